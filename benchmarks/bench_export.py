@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Benchmark end-to-end dell'export contro i server finti di fake_servers.py.
+Per ogni dimensione avvia il server con N deal sintetici ed esegue
+hubspot_to_sheets.py in un processo separato, poi riporta tempo, chiamate
+API, byte trasferiti e picco di memoria (RSS) dell'export.
+
+    python benchmarks/bench_export.py                      # 1k, 10k e 100k deal
+    python benchmarks/bench_export.py 5000 --latency 0.05 --rate429 0.02
+    python benchmarks/bench_export.py 10000 -- --async --combined
+
+Gli argomenti dopo "--" vengono passati all'export. Le variabili d'ambiente
+(es. HUBSPOT_SEARCH_REQUESTS_PER_SECOND, SHEETS_WRITE_MODE) restano valide.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+EXPORTER = os.path.join(os.path.dirname(BENCH_DIR), "hubspot_to_sheets.py")
+
+
+def start_server(count, args):
+    """Avvia fake_servers.py in un processo separato. Ritorna (processo, URL base)."""
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(BENCH_DIR, "fake_servers.py"), "--deals", str(count),
+         "--latency", str(args.latency), "--rate429", str(args.rate429), "--page-size", str(args.page_size)],
+        stdout=subprocess.PIPE, text=True
+    )
+    base_url = server.stdout.readline().strip()
+    if not base_url:
+        server.kill()
+        raise RuntimeError("Server finto non avviato")
+    return server, base_url
+
+
+def get_stats(base_url):
+    with urllib.request.urlopen(f"{base_url}/__stats") as response:
+        return json.loads(response.read())
+
+
+def run_export(base_url, workdir, export_args, quiet):
+    """Esegue l'export in un processo figlio. Ritorna (secondi, picco RSS in MB)."""
+    env = dict(
+        os.environ,
+        HUBSPOT_API_TOKEN="benchmark",
+        GOOGLE_SHEET_ID="benchmark",
+        HUBSPOT_API_BASE=base_url,
+        SHEETS_API_ENDPOINT=base_url,
+        SYNC_STATE_FILE=os.path.join(workdir, "sync_state.json"),
+        DEAL_STORE_FILE=os.path.join(workdir, "deals.sqlite"),
+        LABEL_CACHE_FILE=os.path.join(workdir, "label_cache.json"),
+        # Report, metriche, lock e stato dello scheduler del benchmark non toccano quelli reali
+        RUN_REPORT_FILE=os.path.join(workdir, "run_report.json"),
+        METRICS_FILE=os.path.join(workdir, "hubspot_export.prom"),
+        EXPORT_LOCK_FILE=os.path.join(workdir, "export.lock"),
+        SCHEDULE_STATE_FILE=os.path.join(workdir, "schedule_state.json"),
+    )
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, EXPORTER] + export_args, env=env,
+                               stdout=subprocess.DEVNULL if quiet else None)
+    # wait4 restituisce le risorse del solo processo figlio (ru_maxrss in KB su Linux)
+    _, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    if os.waitstatus_to_exitcode(status) != 0:
+        raise RuntimeError(f"Export terminato con codice {os.waitstatus_to_exitcode(status)}")
+    return elapsed, usage.ru_maxrss / 1024
+
+
+def bench(count, args):
+    server, base_url = start_server(count, args)
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            elapsed, rss_mb = run_export(base_url, workdir, args.export_args, not args.verbose)
+        stats = get_stats(base_url)
+    finally:
+        server.kill()
+        server.wait()
+    return {
+        "deals": count,
+        "seconds": round(elapsed, 2),
+        "hubspot_calls": stats["hubspot_calls"],
+        "sheets_calls": stats["sheets_calls"],
+        "bytes_in": stats["bytes_in"],
+        "bytes_out": stats["bytes_out"],
+        "peak_rss_mb": round(rss_mb, 1),
+        "calls": stats["calls"],
+    }
+
+
+def main():
+    argv = sys.argv[1:]
+    export_args = []
+    if "--" in argv:
+        export_args = argv[argv.index("--") + 1:]
+        argv = argv[:argv.index("--")]
+
+    parser = argparse.ArgumentParser(description="Benchmark end-to-end dell'export su server finti")
+    parser.add_argument("sizes", type=int, nargs="*", default=[1_000, 10_000, 100_000])
+    parser.add_argument("--latency", type=float, default=0.0, help="latenza per richiesta in secondi")
+    parser.add_argument("--rate429", type=float, default=0.0, help="frazione di risposte 429 HubSpot")
+    parser.add_argument("--page-size", type=int, default=200, help="risultati massimi per pagina Search")
+    parser.add_argument("--json", action="store_true", help="stampa i risultati in JSON")
+    parser.add_argument("--verbose", action="store_true", help="mostra l'output dell'export")
+    args = parser.parse_args(argv)
+    args.export_args = export_args
+
+    results = []
+    if not args.json:
+        print(f"{'deal':>8}  {'secondi':>8}  {'HubSpot':>8}  {'Sheets':>7}  {'MB inviati':>10}  "
+              f"{'MB ricevuti':>11}  {'RSS MB':>7}", flush=True)
+    for count in args.sizes:
+        result = bench(count, args)
+        results.append(result)
+        if not args.json:
+            # Byte dal punto di vista dell'export: inviati = ricevuti dal server
+            print(f"{count:>8}  {result['seconds']:>8.2f}  {result['hubspot_calls']:>8}  "
+                  f"{result['sheets_calls']:>7}  {result['bytes_in'] / 1e6:>10.2f}  "
+                  f"{result['bytes_out'] / 1e6:>11.2f}  {result['peak_rss_mb']:>7.1f}", flush=True)
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark della trasformazione deal -> righe (process_deals).
+Misura righe/secondo su 10k e 100k deal sintetici, senza chiamate di rete.
+
+    python benchmarks/bench_process_deals.py [numero_deal ...]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import hubspot_to_sheets as exporter  # noqa: E402
+from synthetic_deals import PIPELINE_STAGES, PROPERTY_OPTIONS, make_deals  # noqa: E402
+
+
+def setup_labels():
+    """Label come le caricherebbe run_export(), senza chiamare HubSpot."""
+    exporter.STAGE_LABELS = {
+        stage_id: label for stages in PIPELINE_STAGES.values() for stage_id, label in stages
+    }
+    # Ordine degli stage: senza, la timeline non aggiunge colonne alle righe
+    exporter.PIPELINE_STAGES = {
+        pipeline_id: [stage_id for stage_id, _ in stages] for pipeline_id, stages in PIPELINE_STAGES.items()
+    }
+    exporter.PROPERTY_LABELS = PROPERTY_OPTIONS
+
+
+def bench(count, partner_keyword):
+    deals = make_deals(count)
+    # Cache delle date vuota: misura anche il parsing
+    exporter.parse_date.cache_clear()
+    exporter.format_date.cache_clear()
+
+    start = time.perf_counter()
+    rows = exporter.process_deals(deals, partner_keyword)
+    elapsed = time.perf_counter() - start
+    return len(rows), elapsed
+
+
+def main():
+    counts = [int(arg) for arg in sys.argv[1:]] or [10_000, 100_000]
+    setup_labels()
+    print(f"{'deal':>8}  {'partner':<14} {'secondi':>8}  {'righe/s':>10}")
+    for count in counts:
+        for partner_keyword in ["Smallpay", "Attitude"]:
+            rows, elapsed = bench(count, partner_keyword)
+            print(f"{count:>8}  {partner_keyword:<14} {elapsed:>8.3f}  {rows / elapsed:>10,.0f}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
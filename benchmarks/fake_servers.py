@@ -0,0 +1,585 @@
+#!/usr/bin/env python3
+"""
+Server HTTP locali che imitano HubSpot e Google Sheets per benchmark end-to-end.
+Implementano solo gli endpoint usati da hubspot_to_sheets.py:
+
+- HubSpot: pipeline dei deal, opzioni delle proprietà, Search API dei deal
+  (filtri EQ / CONTAINS_TOKEN / GT / GTE / LT / LTE, ordinamento per
+  hs_object_id, paging con after e limite di 10.000 risultati per query),
+  batch read, creazione e modifica dei deal (per provare la modalità --webhook),
+  batch read delle associazioni deal -> azienda e delle aziende, elenco owner
+- Sheets: spreadsheets.get / batchUpdate e values get / batchGet / update /
+  batchUpdate / clear / batchClear, con i limiti della griglia come Google,
+  su più spreadsheet distinti per ID
+
+Latenza, dimensione massima delle pagine e percentuale di risposte 429
+(solo HubSpot: il client Sheets non ritenta) sono configurabili.
+GET /__stats restituisce chiamate per endpoint e byte trasferiti,
+POST /__stats/reset li azzera.
+
+    python benchmarks/fake_servers.py --deals 10000 --latency 0.05 --rate429 0.02
+
+Stampa l'URL base da usare come HUBSPOT_API_BASE e SHEETS_API_ENDPOINT.
+"""
+
+import argparse
+import bisect
+import json
+import random
+import re
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+from synthetic_deals import OWNERS, PIPELINE_STAGES, PROPERTY_OPTIONS, deal_company_id, iso, make_company, make_deals
+
+SEARCH_RESULT_LIMIT = 10000   # come HubSpot: after + limit non può superarlo
+SEARCH_MAX_FILTERS = 18       # come HubSpot: filtri totali per richiesta (tutti i filterGroups)
+SHEETS_CELL_LIMIT = 10_000_000  # celle massime per spreadsheet
+ALWAYS_RETURNED = ("hs_object_id", "createdate", "hs_lastmodifieddate")
+ID_OPERATORS = {"GT", "GTE", "LT", "LTE"}
+
+
+def to_number(value):
+    """Valore confrontabile per GT/LT: numero o data ISO in millisecondi."""
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp() * 1000
+
+
+def filter_matches(props, flt):
+    """Valuta un filtro della Search API sulle proprietà di un deal."""
+    value = props.get(flt["propertyName"])
+    operator, expected = flt["operator"], flt.get("value")
+    if operator == "EQ":
+        return value == expected
+    if operator == "CONTAINS_TOKEN":
+        # "smallpay*": token che inizia con il prefisso, senza distinzione di maiuscole
+        prefix = expected.rstrip("*").lower()
+        return value is not None and re.search(r"\b" + re.escape(prefix), value.lower()) is not None
+    if operator in ID_OPERATORS:
+        if value is None:
+            return False
+        a, b = to_number(value), to_number(expected)
+        return {"GT": a > b, "GTE": a >= b, "LT": a < b, "LTE": a <= b}[operator]
+    if operator == "IN":
+        return value in flt.get("values", [])
+    raise ValueError(f"Operatore non supportato: {operator}")
+
+
+def id_bounds(filters):
+    """Separa i filtri su hs_object_id (intervallo [low, high)) dagli altri."""
+    low, high, others = float("-inf"), float("inf"), []
+    for flt in filters:
+        if flt["propertyName"] == "hs_object_id" and flt["operator"] in ID_OPERATORS:
+            value = int(flt["value"])
+            if flt["operator"] == "GT":
+                low = max(low, value + 1)
+            elif flt["operator"] == "GTE":
+                low = max(low, value)
+            elif flt["operator"] == "LT":
+                high = min(high, value)
+            else:
+                high = min(high, value + 1)
+        else:
+            others.append(flt)
+    return low, high, others
+
+
+def column_index(letters):
+    index = 0
+    for char in letters:
+        index = index * 26 + ord(char) - 64
+    return index - 1
+
+
+def parse_range(range_name):
+    """
+    Range A1 -> (titolo, riga, colonna, riga_fine, colonna_fine), 0-based con
+    estremi finali esclusi (None = fino alla fine del foglio).
+    """
+    match = re.match(r"^(?:'((?:[^']|'')+)'|([^!]+))(?:!(.*))?$", range_name)
+    if not match:
+        raise ValueError(f"Unable to parse range: {range_name}")
+    title = (match.group(1) or match.group(2)).replace("''", "'")
+    cells = [re.match(r"^([A-Z]*)(\d*)$", part) for part in (match.group(3) or "").split(":") if part]
+    if not cells:
+        return title, 0, 0, None, None
+    start_col = column_index(cells[0].group(1)) if cells[0].group(1) else 0
+    start_row = int(cells[0].group(2)) - 1 if cells[0].group(2) else 0
+    if len(cells) == 1:
+        return title, start_row, start_col, None, None
+    end_col = column_index(cells[1].group(1)) + 1 if cells[1].group(1) else None
+    end_row = int(cells[1].group(2)) if cells[1].group(2) else None
+    return title, start_row, start_col, end_row, end_col
+
+
+class FakeState:
+    """Dati e statistiche condivisi dai thread del server."""
+
+    def __init__(self, deals, latency=0.0, rate429=0.0, page_size=200):
+        self.deals = sorted(deals, key=lambda deal: int(deal["id"]))
+        self.ids = [int(deal["id"]) for deal in self.deals]
+        self.latency = latency
+        self.rate429 = rate429
+        self.page_size = page_size
+        self.search_cache = {}  # filtri non-ID -> posizioni dei deal che li soddisfano
+        self.sheets = {}        # titolo -> {"sheetId", "rowCount", "columnCount", "grid"}
+        self.spreadsheets = {}  # ID -> fogli; il primo spreadsheet usato è self.sheets
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.calls = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def count(self, endpoint, bytes_in=0, bytes_out=0):
+        with self.lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+
+    def stats(self):
+        with self.lock:
+            return {
+                "calls": dict(self.calls),
+                "hubspot_calls": sum(n for key, n in self.calls.items() if " /crm/" in key),
+                "sheets_calls": sum(n for key, n in self.calls.items() if " /v4/" in key),
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+            }
+
+    # ---- HubSpot
+
+    def matching_positions(self, filters):
+        """Posizioni (ordinate per ID) dei deal che soddisfano un filterGroup."""
+        low, high, others = id_bounds(filters)
+        key = json.dumps(others, sort_keys=True)
+        with self.lock:
+            positions = self.search_cache.get(key)
+        if positions is None:
+            positions = [i for i, deal in enumerate(self.deals)
+                         if all(filter_matches(deal["properties"], flt) for flt in others)]
+            with self.lock:
+                self.search_cache[key] = positions
+        # Intervallo di hs_object_id con ricerca binaria sulle posizioni già filtrate
+        first = bisect.bisect_left(positions, bisect.bisect_left(self.ids, low)) if low > float("-inf") else 0
+        last = (bisect.bisect_left(positions, bisect.bisect_left(self.ids, high))
+                if high < float("inf") else len(positions))
+        return positions[first:last]
+
+    def search(self, body):
+        groups = [group.get("filters", []) for group in body.get("filterGroups") or []] or [[]]
+        if sum(len(filters) for filters in groups) > SEARCH_MAX_FILTERS:
+            return 400, {"status": "error", "category": "VALIDATION_ERROR",
+                         "message": f"Una richiesta può contenere al massimo {SEARCH_MAX_FILTERS} filtri"}
+        positions = sorted(set().union(*(self.matching_positions(filters) for filters in groups)))
+        sorts = body.get("sorts") or []
+        if sorts and sorts[0].get("propertyName") not in (None, "hs_object_id"):
+            raise ValueError("Ordinamento supportato solo per hs_object_id")
+        if sorts and sorts[0].get("direction") == "DESCENDING":
+            positions.reverse()
+
+        after = int(body.get("after") or 0)
+        limit = min(int(body.get("limit", 10)), self.page_size)
+        if after + limit > SEARCH_RESULT_LIMIT:
+            return 400, {"status": "error", "category": "VALIDATION_ERROR",
+                         "message": f"after + limit non può superare {SEARCH_RESULT_LIMIT}"}
+
+        properties = set(body.get("properties") or []) | set(ALWAYS_RETURNED)
+        results = []
+        for position in positions[after:after + limit]:
+            deal = self.deals[position]
+            props = deal["properties"]
+            results.append({"id": deal["id"], "properties": {name: props.get(name) for name in properties}})
+        response = {"total": len(positions), "results": results}
+        if after + limit < len(positions):
+            response["paging"] = {"next": {"after": str(after + limit)}}
+        return 200, response
+
+    def deal_output(self, deal, properties):
+        props = deal["properties"]
+        return {"id": deal["id"], "properties": {name: props.get(name) for name in properties}, "archived": False}
+
+    def batch_read(self, body):
+        properties = set(body.get("properties") or []) | set(ALWAYS_RETURNED)
+        results, missing = [], []
+        for item in body.get("inputs", []):
+            position = bisect.bisect_left(self.ids, int(item["id"]))
+            if position < len(self.ids) and self.ids[position] == int(item["id"]):
+                results.append(self.deal_output(self.deals[position], properties))
+            else:
+                missing.append(str(item["id"]))
+        response = {"status": "COMPLETE", "results": results}
+        if missing:
+            # Come HubSpot: 207 Multi-Status con i deal non trovati
+            response["errors"] = [{"status": "error", "category": "OBJECT_NOT_FOUND",
+                                   "message": "Could not get some DEAL objects", "context": {"ids": missing}}]
+            return 207, response
+        return 200, response
+
+    def deal_companies(self, body):
+        results, missing = [], []
+        for item in body.get("inputs", []):
+            company_id = deal_company_id(item["id"])
+            if company_id is None:
+                missing.append(str(item["id"]))
+                continue
+            results.append({"from": {"id": str(item["id"])}, "to": [{
+                "toObjectId": int(company_id),
+                "associationTypes": [{"category": "HUBSPOT_DEFINED", "typeId": 5, "label": "Primary"},
+                                     {"category": "HUBSPOT_DEFINED", "typeId": 341, "label": None}],
+            }]})
+        response = {"status": "COMPLETE", "results": results}
+        if missing:
+            response["errors"] = [{"status": "error", "category": "OBJECT_NOT_FOUND",
+                                   "message": "No company is associated", "context": {"fromObjectId": missing}}]
+            return 207, response
+        return 200, response
+
+    def companies(self, body):
+        properties = body.get("properties") or []
+        return 200, {"status": "COMPLETE", "results": [
+            {"id": str(item["id"]), "properties": {name: make_company(item["id"]).get(name) for name in properties},
+             "archived": False}
+            for item in body.get("inputs", [])
+        ]}
+
+    def owners(self, query):
+        limit = min(int(query.get("limit", ["100"])[0]), 500)
+        archived = query.get("archived", ["false"])[0] == "true"
+        owners = [owner for owner in OWNERS if owner["archived"] == archived]
+        start = int(query.get("after", ["0"])[0])
+        response = {"results": owners[start:start + limit]}
+        if start + limit < len(owners):
+            response["paging"] = {"next": {"after": str(start + limit)}}
+        return 200, response
+
+    def save_deal(self, deal_id, properties):
+        """Crea (deal_id None) o modifica un deal; hs_lastmodifieddate diventa adesso."""
+        now = iso(datetime.now(timezone.utc))
+        with self.lock:
+            if deal_id is None:
+                deal_id = str((self.ids[-1] if self.ids else 0) + 1)
+                deal = {"id": deal_id, "properties": {"hs_object_id": deal_id, "createdate": now}}
+                self.deals.append(deal)
+                self.ids.append(int(deal_id))
+                status = 201
+            else:
+                position = bisect.bisect_left(self.ids, int(deal_id))
+                if position == len(self.ids) or self.ids[position] != int(deal_id):
+                    return 404, {"status": "error", "category": "OBJECT_NOT_FOUND", "message": "Not found"}
+                deal = self.deals[position]
+                status = 200
+            deal["properties"].update(properties, hs_lastmodifieddate=now)
+            # I risultati di ricerca in cache non sono più validi
+            self.search_cache.clear()
+        return status, self.deal_output(deal, deal["properties"])
+
+    def pipelines(self):
+        return 200, {"results": [
+            {"id": pipeline_id, "label": pipeline_id, "stages": [
+                {"id": stage_id, "label": label, "displayOrder": position}
+                for position, (stage_id, label) in enumerate(stages)
+            ]}
+            for pipeline_id, stages in PIPELINE_STAGES.items()
+        ]}
+
+    def property_options(self, name):
+        if name not in PROPERTY_OPTIONS:
+            return 404, {"status": "error", "message": f"Property {name} does not exist"}
+        return 200, {"name": name, "options": [
+            {"value": value, "label": label} for value, label in PROPERTY_OPTIONS[name].items()
+        ]}
+
+    # ---- Sheets
+
+    def sheet(self, title):
+        if title not in self.sheets:
+            raise ValueError(f"Unable to parse range: {title}")
+        return self.sheets[title]
+
+    def sheet_by_id(self, sheet_id):
+        for sheet in self.sheets.values():
+            if sheet["sheetId"] == sheet_id:
+                return sheet
+        raise ValueError(f"No grid with id: {sheet_id}")
+
+    def check_grid(self, sheet, end_row, end_col, label):
+        if end_row > sheet["rowCount"] or end_col > sheet["columnCount"]:
+            raise ValueError(f"Range ({label}) exceeds grid limits. Max rows: "
+                             f"{sheet['rowCount']}, max columns: {sheet['columnCount']}")
+
+    def resize(self, sheet, rows, columns):
+        total = sum(s["rowCount"] * s["columnCount"] for s in self.sheets.values() if s is not sheet)
+        if total + rows * columns > SHEETS_CELL_LIMIT:
+            raise ValueError(f"This action would increase the number of cells in the "
+                             f"workbook above the limit of {SHEETS_CELL_LIMIT} cells.")
+        sheet["rowCount"], sheet["columnCount"] = rows, columns
+        del sheet["grid"][rows:]
+        for row in sheet["grid"]:
+            del row[columns:]
+
+    def write(self, range_name, values):
+        title, start_row, start_col, _, _ = parse_range(range_name)
+        sheet = self.sheet(title)
+        width = max((len(row) for row in values), default=0)
+        self.check_grid(sheet, start_row + len(values), start_col + width, range_name)
+        grid = sheet["grid"]
+        if len(grid) < start_row + len(values):
+            grid.extend([] for _ in range(start_row + len(values) - len(grid)))
+        for offset, row in enumerate(values):
+            target = grid[start_row + offset]
+            if len(target) < start_col + len(row):
+                target.extend([""] * (start_col + len(row) - len(target)))
+            target[start_col:start_col + len(row)] = row
+        return sum(len(row) for row in values)
+
+    def clear(self, start_row, start_col, end_row, end_col, sheet):
+        for row in sheet["grid"][start_row:end_row]:
+            for col in range(start_col, min(len(row), end_col if end_col is not None else len(row))):
+                row[col] = ""
+
+    def read(self, range_name, unformatted):
+        title, start_row, start_col, end_row, end_col = parse_range(range_name)
+        values = []
+        for row in self.sheet(title)["grid"][start_row:end_row]:
+            row = row[start_col:end_col]
+            while row and row[-1] == "":
+                row = row[:-1]
+            values.append(row if unformatted else [str(value) for value in row])
+        while values and not values[-1]:
+            values.pop()
+        return {"range": range_name, "majorDimension": "ROWS", "values": values} if values else {"range": range_name}
+
+    def grid_range(self, grid_range):
+        sheet = self.sheet_by_id(grid_range.get("sheetId", 0))
+        end_row = grid_range.get("endRowIndex", sheet["rowCount"])
+        end_col = grid_range.get("endColumnIndex", sheet["columnCount"])
+        self.check_grid(sheet, end_row, end_col, f"sheetId {sheet['sheetId']}")
+        return sheet, grid_range.get("startRowIndex", 0), grid_range.get("startColumnIndex", 0), end_row, end_col
+
+    def batch_update(self, spreadsheet_id, body):
+        replies = []
+        for request in body.get("requests", []):
+            kind, params = next(iter(request.items()))
+            reply = {}
+            if kind == "addSheet":
+                props = params.get("properties", {})
+                title = props["title"]
+                if title in self.sheets:
+                    raise ValueError(f'A sheet with the name "{title}" already exists.')
+                sheet_id = props.get("sheetId", max([s["sheetId"] for s in self.sheets.values()] + [0]) + 1)
+                grid = props.get("gridProperties", {})
+                sheet = {"sheetId": sheet_id, "rowCount": 0, "columnCount": 0, "grid": []}
+                self.sheets[title] = sheet
+                self.resize(sheet, grid.get("rowCount", 1000), grid.get("columnCount", 26))
+                reply = {"addSheet": {"properties": {"sheetId": sheet_id, "title": title}}}
+            elif kind == "updateSheetProperties":
+                props = params["properties"]
+                sheet = self.sheet_by_id(props.get("sheetId", 0))
+                grid = props.get("gridProperties", {})
+                self.resize(sheet, grid.get("rowCount", sheet["rowCount"]),
+                            grid.get("columnCount", sheet["columnCount"]))
+            elif kind == "updateCells":
+                sheet, start_row, start_col, end_row, end_col = self.grid_range(params["range"])
+                if "rows" in params:
+                    raise ValueError("updateCells con rows non supportato")
+                self.clear(start_row, start_col, end_row, end_col, sheet)
+            elif kind == "deleteSheet":
+                sheet = self.sheet_by_id(params["sheetId"])
+                if len(self.sheets) == 1:
+                    raise ValueError("You can't remove all the sheets in a document.")
+                del self.sheets[next(title for title, s in self.sheets.items() if s is sheet)]
+            elif kind == "createDeveloperMetadata":
+                metadata = params["developerMetadata"]
+                sheet = self.sheet_by_id(metadata["location"]["sheetId"])
+                sheet.setdefault("metadata", []).append(
+                    {key: metadata[key] for key in ("metadataKey", "metadataValue") if key in metadata}
+                )
+            elif kind == "repeatCell":
+                # Solo formattazione: la griglia viene comunque validata
+                self.grid_range(params["range"])
+            else:
+                raise ValueError(f"Richiesta batchUpdate non supportata: {kind}")
+            replies.append(reply)
+        return 200, {"spreadsheetId": spreadsheet_id, "replies": replies}
+
+    def spreadsheet_call(self, method, spreadsheet_id, rest, query, body):
+        """Chiamata Sheets sullo spreadsheet dell'URL (più spreadsheet per le destinazioni aggiuntive)."""
+        if not self.spreadsheets:
+            self.spreadsheets[spreadsheet_id] = self.sheets
+        primary, self.sheets = self.sheets, self.spreadsheets.setdefault(spreadsheet_id, {})
+        try:
+            return self.sheets_call(method, spreadsheet_id, rest, query, body)
+        finally:
+            self.sheets = primary
+
+    def sheets_call(self, method, spreadsheet_id, rest, query, body):
+        unformatted = query.get("valueRenderOption", [""])[0] == "UNFORMATTED_VALUE"
+        if method == "GET" and rest == "":
+            return 200, {"spreadsheetId": spreadsheet_id, "sheets": [
+                {"properties": {"sheetId": sheet["sheetId"], "title": title, "gridProperties": {
+                    "rowCount": sheet["rowCount"], "columnCount": sheet["columnCount"]}},
+                 "developerMetadata": sheet.get("metadata", [])}
+                for title, sheet in self.sheets.items()
+            ]}
+        if rest == ":batchUpdate":
+            return self.batch_update(spreadsheet_id, body)
+        if rest == "/values:batchUpdate":
+            cells = sum(self.write(data["range"], data["values"]) for data in body.get("data", []))
+            return 200, {"spreadsheetId": spreadsheet_id, "totalUpdatedCells": cells}
+        if rest == "/values:batchGet":
+            return 200, {"spreadsheetId": spreadsheet_id,
+                         "valueRanges": [self.read(name, unformatted) for name in query.get("ranges", [])]}
+        if rest == "/values:batchClear":
+            for name in body.get("ranges", []):
+                title, *bounds = parse_range(name)
+                self.clear(bounds[0], bounds[1], bounds[2], bounds[3], self.sheet(title))
+            return 200, {"spreadsheetId": spreadsheet_id}
+        match = re.match(r"^/values/(.+?)(:clear)?$", rest)
+        if not match:
+            return 404, {"error": {"code": 404, "message": f"Endpoint non implementato: {rest}"}}
+        range_name = match.group(1)
+        if match.group(2):
+            title, *bounds = parse_range(range_name)
+            self.clear(bounds[0], bounds[1], bounds[2], bounds[3], self.sheet(title))
+            return 200, {"spreadsheetId": spreadsheet_id, "clearedRange": range_name}
+        if method == "PUT":
+            cells = self.write(range_name, body.get("values", []))
+            return 200, {"spreadsheetId": spreadsheet_id, "updatedRange": range_name,
+                         "updatedRows": len(body.get("values", [])), "updatedCells": cells}
+        return 200, self.read(range_name, unformatted)
+
+
+def make_handler(state):
+    class FakeHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # connessioni keep-alive come le API reali
+
+        def log_message(self, *args):
+            pass
+
+        def send_json(self, status, payload, endpoint, bytes_in):
+            body = json.dumps(payload).encode()
+            state.count(endpoint, bytes_in, len(body))
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            if status == 429:
+                self.send_header("Retry-After", "1")
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            self.dispatch("GET")
+
+        def do_POST(self):
+            self.dispatch("POST")
+
+        def do_PUT(self):
+            self.dispatch("PUT")
+
+        def do_PATCH(self):
+            self.dispatch("PATCH")
+
+        def dispatch(self, method):
+            length = int(self.headers.get("Content-Length") or 0)
+            raw = self.rfile.read(length) if length else b""
+            url = urlparse(self.path)
+            path = unquote(url.path)
+            query = parse_qs(url.query)
+
+            if path.startswith("/__stats"):
+                if method == "POST":
+                    with state.lock:
+                        state.reset_stats()
+                body = json.dumps(state.stats()).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+
+            # Endpoint per le statistiche: ID spreadsheet e range non distinguono le chiamate
+            endpoint = f"{method} " + re.sub(r"^(/v4/spreadsheets/)[^/:]+(/values/[^:]+)?",
+                                             lambda m: m.group(1) + "*" + ("/values/*" if m.group(2) else ""), path)
+            endpoint = re.sub(r"^(GET /crm/v3/properties/deals/|PATCH /crm/v3/objects/deals/).+$", r"\1*", endpoint)
+            if state.latency:
+                time.sleep(state.latency)
+            if path.startswith("/crm/") and state.rate429 and random.random() < state.rate429:
+                return self.send_json(429, {"status": "error", "category": "RATE_LIMITS",
+                                            "message": "You have reached your secondly limit."}, endpoint, len(raw))
+            try:
+                body = json.loads(raw) if raw else {}
+                if path.startswith("/crm/"):
+                    status, payload = self.hubspot(method, path, body, query)
+                else:
+                    match = re.match(r"^/v4/spreadsheets/([^/:]+)(.*)$", path)
+                    if not match:
+                        status, payload = 404, {"error": {"code": 404, "message": path}}
+                    else:
+                        with state.lock:
+                            status, payload = state.spreadsheet_call(method, match.group(1), match.group(2), query, body)
+            except ValueError as e:
+                status, payload = 400, {"error": {"code": 400, "message": str(e), "status": "INVALID_ARGUMENT"}}
+            self.send_json(status, payload, endpoint, len(raw))
+
+        def hubspot(self, method, path, body, query):
+            if path == "/crm/v3/objects/deals/search" and method == "POST":
+                return state.search(body)
+            if path == "/crm/v4/associations/deals/companies/batch/read" and method == "POST":
+                return state.deal_companies(body)
+            if path == "/crm/v3/objects/companies/batch/read" and method == "POST":
+                return state.companies(body)
+            if path.rstrip("/") == "/crm/v3/owners":
+                return state.owners(query)
+            if path == "/crm/v3/objects/deals/batch/read" and method == "POST":
+                return state.batch_read(body)
+            if path == "/crm/v3/objects/deals" and method == "POST":
+                return state.save_deal(None, body.get("properties", {}))
+            match = re.match(r"^/crm/v3/objects/deals/(\d+)$", path)
+            if match and method == "PATCH":
+                return state.save_deal(match.group(1), body.get("properties", {}))
+            if path == "/crm/v3/pipelines/deals":
+                return state.pipelines()
+            match = re.match(r"^/crm/v3/properties/deals/([^/]+)$", path)
+            if match:
+                return state.property_options(match.group(1))
+            return 404, {"status": "error", "message": f"Endpoint non implementato: {path}"}
+
+    return FakeHandler
+
+
+def start(deals, latency=0.0, rate429=0.0, page_size=200, port=0):
+    """Avvia il server in un thread. Ritorna (server, stato, URL base)."""
+    state = FakeState(deals, latency, rate429, page_size)
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(state))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Server HubSpot e Google Sheets finti per benchmark")
+    parser.add_argument("--deals", type=int, default=1000, help="numero di deal sintetici")
+    parser.add_argument("--port", type=int, default=0, help="porta (0 = libera)")
+    parser.add_argument("--latency", type=float, default=0.0, help="latenza per richiesta in secondi")
+    parser.add_argument("--rate429", type=float, default=0.0, help="frazione di risposte 429 HubSpot")
+    parser.add_argument("--page-size", type=int, default=200, help="risultati massimi per pagina Search")
+    args = parser.parse_args()
+
+    server, _, base_url = start(make_deals(args.deals), args.latency, args.rate429, args.page_size, args.port)
+    print(base_url, flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
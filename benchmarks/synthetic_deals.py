@@ -0,0 +1,114 @@
+"""
+Generatore di deal HubSpot sintetici per benchmark e test locali.
+I deal hanno la stessa forma dei risultati della Search API.
+"""
+
+import random
+from datetime import datetime, timedelta, timezone
+
+PARTNER_LABELS = ["Smallpay", "Deutsche Bank", "Attitude", "PostePay"]
+
+# Stage di esempio per pipeline (ID reali delle pipeline configurate)
+PIPELINE_STAGES = {
+    "1347411134": [
+        ("1834011864", "Qualified"),
+        ("1834011865", "Proposal sent"),
+        ("1834011866", "KYC Pending Approval"),
+        ("2019816637", "Onboarding Completed"),
+        ("1834011869", "Closed lost"),
+    ],
+    "75805933": [
+        ("181259987", "New"),
+        ("181259988", "Proposal sent"),
+        ("720800761", "KYC Pending Approval"),
+        ("181259990", "Onboarding Completed"),
+    ],
+}
+
+PROPERTY_OPTIONS = {
+    "instore_category": {"fashion": "Fashion", "home": "Casa e arredamento", "beauty": "Beauty"},
+    "risk_check_status": {"approved": "Approved", "pending": "Pending", "rejected": "Rejected"},
+    "store_type": {"Physical store": "Physical store", "Online": "Online", "Omnichannel": "Omnichannel"},
+}
+
+
+CITIES = ["Milano", "Roma", "Torino", "Napoli", "Bologna", "Firenze"]
+
+# Owner dei deal (hubspot_owner_id da 1 a 19); l'ultimo è archiviato
+OWNERS = [
+    {"id": str(owner_id), "email": f"owner{owner_id}@example.com", "firstName": f"Nome{owner_id}",
+     "lastName": f"Cognome{owner_id}", "archived": owner_id == 19}
+    for owner_id in range(1, 20)
+]
+
+
+def deal_company_id(deal_id):
+    """Azienda associata al deal (None per un deal su 13): 97 aziende condivise tra i deal."""
+    deal_id = int(deal_id)
+    return None if deal_id % 13 == 0 else str(5000 + deal_id % 97)
+
+
+def make_company(company_id):
+    """Proprietà dell'azienda sintetica (come la batch read delle aziende)."""
+    number = int(company_id) - 5000
+    return {
+        "name": f"Azienda {number} S.r.l.",
+        "vat_number": f"IT{number:011d}",
+        "city": CITIES[number % len(CITIES)],
+    }
+
+
+def iso(dt):
+    """Formato timestamp HubSpot: 2024-01-31T10:00:00.000Z"""
+    return dt.strftime("%Y-%m-%dT%H:%M:%S.") + f"{dt.microsecond // 1000:03d}Z"
+
+
+def make_deals(count, seed=42, first_id=1000):
+    """Genera `count` deal distribuiti sui 4 partner, con date di ingresso/uscita negli stage."""
+    rnd = random.Random(seed)
+    start = datetime(2023, 1, 1, tzinfo=timezone.utc)
+    deals = []
+    for i in range(count):
+        label = PARTNER_LABELS[i % len(PARTNER_LABELS)]
+        pipeline_id = "75805933" if label == "Smallpay" else "1347411134"
+        stages = PIPELINE_STAGES[pipeline_id]
+        current = rnd.randrange(len(stages))
+        created = start + timedelta(minutes=rnd.randrange(900 * 24 * 60))
+        modified = created + timedelta(minutes=rnd.randrange(60 * 24 * 60))
+        deal_id = str(first_id + i)
+        props = {
+            "hs_object_id": deal_id,
+            "dealname": f"Merchant {i}",
+            "createdate": iso(created),
+            "hs_lastmodifieddate": iso(modified),
+            "amount": str(rnd.randrange(1000, 3000000)),
+            "dealstage": stages[current][0],
+            "pipeline": pipeline_id,
+            "partner_label_name": label + (" Italia" if i % 7 == 0 else ""),
+            "ttv_all_time": str(round(rnd.random() * 100000, 2)),
+            "instore_category": rnd.choice(list(PROPERTY_OPTIONS["instore_category"])),
+            "offline_annual_revenue": str(rnd.randrange(0, 5000000)),
+            "first_order_ttv": str(round(rnd.random() * 500, 2)),
+            "days_between_create_and_kyc": str(rnd.randrange(0, 90 * 86400000)),
+            "risk_check_status": rnd.choice(list(PROPERTY_OPTIONS["risk_check_status"])),
+            "store_type": rnd.choice(list(PROPERTY_OPTIONS["store_type"])),
+            "category": None,
+            "onboarding_declined_reason": None,
+            "hubspot_owner_id": str(rnd.randrange(1, 20)),
+            "third_party___customer_tier": rnd.choice(["Gold", "Silver", None]),
+            "third_party___remuneration": None,
+            "original_agent_source_name": None,
+            "third_party___fixed_fee": None,
+            "third_party___products__fee": None,
+            "original_agent_email": None,
+        }
+        entered = created
+        for position, (stage_id, _) in enumerate(stages[:current + 1]):
+            props[f"hs_v2_date_entered_{stage_id}"] = iso(entered)
+            if position < current:
+                exited = entered + timedelta(minutes=rnd.randrange(10, 30 * 24 * 60))
+                props[f"hs_v2_date_exited_{stage_id}"] = iso(exited)
+                props[f"hs_v2_cumulative_time_in_{stage_id}"] = str(int((exited - entered).total_seconds() * 1000))
+                entered = exited
+        deals.append({"id": deal_id, "properties": props})
+    return deals
@@ -1,20 +1,72 @@
 #!/usr/bin/env python3
 """
 Script per estrarre deal da HubSpot e inserirli in Google Sheets.
-Esegue automaticamente alle 05:05 se usato con --schedule
+Con --schedule resta attivo: export completo alle 05:05 e, con --incremental,
+sync incrementali per partner a intervalli propri
+Con --incremental scarica solo i deal modificati dall'ultimo export
+Con --combined esegue una sola ricerca HubSpot per pipeline
+Con SHEETS_WRITE_MODE=stream legge, trasforma e scrive i deal a blocchi
+I deal letti vengono salvati in un archivio SQLite locale da cui vengono generati i fogli;
+lo storico dei cambi di stage alimenta le metriche di funnel del foglio "Funnel";
+con --render-from-store i fogli vengono rigenerati dall'archivio senza chiamare HubSpot
+I partner vengono esportati in parallelo (EXPORT_WORKERS thread)
 """
 
+import asyncio
+import base64
+import calendar
+import contextvars
+import csv
+import gzip
+import hashlib
+import hmac
+import json
+import math
+import queue
+import random
+import re
+import shutil
+import sqlite3
 import requests
-from datetime import datetime
+from requests.adapters import HTTPAdapter
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
+from statistics import median
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import os
 import sys
+import threading
 import time
-import schedule
 from dotenv import load_dotenv
+from google.auth.credentials import AnonymousCredentials
 from google.oauth2.credentials import Credentials
 from google.auth.transport.requests import Request
 from googleapiclient.discovery import build
 
+try:
+    import httpx  # opzionale: solo per la modalità --async
+except ImportError:
+    httpx = None
+
+try:
+    import pyarrow  # opzionale: solo per l'export colonnare Parquet
+    import pyarrow.parquet as pq
+except ImportError:
+    pyarrow = pq = None
+
+try:
+    import resource  # non disponibile su Windows: picco di memoria non misurato
+except ImportError:
+    resource = None
+
+try:
+    import fcntl  # non disponibile su Windows: nessun lock tra processi
+except ImportError:
+    fcntl = None
+
 # Carica variabili d'ambiente
 load_dotenv()
 
@@ -24,6 +76,10 @@ GOOGLE_SHEET_ID = os.getenv("GOOGLE_SHEET_ID", "1JtvLP9vLPkn98seLav0tUQShvQyICSf
 
 # Partner da filtrare con i rispettivi nomi dei fogli e pipeline
 # pipeline_id: None = usa pipeline di default (Partnership), altrimenti specifica
+# Chiavi opzionali per --schedule --incremental: "sync_minutes" (intervallo del
+# sync incrementale, default SCHEDULE_INCREMENTAL_MINUTES) e "priority" (a parità
+# di scadenza i partner con priorità più alta vengono esportati per primi, default 0).
+# "spreadsheet_id": spreadsheet esterno del partner, che riceve una copia del suo foglio
 PARTNERS = {
     "Smallpay": {"sheet": "Smallpay", "pipeline": "75805933"},  # Marketing pipeline
     "Deutsche Bank": {"sheet": "Deutsche Bank", "pipeline": None},
@@ -31,13 +87,162 @@ PARTNERS = {
     "PostePay": {"sheet": "PostePay", "pipeline": None}
 }
 
+# Destinazioni aggiuntive alimentate dalla stessa lettura HubSpot: spreadsheet con
+# tutti i partner (es. copia interna, ID separati da virgola) e file locali per
+# partner in EXPORT_DIR nei formati EXPORT_FORMATS (csv). Vuoto = disattivato.
+MIRROR_SPREADSHEET_IDS = [s.strip() for s in os.getenv("MIRROR_SPREADSHEET_IDS", "").split(",") if s.strip()]
+EXPORT_DIR = os.getenv("EXPORT_DIR", "")
+EXPORT_FORMATS = [s.strip() for s in os.getenv("EXPORT_FORMATS", "csv").split(",") if s.strip()]
+# Export colonnare per la BI: valori tipizzati, partizionati per partner e mese
+# di creazione, in formato parquet o csv.gz, scritti a blocchi di righe
+COLUMNAR_EXPORT_DIR = os.getenv("COLUMNAR_EXPORT_DIR", "")
+COLUMNAR_FORMAT = os.getenv("COLUMNAR_FORMAT", "parquet")
+COLUMNAR_CHUNK_ROWS = int(os.getenv("COLUMNAR_CHUNK_ROWS", "50000"))
+
 SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
+# Endpoint alternativo delle API Sheets senza credenziali (es. benchmarks/fake_servers.py)
+SHEETS_API_ENDPOINT = os.getenv("SHEETS_API_ENDPOINT")
+
+# File con il checkpoint (high-water mark di hs_lastmodifieddate) per partner
+SYNC_STATE_FILE = os.getenv(
+    "SYNC_STATE_FILE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "sync_state.json")
+)
+# Archivio SQLite dei deal (ultima versione letta da HubSpot per Deal ID)
+DEAL_STORE_FILE = os.getenv(
+    "DEAL_STORE_FILE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "deals.sqlite")
+)
+# Ultimi run riusciti dello scheduler (--schedule), per recuperare i run persi
+SCHEDULE_STATE_FILE = os.getenv(
+    "SCHEDULE_STATE_FILE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "schedule_state.json")
+)
+# Lock tra processi: un solo export alla volta (schedulato o manuale)
+EXPORT_LOCK_FILE = os.getenv(
+    "EXPORT_LOCK_FILE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "export.lock")
+)
+# Cache su disco delle label (stage delle pipeline e opzioni delle proprietà)
+LABEL_CACHE_FILE = os.getenv(
+    "LABEL_CACHE_FILE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "label_cache.json")
+)
+LABEL_CACHE_TTL = int(os.getenv("LABEL_CACHE_TTL", str(24 * 3600)))  # secondi
+# Cache dell'arricchimento (azienda associata e owner dei deal) nell'archivio locale:
+# le voci più vecchie del TTL vengono rilette quando servono, quelle non più
+# aggiornate da ENRICHMENT_CACHE_MAX_AGE vengono eliminate
+ENRICHMENT_CACHE_TTL = int(os.getenv("ENRICHMENT_CACHE_TTL", str(24 * 3600)))  # secondi
+ENRICHMENT_CACHE_MAX_AGE = int(os.getenv("ENRICHMENT_CACHE_MAX_AGE", str(30 * 24 * 3600)))  # secondi
+# Telemetria del run: report JSON e metriche per il textfile collector di
+# Prometheus (node_exporter). Stringa vuota = file non scritto.
+RUN_REPORT_FILE = os.getenv(
+    "RUN_REPORT_FILE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "run_report.json")
+)
+METRICS_FILE = os.getenv(
+    "METRICS_FILE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "hubspot_export.prom")
+)
+
+# Margine di sicurezza sul checkpoint: l'indice della Search API è in ritardo
+# di qualche secondo, i deal riletti vengono comunque sovrascritti per Deal ID
+INCREMENTAL_OVERLAP_MS = 5 * 60 * 1000
 
 HUBSPOT_HEADERS = {
     "Authorization": f"Bearer {HUBSPOT_API_TOKEN}",
     "Content-Type": "application/json"
 }
 
+# Client HTTP HubSpot: timeout (connessione, lettura) in secondi e retry
+HUBSPOT_API_BASE = os.getenv("HUBSPOT_API_BASE", "https://api.hubapi.com")
+HUBSPOT_TIMEOUT = (
+    float(os.getenv("HUBSPOT_CONNECT_TIMEOUT", "5")),
+    float(os.getenv("HUBSPOT_READ_TIMEOUT", "60"))
+)
+HUBSPOT_MAX_RETRIES = int(os.getenv("HUBSPOT_MAX_RETRIES", "6"))
+HUBSPOT_BACKOFF_BASE = 1.0   # secondi, raddoppia a ogni tentativo
+HUBSPOT_BACKOFF_MAX = 60.0
+HUBSPOT_RETRY_STATUS = {429, 500, 502, 503, 504}
+
+# Scrittura sui fogli: "delta" aggiorna solo le righe cambiate, "full" pulisce e riscrive tutto,
+# "stream" scrive a blocchi di SHEETS_STREAM_CHUNK_ROWS righe mentre le pagine vengono lette
+SHEETS_WRITE_MODE = os.getenv("SHEETS_WRITE_MODE", "delta")
+SHEETS_STREAM_CHUNK_ROWS = int(os.getenv("SHEETS_STREAM_CHUNK_ROWS", "5000"))
+
+# Limiti di Google Sheets: celle per spreadsheet (tutti i fogli, griglia compresa)
+# e colonne per foglio; oltre SHEETS_MAX_ROWS_PER_TAB righe il partner prosegue
+# nei fogli "Partner (2)", "Partner (3)", ... e, finite le celle, negli
+# spreadsheet di OVERFLOW_SPREADSHEET_IDS (elencati nel foglio SHEETS_INDEX_SHEET)
+SHEETS_CELL_LIMIT = 10_000_000
+SHEETS_MAX_COLUMNS = 18_278
+SHEETS_MAX_ROWS_PER_TAB = int(os.getenv("SHEETS_MAX_ROWS_PER_TAB", "200000"))
+# Dimensione massima (JSON) di una chiamata values: i blocchi più grandi vengono divisi
+SHEETS_MAX_REQUEST_BYTES = int(os.getenv("SHEETS_MAX_REQUEST_BYTES", str(2 * 1024 * 1024)))
+OVERFLOW_SPREADSHEET_IDS = [s.strip() for s in os.getenv("OVERFLOW_SPREADSHEET_IDS", "").split(",") if s.strip()]
+SHEETS_INDEX_SHEET = os.getenv("SHEETS_INDEX_SHEET", "Indice")
+# Developer metadata dei fogli dei partner scritti dall'export (valore: sheetId del
+# foglio, così una copia fatta a mano con "Duplica" non risulta dell'export)
+SHARD_METADATA_KEY = "hubspot_export_shard"
+
+# Foglio con le metriche di funnel per partner (dallo storico degli stage)
+FUNNEL_SHEET = os.getenv("FUNNEL_SHEET", "Funnel")
+
+# Timeline degli stage: data di ingresso e tempo in ogni stage della pipeline del
+# partner, in coda alle colonne del foglio (0 = disattivata)
+STAGE_TIMELINE = os.getenv("STAGE_TIMELINE", "1") != "0"
+
+# Partner esportati in parallelo (1 = sequenziale)
+EXPORT_WORKERS = int(os.getenv("EXPORT_WORKERS", "4"))
+
+# Limiti HubSpot private app: 100 richieste / 10 secondi, Search API max 5 richieste/secondo,
+# limite giornaliero dipendente dal piano. Valori prudenti, configurabili da env.
+HUBSPOT_REQUESTS_PER_SECOND = float(os.getenv("HUBSPOT_REQUESTS_PER_SECOND", "9"))
+HUBSPOT_SEARCH_REQUESTS_PER_SECOND = float(os.getenv("HUBSPOT_SEARCH_REQUESTS_PER_SECOND", "4"))
+HUBSPOT_DAILY_LIMIT = int(os.getenv("HUBSPOT_DAILY_LIMIT", "250000"))
+
+# Limiti Search API: filterGroups e filtri totali per richiesta, risultati per pagina e per query
+SEARCH_MAX_FILTER_GROUPS = 5
+SEARCH_MAX_FILTERS = 18
+# Filtri aggiunti a ogni gruppo dopo la suddivisione: intervallo di hs_object_id
+# (GTE + LT, range_filter_groups) e ripartenza keyset (GT, search_steps)
+SEARCH_EXTRA_FILTERS_PER_GROUP = 3
+SEARCH_PAGE_SIZE = 100
+SEARCH_RESULT_LIMIT = 10000
+
+# Partner grandi: lettura in parallelo di intervalli disgiunti di hs_object_id
+FETCH_PARTITION_SIZE = int(os.getenv("FETCH_PARTITION_SIZE", "2000"))   # deal per intervallo
+FETCH_MAX_PARTITIONS = int(os.getenv("FETCH_MAX_PARTITIONS", "8"))
+FETCH_PARTITION_WORKERS = int(os.getenv("FETCH_PARTITION_WORKERS", "4"))
+
+# Modalità --async: connessioni HTTP HubSpot contemporanee
+ASYNC_MAX_CONNECTIONS = int(os.getenv("ASYNC_MAX_CONNECTIONS", "20"))
+
+# Pagine Search API lette in anticipo (modalità stream) mentre si elaborano le precedenti
+FETCH_PREFETCH_PAGES = int(os.getenv("FETCH_PREFETCH_PAGES", "2"))
+
+# Modalità --webhook: ricevitore dei webhook HubSpot (firma v3 con il client secret dell'app)
+HUBSPOT_CLIENT_SECRET = os.getenv("HUBSPOT_CLIENT_SECRET")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/hubspot/webhook")
+# URL pubblico a cui HubSpot invia i webhook (fa parte della firma); vuoto = dagli header
+WEBHOOK_PUBLIC_URL = os.getenv("WEBHOOK_PUBLIC_URL", "")
+# Un lotto parte dopo WEBHOOK_DEBOUNCE_SECONDS senza eventi, al più WEBHOOK_MAX_DELAY_SECONDS dopo il primo
+WEBHOOK_DEBOUNCE_SECONDS = float(os.getenv("WEBHOOK_DEBOUNCE_SECONDS", "5"))
+WEBHOOK_MAX_DELAY_SECONDS = float(os.getenv("WEBHOOK_MAX_DELAY_SECONDS", "30"))
+WEBHOOK_MAX_AGE_MS = 5 * 60 * 1000  # firme più vecchie vengono rifiutate (come da specifica HubSpot)
+HUBSPOT_BATCH_READ_LIMIT = 100      # deal per chiamata batch/read
+
+# Scheduler (--schedule): export completo giornaliero (ora locale HH:MM) e
+# intervallo di default dei sync incrementali per partner
+SCHEDULE_FULL_AT = os.getenv("SCHEDULE_FULL_AT", "05:05")
+SCHEDULE_INCREMENTAL_MINUTES = float(os.getenv("SCHEDULE_INCREMENTAL_MINUTES", "60"))
+# Ritardo casuale (0..N secondi) di ogni run, per non partire tutti allo stesso istante
+SCHEDULE_JITTER_SECONDS = float(os.getenv("SCHEDULE_JITTER_SECONDS", "30"))
+# Attesa prima di ritentare un run fallito o trovato con il lock occupato
+SCHEDULE_RETRY_SECONDS = float(os.getenv("SCHEDULE_RETRY_SECONDS", "300"))
+
 # Pipeline IDs
 PARTNERSHIP_PIPELINE_ID = "1347411134"
 MARKETING_PIPELINE_ID = "75805933"  # Marketing - Inbound automated Micro/Small Pipeline
@@ -63,70 +268,289 @@ ALL_PROPOSAL_SENT_IDS = [p["proposal_sent"] for p in PIPELINES.values()]
 ALL_KYC_IDS = [p["kyc_pending_approval"] for p in PIPELINES.values()]
 ALL_ONBOARDING_IDS = [p["onboarding_completed"] for p in PIPELINES.values()]
 
-# Proprietà HubSpot da recuperare (tutte le combinazioni di stage)
-HUBSPOT_PROPERTIES = [
-    "dealname", "createdate", "amount", "dealstage", "pipeline",
-    "partner_label_name", "ttv_all_time", "instore_category", "offline_annual_revenue",
-    "first_order_ttv", "days_between_create_and_kyc",
-    # Nuove colonne comuni
-    "risk_check_status", "store_type", "category", "onboarding_declined_reason",
-    # Colonne per Attitude
-    "third_party___customer_tier", "third_party___remuneration",
-    "original_agent_source_name", "third_party___fixed_fee", "third_party___products__fee",
-    # Colonne per Deutsche Bank
-    "original_agent_email",
-]
-# Aggiungi proprietà V2 per ogni stage ID di ogni pipeline (V2 ha i dati reali)
-for stage_id in ALL_KYC_IDS:
-    HUBSPOT_PROPERTIES.append(f"hs_v2_date_entered_{stage_id}")
-for stage_id in ALL_ONBOARDING_IDS:
-    HUBSPOT_PROPERTIES.append(f"hs_v2_date_entered_{stage_id}")
-for stage_id in ALL_PROPOSAL_SENT_IDS:
-    HUBSPOT_PROPERTIES.append(f"hs_v2_date_entered_{stage_id}")
-    HUBSPOT_PROPERTIES.append(f"hs_v2_date_exited_{stage_id}")
-    HUBSPOT_PROPERTIES.append(f"hs_v2_cumulative_time_in_{stage_id}")
-
-# Header base (comuni a tutti)
-BASE_HEADERS = [
-    "Deal ID", "Deal name", "Deal Create date", "Deal Amount", "Deal stage",
-    "Partner Name", "Deal TTV All Time", "Deal InStore Category",
-    "Deal Date entered \"KYC Pending Approval\"",
-    "Deal Date entered \"Onboarding Completed\"",
-    "Deal Offline Annual Revenue", "Deal First Order TTV",
-    "Deal Days between Create and KYC (min)",
-    "Deal Date entered \"Proposal sent\"",
-    "Deal Date exited \"Proposal sent\"",
-    "Deal Cumulative time in \"Proposal sent\" (min)",
-    "Giorni in Proposal sent",
+# Proprietà V2 degli stage (prende il primo valore non vuoto tra le pipeline)
+def stage_properties(prefix, stage_ids):
+    return [f"{prefix}{stage_id}" for stage_id in stage_ids]
+
+
+KYC_ENTERED = stage_properties("hs_v2_date_entered_", ALL_KYC_IDS)
+ONBOARDING_ENTERED = stage_properties("hs_v2_date_entered_", ALL_ONBOARDING_IDS)
+PROPOSAL_ENTERED = stage_properties("hs_v2_date_entered_", ALL_PROPOSAL_SENT_IDS)
+PROPOSAL_EXITED = stage_properties("hs_v2_date_exited_", ALL_PROPOSAL_SENT_IDS)
+PROPOSAL_TIME = stage_properties("hs_v2_cumulative_time_in_", ALL_PROPOSAL_SENT_IDS)
+
+# Schema delle colonne esportate, nell'ordine del foglio.
+# - sources: proprietà lette, passate in ordine alla trasformazione; una lista
+#   di proprietà vale il primo valore non vuoto
+# - transform: chiave di COLUMN_TRANSFORMS
+# - format: chiave di NUMBER_FORMATS (opzionale)
+# - partners: partner che hanno la colonna (assente = tutti)
+# - enrichment: dato non del deal ("company" o "owner") aggiunto alle proprietà
+#   da enrich_deals() con il nome indicato in sources
+# Header, righe, formattazione e proprietà richieste a HubSpot derivano da qui.
+COLUMNS = [
+    {"header": "Deal ID", "sources": [], "transform": "id"},
+    {"header": "Deal name", "sources": ["dealname"], "transform": "text"},
+    {"header": "Deal Create date", "sources": ["createdate"], "transform": "date"},
+    {"header": "Deal Amount", "sources": ["amount"], "transform": "euro", "format": "euro"},
+    {"header": "Deal stage", "sources": ["dealstage"], "transform": "stage"},
+    {"header": "Partner Name", "sources": ["partner_label_name"], "transform": "text"},
+    {"header": "Deal TTV All Time", "sources": ["ttv_all_time"], "transform": "euro", "format": "euro"},
+    {"header": "Deal InStore Category", "sources": ["instore_category"], "transform": "label"},
+    {"header": "Deal Date entered \"KYC Pending Approval\"", "sources": [KYC_ENTERED], "transform": "date"},
+    {"header": "Deal Date entered \"Onboarding Completed\"", "sources": [ONBOARDING_ENTERED], "transform": "date"},
+    {"header": "Deal Offline Annual Revenue", "sources": ["offline_annual_revenue"], "transform": "euro", "format": "euro"},
+    {"header": "Deal First Order TTV", "sources": ["first_order_ttv"], "transform": "euro", "format": "euro"},
+    {"header": "Deal Days between Create and KYC (min)", "sources": ["days_between_create_and_kyc"],
+     "transform": "minutes", "format": "minutes"},
+    {"header": "Deal Date entered \"Proposal sent\"", "sources": [PROPOSAL_ENTERED], "transform": "date"},
+    {"header": "Deal Date exited \"Proposal sent\"", "sources": [PROPOSAL_EXITED], "transform": "date"},
+    {"header": "Deal Cumulative time in \"Proposal sent\" (min)", "sources": [PROPOSAL_TIME],
+     "transform": "minutes", "format": "minutes"},
+    {"header": "Giorni in Proposal sent", "sources": [PROPOSAL_ENTERED, PROPOSAL_EXITED, "dealstage"],
+     "transform": "days_in_proposal", "format": "days"},
     # Nuove colonne comuni
-    "Risk Check Status", "Store Type", "Deal Size", "Category", "Onboarding Declined Reason"
+    {"header": "Risk Check Status", "sources": ["risk_check_status"], "transform": "label"},
+    {"header": "Store Type", "sources": ["store_type"], "transform": "label"},
+    {"header": "Deal Size", "sources": ["amount", "store_type"], "transform": "deal_size"},
+    {"header": "Category", "sources": ["category"], "transform": "text"},
+    {"header": "Onboarding Declined Reason", "sources": ["onboarding_declined_reason"], "transform": "text"},
+    # Colonne per partner specifici (l'ordine vale per entrambi i partner)
+    {"header": "Original Agent Email", "sources": ["original_agent_email"], "transform": "text",
+     "partners": ["Deutsche Bank"]},
+    {"header": "Third Party - Customer Tier", "sources": ["third_party___customer_tier"], "transform": "text",
+     "partners": ["Attitude", "Deutsche Bank"]},
+    {"header": "Third Party - Remuneration", "sources": ["third_party___remuneration"], "transform": "text",
+     "partners": ["Attitude"]},
+    {"header": "Original Agent Source Name", "sources": ["original_agent_source_name"], "transform": "text",
+     "partners": ["Attitude"]},
+    {"header": "Third Party - Fixed Fee", "sources": ["third_party___fixed_fee"], "transform": "text",
+     "partners": ["Attitude"]},
+    {"header": "Third Party - Products Fee", "sources": ["third_party___products__fee"], "transform": "text",
+     "partners": ["Attitude", "Deutsche Bank"]},
+    # Arricchimento: azienda associata (primaria) e owner del deal, dopo le colonne
+    # esistenti per non spostarle nei fogli già in uso
+    {"header": "Company Name", "sources": ["company.name"], "transform": "text", "enrichment": "company"},
+    {"header": "Company VAT ID", "sources": ["company.vat_id"], "transform": "text", "enrichment": "company"},
+    {"header": "Company City", "sources": ["company.city"], "transform": "text", "enrichment": "company"},
+    {"header": "Deal Owner", "sources": ["owner.name"], "transform": "text", "enrichment": "owner"},
 ]
 
-# Header aggiuntivi per partner specifici
-ATTITUDE_EXTRA_HEADERS = [
-    "Third Party - Customer Tier", "Third Party - Remuneration",
-    "Original Agent Source Name", "Third Party - Fixed Fee", "Third Party - Products Fee"
-]
+# Formati numerici Google Sheets per le colonne con "format"
+NUMBER_FORMATS = {
+    "euro": '#,##0.00"€"',
+    "minutes": "0.00",
+    "days": '0.00"d"',
+}
+
+# Proprietà sempre richieste: filtri, smistamento per partner e checkpoint incrementale
+REQUIRED_PROPERTIES = ["pipeline", "partner_label_name", "hs_lastmodifieddate"]
+
+# Arricchimento: proprietà del deal da leggere per tipo e proprietà HubSpot
+# dell'azienda per ogni source "company.*"
+ENRICHMENT_DEAL_PROPERTIES = {"company": [], "owner": ["hubspot_owner_id"]}
+COMPANY_PROPERTIES = {
+    "company.name": "name",
+    "company.vat_id": os.getenv("COMPANY_VAT_PROPERTY", "vat_number"),
+    "company.city": "city",
+}
+
+
+def stage_timeline_columns(pipeline_id):
+    """
+    Colonne della timeline per tutti gli stage della pipeline, nell'ordine della
+    pipeline scoperto da load_stage_labels() (nessuna colonna prima del caricamento).
+    Il tempo nello stage è il cumulativo HubSpot, senza il periodo in corso: i
+    valori cambiano solo quando cambia il deal, non a ogni run.
+    """
+    if not STAGE_TIMELINE:
+        return []
+    columns = []
+    for stage_id in PIPELINE_STAGES.get(pipeline_id, []):
+        label = STAGE_LABELS.get(stage_id, stage_id)
+        entered = f"hs_v2_date_entered_{stage_id}"
+        columns.append({"header": f"Date entered \"{label}\"", "sources": [entered], "transform": "date"})
+        columns.append({"header": f"Time in \"{label}\" (min)", "sources": [f"hs_v2_cumulative_time_in_{stage_id}"],
+                        "transform": "minutes", "format": "minutes", "stage": stage_id})
+    return columns
+
+
+def partner_timeline_columns(partner_keywords):
+    """Colonne della timeline delle pipeline dei partner indicati (una volta per pipeline)."""
+    pipelines = dict.fromkeys(
+        PARTNERS[partner_keyword]["pipeline"] or PARTNERSHIP_PIPELINE_ID
+        for partner_keyword in partner_keywords if partner_keyword in PARTNERS
+    )
+    return [column for pipeline_id in pipelines for column in stage_timeline_columns(pipeline_id)]
+
+
+def get_columns_for_partner(partner_keyword):
+    """Colonne dello schema esportate per il partner, nell'ordine del foglio (timeline in coda)."""
+    return [
+        column for column in COLUMNS
+        if "partners" not in column or partner_keyword in column["partners"]
+    ] + partner_timeline_columns([partner_keyword])
 
-DEUTSCHE_BANK_EXTRA_HEADERS = [
-    "Original Agent Email", "Third Party - Customer Tier", "Third Party - Products Fee"
-]
 
 # Funzione per ottenere headers per partner
 def get_headers_for_partner(partner_keyword):
-    headers = BASE_HEADERS.copy()
-    if partner_keyword == "Attitude":
-        headers.extend(ATTITUDE_EXTRA_HEADERS)
-    elif partner_keyword == "Deutsche Bank":
-        headers.extend(DEUTSCHE_BANK_EXTRA_HEADERS)
-    return headers
-
-# Labels globali
+    return [column["header"] for column in get_columns_for_partner(partner_keyword)]
+
+
+def get_properties_for_partners(partner_keywords):
+    """
+    Proprietà HubSpot minime per le colonne dei partner indicati
+    (unione, senza duplicati, in ordine di schema), timeline degli stage compresa.
+    """
+    properties = list(REQUIRED_PROPERTIES)
+    for column in COLUMNS + partner_timeline_columns(partner_keywords):
+        if "partners" in column and not any(k in column["partners"] for k in partner_keywords):
+            continue
+        if "enrichment" in column:
+            # Le sources sono i campi aggiunti da enrich_deals(), non proprietà del deal
+            properties.extend(name for name in ENRICHMENT_DEAL_PROPERTIES[column["enrichment"]]
+                              if name not in properties)
+            continue
+        for source in column["sources"]:
+            for name in (source if isinstance(source, list) else [source]):
+                if name not in properties:
+                    properties.append(name)
+    return properties
+
+
+def hubspot_properties():
+    """
+    Proprietà HubSpot di tutte le colonne (default della Search API). Dipende
+    dagli stage caricati, quindi va calcolata dopo load_stage_labels().
+    """
+    return get_properties_for_partners(list(PARTNERS))
+
+# Proprietà enumerate esportate con la label al posto del valore interno
+LABEL_PROPERTIES = [column["sources"][0] for column in COLUMNS if column["transform"] == "label"]
+
+# Labels globali (sostituite a ogni run da load_stage_labels/load_property_labels)
 STAGE_LABELS = {}
-INSTORE_CATEGORY_LABELS = {}
+PIPELINE_STAGES = {}  # pipeline -> [stage ID nell'ordine della pipeline]
+PROPERTY_LABELS = {}  # proprietà -> {valore: label}
+
+# Cache label in memoria (specchio di LABEL_CACHE_FILE) e refresh in background
+_label_cache = None
+_label_cache_lock = threading.Lock()
+_label_refresh_threads = {}
+
+
+class RateLimiter:
+    """
+    Token bucket thread-safe condiviso da tutti i worker: al massimo `rate`
+    richieste al secondo (con burst fino a `burst`) e `daily_limit` al giorno.
+    """
+
+    def __init__(self, rate, burst=None, daily_limit=None):
+        self.rate = rate
+        self.capacity = burst or max(1, int(rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.daily_limit = daily_limit
+        self.day = None
+        self.day_count = 0
+        self.lock = threading.Lock()
+
+    def try_acquire(self):
+        """Prende un token se disponibile. Ritorna 0 o i secondi da attendere prima di riprovare."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                self._count_daily()
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        """Attende un token libero; solleva RuntimeError oltre il limite giornaliero."""
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        """Come acquire(), ma attende senza bloccare l'event loop."""
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    def _count_daily(self):
+        if not self.daily_limit:
+            return
+        today = datetime.now(timezone.utc).date()
+        if today != self.day:
+            self.day = today
+            self.day_count = 0
+        if self.day_count >= self.daily_limit:
+            raise RuntimeError(f"Limite giornaliero HubSpot raggiunto ({self.daily_limit} richieste)")
+        self.day_count += 1
+
 
+# Limiter condivisi: tutte le chiamate HubSpot passano da HUBSPOT_RATE_LIMITER,
+# le Search API anche da SEARCH_RATE_LIMITER
+HUBSPOT_RATE_LIMITER = RateLimiter(HUBSPOT_REQUESTS_PER_SECOND, daily_limit=HUBSPOT_DAILY_LIMIT)
+SEARCH_RATE_LIMITER = RateLimiter(HUBSPOT_SEARCH_REQUESTS_PER_SECOND)
 
-def get_google_sheets_service():
+# Partner in lavorazione (per i log): per thread e per task asyncio
+_current_partner = contextvars.ContextVar("partner", default=None)
+PRINT_LOCK = threading.Lock()
+
+
+# Sessione HTTP condivisa (keep-alive) e statistiche per endpoint
+_hubspot_session = None
+_hubspot_session_lock = threading.Lock()
+# Servizi Sheets condivisi dai run dello stesso processo (--schedule, --webhook)
+_sheets_services = {}
+_sheets_service_lock = threading.Lock()
+ENDPOINT_STATS = {}
+ENDPOINT_STATS_LOCK = threading.Lock()
+
+
+def log(message):
+    """print con flush; dentro l'export di un partner antepone il nome del partner."""
+    partner_keyword = _current_partner.get()
+    if partner_keyword:
+        message = f"    [{partner_keyword}] {message.strip()}"
+    with PRINT_LOCK:
+        print(message, flush=True)
+
+
+@contextmanager
+def partner_context(partner_keyword):
+    """Associa il thread (o task asyncio) corrente al partner per i messaggi di log."""
+    token = _current_partner.set(partner_keyword)
+    try:
+        yield
+    finally:
+        _current_partner.reset(token)
+
+
+def get_google_sheets_service(name="main"):
+    """
+    Servizio Google Sheets del processo, creato al primo uso: i run successivi
+    riusano discovery, credenziali (rinnovate alla scadenza) e connessioni.
+    Il client non è thread-safe: chi scrive in parallelo (le destinazioni
+    aggiuntive) usa un nome proprio e quindi un servizio separato.
+    """
+    with _sheets_service_lock:
+        if name not in _sheets_services:
+            _sheets_services[name] = build_sheets_service()
+        return _sheets_services[name]
+
+
+def build_sheets_service():
+    if SHEETS_API_ENDPOINT:
+        return build("sheets", "v4", credentials=AnonymousCredentials(),
+                     client_options={"api_endpoint": SHEETS_API_ENDPOINT})
     script_dir = os.path.dirname(os.path.abspath(__file__))
     token_path = os.path.join(script_dir, "token.json")
     creds = Credentials.from_authorized_user_file(token_path, SCOPES)
@@ -135,501 +559,3892 @@ def get_google_sheets_service():
     return build("sheets", "v4", credentials=creds)
 
 
-def load_stage_labels():
-    """Carica le label degli stage delle pipeline."""
-    global STAGE_LABELS
-    url = "https://api.hubapi.com/crm/v3/pipelines/deals"
-    response = requests.get(url, headers=HUBSPOT_HEADERS)
-    for pipeline in response.json().get("results", []):
-        for stage in pipeline.get("stages", []):
-            STAGE_LABELS[stage["id"]] = stage["label"]
-
-
-def load_instore_category_labels():
-    """Carica le label per instore_category da HubSpot."""
-    global INSTORE_CATEGORY_LABELS
-    url = "https://api.hubapi.com/crm/v3/properties/deals/instore_category"
-    response = requests.get(url, headers=HUBSPOT_HEADERS)
-    data = response.json()
-    for opt in data.get("options", []):
-        INSTORE_CATEGORY_LABELS[opt["value"]] = opt["label"]
-
-
-def get_deals_for_partner(pipeline_id, partner_keyword):
-    """Recupera deal per un partner specifico usando Search API con filtri combinati."""
-    if pipeline_id is None:
-        pipeline_id = PARTNERSHIP_PIPELINE_ID
-
-    url = "https://api.hubapi.com/crm/v3/objects/deals/search"
-    all_deals = []
-    after = None
+def get_hubspot_session():
+    """Sessione requests condivisa con pool di connessioni keep-alive verso HubSpot."""
+    global _hubspot_session
+    with _hubspot_session_lock:
+        if _hubspot_session is None:
+            session = requests.Session()
+            # Una connessione per ogni intervallo letto in parallelo da ogni partner, più
+            # margine per label e arricchimento: oltre pool_maxsize urllib3 chiude le connessioni
+            pool_size = max(1, EXPORT_WORKERS) * max(1, FETCH_PARTITION_WORKERS) + 4
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(10, pool_size))
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers.update(HUBSPOT_HEADERS)
+            _hubspot_session = session
+        return _hubspot_session
 
-    while True:
-        # Usa Search API con filtro per pipeline E partner_label_name
-        filters = [{
-            "propertyName": "pipeline",
-            "operator": "EQ",
-            "value": pipeline_id
-        }]
-
-        # Aggiungi filtro per partner_label_name usando CONTAINS_TOKEN
-        if partner_keyword:
-            filters.append({
-                "propertyName": "partner_label_name",
-                "operator": "CONTAINS_TOKEN",
-                "value": f"{partner_keyword.lower()}*"
-            })
 
-        payload = {
-            "filterGroups": [{
-                "filters": filters
-            }],
-            "properties": HUBSPOT_PROPERTIES,
-            "limit": 100
-        }
+def record_endpoint_call(endpoint, elapsed, retried=False, failed=False, bytes_sent=0, bytes_received=0):
+    """Aggiorna contatori, byte e latenza (ms) di un endpoint HubSpot o Sheets."""
+    with ENDPOINT_STATS_LOCK:
+        stats = ENDPOINT_STATS.setdefault(endpoint, {
+            "requests": 0, "retries": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0,
+            "bytes_sent": 0, "bytes_received": 0
+        })
+        stats["requests"] += 1
+        stats["retries"] += int(retried)
+        stats["errors"] += int(failed)
+        stats["total_ms"] += elapsed * 1000
+        stats["max_ms"] = max(stats["max_ms"], elapsed * 1000)
+        stats["bytes_sent"] += bytes_sent
+        stats["bytes_received"] += bytes_received
 
-        # Aggiungi after solo se presente (non nella prima richiesta)
-        if after:
-            payload["after"] = after
 
-        response = requests.post(url, headers=HUBSPOT_HEADERS, json=payload)
-        data = response.json()
+def get_retry_delay(response, attempt):
+    """Attesa prima del prossimo tentativo: Retry-After se presente, altrimenti backoff esponenziale con jitter."""
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if retry_after:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            try:
+                return max(0.0, (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds())
+            except (TypeError, ValueError):
+                pass
+    delay = min(HUBSPOT_BACKOFF_MAX, HUBSPOT_BACKOFF_BASE * 2 ** attempt)
+    return random.uniform(delay / 2, delay)
 
-        results = data.get("results", [])
-        all_deals.extend(results)
 
-        # Paging per Search API
-        paging = data.get("paging", {})
-        next_page = paging.get("next", {})
-        after = next_page.get("after")
+def hubspot_request(method, path, json_body=None, params=None, search=False):
+    """
+    Esegue una chiamata HubSpot con la sessione condivisa e ritorna il JSON.
+    Passa dai rate limiter, ritenta 429/5xx ed errori di rete con backoff
+    (rispettando Retry-After) e solleva requests.HTTPError per le altre
+    risposte di errore, così una pagina fallita non tronca l'export.
+    """
+    url = f"{HUBSPOT_API_BASE}{path}"
+    endpoint = f"{method} {path}"
+    session = get_hubspot_session()
 
-        if not after or len(results) == 0:
-            break
+    for attempt in range(HUBSPOT_MAX_RETRIES + 1):
+        if search:
+            SEARCH_RATE_LIMITER.acquire()
+        HUBSPOT_RATE_LIMITER.acquire()
 
-        print(f"    Recuperati {len(all_deals)} deal...", flush=True)
+        response = None
+        error = None
+        start = time.monotonic()
+        try:
+            response = session.request(
+                method, url, json=json_body, params=params, timeout=HUBSPOT_TIMEOUT
+            )
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error = e
+        elapsed = time.monotonic() - start
 
-    return all_deals
+        sent = len(response.request.body or b"") if response is not None else 0
+        received = len(response.content) if response is not None else 0
+        if response is not None and response.status_code < 400:
+            record_endpoint_call(endpoint, elapsed, retried=attempt > 0, bytes_sent=sent, bytes_received=received)
+            return response.json()
 
+        record_endpoint_call(endpoint, elapsed, retried=attempt > 0, failed=True,
+                             bytes_sent=sent, bytes_received=received)
+        retryable = response is None or response.status_code in HUBSPOT_RETRY_STATUS
+        if not retryable or attempt == HUBSPOT_MAX_RETRIES:
+            if error is not None:
+                raise error
+            raise requests.HTTPError(
+                f"HubSpot {response.status_code} su {endpoint}: {response.text[:500]}",
+                response=response
+            )
 
-def parse_date(date_string):
-    """Parse una stringa data e ritorna oggetto datetime o None."""
-    if not date_string:
-        return None
-    try:
-        return datetime.fromisoformat(date_string.replace("Z", "+00:00"))
-    except:
-        return None
+        delay = get_retry_delay(response, attempt)
+        reason = error if error is not None else f"HTTP {response.status_code}"
+        log(f"    HubSpot {reason} su {path}, nuovo tentativo tra {delay:.1f}s "
+            f"({attempt + 1}/{HUBSPOT_MAX_RETRIES})")
+        time.sleep(delay)
 
 
-def format_date(date_string):
-    """Formatta data come stringa YYYY-MM-DD HH:MM:SS."""
-    if not date_string:
-        return ""
-    try:
-        dt = datetime.fromisoformat(date_string.replace("Z", "+00:00"))
-        return dt.strftime("%Y-%m-%d %H:%M:%S")
-    except:
-        return date_string
+_hubspot_async_client = contextvars.ContextVar("hubspot_async_client", default=None)
 
 
-def format_euro(value):
-    """Converte valore in numero per formato Euro."""
-    if not value:
-        return ""
-    try:
-        return float(str(value).replace(",", ".").replace(" ", ""))
-    except:
-        return value
+def get_hubspot_async_client():
+    """Client httpx asincrono del run --async in corso (None fuori da run_export_async)."""
+    return _hubspot_async_client.get()
 
 
-def classify_deal_size(value, store_type="", partner=""):
-    """Classifica il deal in base all'amount. Per SmallPay/PostePay con Physical store, usa amount/0.05."""
-    if not value:
-        return ""
-    try:
-        amount = float(str(value).replace(",", ".").replace(" ", ""))
-        # Solo per SmallPay e PostePay: se Physical store, usa amount/0.05
-        partner_lower = partner.lower() if partner else ""
-        if partner_lower in ["smallpay", "postepay"]:
-            if store_type and "physical store" in store_type.lower():
-                amount = amount / 0.05
-        if amount < 50000:
-            return "0 - 50.000 €"
-        elif amount < 100000:
-            return "50.000 € - 100.000 €"
-        elif amount < 300000:
-            return "100.000 € - 300.000 €"
-        elif amount < 500000:
-            return "300.000 € - 500.000 €"
-        elif amount < 1000000:
-            return "500.000 € - 1M €"
-        elif amount < 5000000:
-            return "1M € - 5M €"
-        elif amount < 10000000:
-            return "5M € - 10M €"
-        else:
-            return "Oltre 10M €"
-    except:
-        return ""
+async def hubspot_request_async(method, path, json_body=None, params=None, search=False):
+    """
+    Versione asincrona di hubspot_request() sul client httpx del run --async:
+    stessi rate limiter, retry, backoff e statistiche per endpoint.
+    """
+    url = f"{HUBSPOT_API_BASE}{path}"
+    endpoint = f"{method} {path}"
+    client = get_hubspot_async_client()
 
+    for attempt in range(HUBSPOT_MAX_RETRIES + 1):
+        if search:
+            await SEARCH_RATE_LIMITER.acquire_async()
+        await HUBSPOT_RATE_LIMITER.acquire_async()
 
-def format_ms_to_minutes(ms_string):
-    """Converte millisecondi in minuti."""
-    if not ms_string:
-        return ""
-    try:
-        ms = float(str(ms_string).replace(",", ".").replace(" ", ""))
-        return round(ms / 1000 / 60, 2)
-    except:
-        return ms_string
+        response = None
+        error = None
+        start = time.monotonic()
+        try:
+            response = await client.request(method, url, json=json_body, params=params)
+        except httpx.TransportError as e:
+            error = e
+        elapsed = time.monotonic() - start
 
+        sent = len(response.request.content) if response is not None else 0
+        received = len(response.content) if response is not None else 0
+        if response is not None and response.status_code < 400:
+            record_endpoint_call(endpoint, elapsed, retried=attempt > 0, bytes_sent=sent, bytes_received=received)
+            return response.json()
 
-def calculate_days_in_proposal(date_entered, date_exited, stage_label):
-    """
-    Calcola giorni in Proposal sent:
-    - Se date_entered e date_exited presenti: diff in giorni
-    - Se solo date_entered e stage = "Proposal sent": giorni da entered a ora
-    - Altrimenti: vuoto
-    """
-    entered_dt = parse_date(date_entered)
-    exited_dt = parse_date(date_exited)
+        record_endpoint_call(endpoint, elapsed, retried=attempt > 0, failed=True,
+                             bytes_sent=sent, bytes_received=received)
+        retryable = response is None or response.status_code in HUBSPOT_RETRY_STATUS
+        if not retryable or attempt == HUBSPOT_MAX_RETRIES:
+            if error is not None:
+                raise error
+            raise requests.HTTPError(
+                f"HubSpot {response.status_code} su {endpoint}: {response.text[:500]}",
+                response=response
+            )
 
-    if not entered_dt:
-        return ""
+        delay = get_retry_delay(response, attempt)
+        reason = error if error is not None else f"HTTP {response.status_code}"
+        log(f"    HubSpot {reason} su {path}, nuovo tentativo tra {delay:.1f}s "
+            f"({attempt + 1}/{HUBSPOT_MAX_RETRIES})")
+        await asyncio.sleep(delay)
 
-    # Se abbiamo entrambe le date, calcoliamo la differenza in giorni
-    if exited_dt:
-        diff_days = (exited_dt - entered_dt).total_seconds() / 3600 / 24
-        return round(diff_days, 2)
 
-    # Se stage è "Proposal sent" (o simile), calcola da entered a ora
-    if stage_label and "proposal sent" in stage_label.lower():
-        now = datetime.now(entered_dt.tzinfo) if entered_dt.tzinfo else datetime.now()
-        diff_days = (now - entered_dt).total_seconds() / 3600 / 24
-        return round(diff_days, 2)
+def print_endpoint_stats():
+    """Stampa richieste, retry, byte e latenza media/massima per endpoint HubSpot e Sheets."""
+    with ENDPOINT_STATS_LOCK:
+        items = sorted(ENDPOINT_STATS.items())
+    if not items:
+        return
+    print("\nChiamate API per endpoint:", flush=True)
+    for endpoint, stats in items:
+        avg_ms = stats["total_ms"] / stats["requests"]
+        kilobytes = (stats["bytes_sent"] + stats["bytes_received"]) / 1024
+        print(f"  {endpoint}: {stats['requests']} richieste, {stats['retries']} retry, "
+              f"{stats['errors']} errori, media {avg_ms:.0f} ms, max {stats['max_ms']:.0f} ms, "
+              f"{kilobytes:.0f} KB", flush=True)
 
-    return ""
 
+# Telemetria del run in corso: tempi per fase e contatori, del run e per
+# partner (azzerata da start_run_stats, scritta da save_run_report)
+RUN_STATS = {}
+RUN_STATS_LOCK = threading.Lock()
+METRICS_PREFIX = "hubspot_export"
 
-def get_first_value(props, stage_ids, prefix="hs_v2_date_entered_"):
-    """Ritorna il primo valore non vuoto tra gli stage IDs (usa proprietà V2)."""
-    for stage_id in stage_ids:
-        value = props.get(f"{prefix}{stage_id}", "")
-        if value:
-            return value
-    return ""
 
+def start_run_stats(**options):
+    """Azzera la telemetria per un nuovo run con le opzioni indicate."""
+    with RUN_STATS_LOCK:
+        RUN_STATS.clear()
+        RUN_STATS.update({
+            "options": dict(options, write_mode=SHEETS_WRITE_MODE),
+            "started_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "start": time.monotonic(),
+            "phases": {},
+            "counters": {},
+            "partners": {},
+        })
 
-def process_deals(deals, partner_keyword=""):
-    """Processa i deal e ritorna righe formattate."""
-    rows = []
-    for deal in deals:
-        props = deal.get("properties", {})
-        stage_id = props.get("dealstage", "")
-        stage_label = STAGE_LABELS.get(stage_id, stage_id)
-
-        # Cerca valori in tutte le pipeline (prende il primo non vuoto) - usa proprietà V2
-        date_entered_kyc = get_first_value(props, ALL_KYC_IDS, "hs_v2_date_entered_")
-        date_entered_onboarding = get_first_value(props, ALL_ONBOARDING_IDS, "hs_v2_date_entered_")
-        date_entered_proposal = get_first_value(props, ALL_PROPOSAL_SENT_IDS, "hs_v2_date_entered_")
-        date_exited_proposal = get_first_value(props, ALL_PROPOSAL_SENT_IDS, "hs_v2_date_exited_")
-        time_in_proposal = get_first_value(props, ALL_PROPOSAL_SENT_IDS, "hs_v2_cumulative_time_in_")
-
-        # Calcola giorni in proposal
-        days_in_proposal = calculate_days_in_proposal(
-            date_entered_proposal,
-            date_exited_proposal,
-            stage_label
-        )
 
-        # InStore category con label
-        instore_value = props.get("instore_category", "")
-        instore_label = INSTORE_CATEGORY_LABELS.get(instore_value, instore_value)
-
-        # Riga base (comuni a tutti)
-        row = [
-            deal.get("id", ""),
-            props.get("dealname", ""),
-            format_date(props.get("createdate", "")),
-            format_euro(props.get("amount", "")),                    # D: Euro
-            stage_label,                                              # E: Stage
-            props.get("partner_label_name", ""),
-            format_euro(props.get("ttv_all_time", "")),              # G: Euro
-            instore_label,                                            # H: Label
-            format_date(date_entered_kyc),                            # I: KYC
-            format_date(date_entered_onboarding),                     # J: Onboarding
-            format_euro(props.get("offline_annual_revenue", "")),
-            format_euro(props.get("first_order_ttv", "")),
-            format_ms_to_minutes(props.get("days_between_create_and_kyc", "")),  # M: Minuti
-            format_date(date_entered_proposal),                       # N: Date entered
-            format_date(date_exited_proposal),                        # O: Date exited
-            format_ms_to_minutes(time_in_proposal),                   # P: Minuti
-            days_in_proposal,                                         # Q: Giorni calcolati
-            # Nuove colonne comuni
-            props.get("risk_check_status", ""),
-            props.get("store_type", ""),
-            classify_deal_size(props.get("amount", ""), props.get("store_type", ""), partner_keyword),  # Deal Size
-            props.get("category", ""),  # Category
-            props.get("onboarding_declined_reason", "")  # Onboarding Declined Reason
-        ]
+def run_stats_section():
+    """Sezione della telemetria del partner corrente (o del run fuori da un partner)."""
+    partner_keyword = _current_partner.get()
+    if not partner_keyword:
+        return RUN_STATS
+    return RUN_STATS.setdefault("partners", {}).setdefault(partner_keyword, {})
 
-        # Colonne aggiuntive per Attitude
-        if partner_keyword == "Attitude":
-            row.extend([
-                props.get("third_party___customer_tier", ""),
-                props.get("third_party___remuneration", ""),
-                props.get("original_agent_source_name", ""),
-                props.get("third_party___fixed_fee", ""),
-                props.get("third_party___products__fee", "")
-            ])
-        # Colonne aggiuntive per Deutsche Bank
-        elif partner_keyword == "Deutsche Bank":
-            row.extend([
-                props.get("original_agent_email", ""),
-                props.get("third_party___customer_tier", ""),
-                props.get("third_party___products__fee", "")
-            ])
 
-        rows.append(row)
-    return rows
+def record_phase(name, seconds):
+    """Somma la durata di una fase a quelle del partner corrente (o del run)."""
+    with RUN_STATS_LOCK:
+        phases = run_stats_section().setdefault("phases", {})
+        phases[name] = phases.get(name, 0.0) + seconds
 
 
-def ensure_sheet_exists(service, sheet_name):
-    """Crea il foglio se non esiste."""
-    try:
-        spreadsheet = service.spreadsheets().get(spreadsheetId=GOOGLE_SHEET_ID).execute()
-        existing_sheets = [s["properties"]["title"] for s in spreadsheet.get("sheets", [])]
-        if sheet_name not in existing_sheets:
-            request = {
-                "requests": [{
-                    "addSheet": {
-                        "properties": {"title": sheet_name}
-                    }
-                }]
-            }
-            service.spreadsheets().batchUpdate(
-                spreadsheetId=GOOGLE_SHEET_ID,
-                body=request
-            ).execute()
-            print(f"    Creato foglio '{sheet_name}'", flush=True)
-    except Exception as e:
-        print(f"    Errore creazione foglio: {e}", flush=True)
+def count_stat(name, value=1):
+    """Incrementa un contatore del partner corrente (o del run)."""
+    with RUN_STATS_LOCK:
+        counters = run_stats_section().setdefault("counters", {})
+        counters[name] = counters.get(name, 0) + value
 
 
-def clear_sheet(service, sheet_name):
-    """Pulisce il contenuto del foglio."""
+@contextmanager
+def timed_phase(name):
+    """Misura la durata del blocco come fase del partner corrente (o del run)."""
+    start = time.monotonic()
     try:
-        service.spreadsheets().values().clear(
-            spreadsheetId=GOOGLE_SHEET_ID,
-            range=f"'{sheet_name}'!A:Z"
-        ).execute()
-    except:
-        pass
+        yield
+    finally:
+        record_phase(name, time.monotonic() - start)
 
 
-def get_sheet_id(service, sheet_name):
-    """Ottiene l'ID del foglio dal nome."""
-    spreadsheet = service.spreadsheets().get(spreadsheetId=GOOGLE_SHEET_ID).execute()
-    for sheet in spreadsheet.get("sheets", []):
-        if sheet["properties"]["title"] == sheet_name:
-            return sheet["properties"]["sheetId"]
-    return None
+def print_phase_timings():
+    """Stampa la durata delle fasi del run e di quelle di ogni partner."""
+    with RUN_STATS_LOCK:
+        sections = [("Run", RUN_STATS.get("phases", {}))] + [
+            (partner_keyword, section.get("phases", {}))
+            for partner_keyword, section in RUN_STATS.get("partners", {}).items()
+        ]
+        sections = [(name, dict(phases)) for name, phases in sections if phases]
+    if not sections:
+        return
+    print("\nTempi per fase:", flush=True)
+    for name, phases in sections:
+        timings = ", ".join(f"{phase} {seconds:.1f}s" for phase, seconds in phases.items())
+        print(f"  {name}: {timings}", flush=True)
 
 
-def format_sheet(service, sheet_name, num_rows):
-    """Applica formattazione Euro e numero alle colonne."""
-    sheet_id = get_sheet_id(service, sheet_name)
-    if not sheet_id:
-        return
+def peak_rss_bytes():
+    """Picco di memoria residente del processo in byte (None se non misurabile)."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss è in KB su Linux, in byte su macOS
+    return peak if sys.platform == "darwin" else peak * 1024
 
-    requests_list = []
 
-    # Colonne Euro: D (index 3), G (index 6), K (index 10), L (index 11)
-    euro_columns = [3, 6, 10, 11]
-    for col_idx in euro_columns:
-        requests_list.append({
-            "repeatCell": {
-                "range": {
-                    "sheetId": sheet_id,
-                    "startRowIndex": 1,
-                    "endRowIndex": num_rows + 1,
-                    "startColumnIndex": col_idx,
-                    "endColumnIndex": col_idx + 1
-                },
-                "cell": {
-                    "userEnteredFormat": {
-                        "numberFormat": {
-                            "type": "NUMBER",
-                            "pattern": '#,##0.00"€"'
-                        }
-                    }
-                },
-                "fields": "userEnteredFormat.numberFormat"
+def build_run_report(status, error=None):
+    """Report del run: opzioni, esito, tempi, contatori, chiamate API e memoria."""
+    with RUN_STATS_LOCK:
+        stats = json.loads(json.dumps({k: v for k, v in RUN_STATS.items() if k != "start"}))
+        duration = time.monotonic() - RUN_STATS.get("start", time.monotonic())
+    with ENDPOINT_STATS_LOCK:
+        endpoints = {
+            endpoint: {
+                "requests": s["requests"], "retries": s["retries"], "errors": s["errors"],
+                "bytes_sent": s["bytes_sent"], "bytes_received": s["bytes_received"],
+                "avg_ms": round(s["total_ms"] / s["requests"], 1), "max_ms": round(s["max_ms"], 1),
             }
-        })
-
-    # Colonna minuti M (index 12) - Days between Create and KYC
-    requests_list.append({
-        "repeatCell": {
-            "range": {
-                "sheetId": sheet_id,
-                "startRowIndex": 1,
-                "endRowIndex": num_rows + 1,
-                "startColumnIndex": 12,
-                "endColumnIndex": 13
-            },
-            "cell": {
-                "userEnteredFormat": {
-                    "numberFormat": {
-                        "type": "NUMBER",
-                        "pattern": "0.00"
-                    }
-                }
-            },
-            "fields": "userEnteredFormat.numberFormat"
+            for endpoint, s in sorted(ENDPOINT_STATS.items())
         }
-    })
 
-    # Colonna minuti P (index 15) - Cumulative time in Proposal sent
-    requests_list.append({
-        "repeatCell": {
-            "range": {
-                "sheetId": sheet_id,
-                "startRowIndex": 1,
-                "endRowIndex": num_rows + 1,
-                "startColumnIndex": 15,
-                "endColumnIndex": 16
-            },
-            "cell": {
-                "userEnteredFormat": {
-                    "numberFormat": {
-                        "type": "NUMBER",
-                        "pattern": "0.00"
-                    }
-                }
-            },
-            "fields": "userEnteredFormat.numberFormat"
-        }
-    })
+    def rounded(phases):
+        return {name: round(seconds, 3) for name, seconds in phases.items()}
 
-    # Colonna giorni Q (index 16) - Giorni in Proposal sent
-    requests_list.append({
-        "repeatCell": {
-            "range": {
-                "sheetId": sheet_id,
-                "startRowIndex": 1,
-                "endRowIndex": num_rows + 1,
-                "startColumnIndex": 16,
-                "endColumnIndex": 17
-            },
-            "cell": {
-                "userEnteredFormat": {
-                    "numberFormat": {
-                        "type": "NUMBER",
-                        "pattern": '0.00"d"'
-                    }
-                }
-            },
-            "fields": "userEnteredFormat.numberFormat"
-        }
-    })
+    report = {
+        "status": status,
+        "started_at": stats.get("started_at"),
+        "finished_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "duration_seconds": round(duration, 3),
+        "options": stats.get("options", {}),
+        "peak_rss_bytes": peak_rss_bytes(),
+        "phases": rounded(stats.get("phases", {})),
+        "counters": stats.get("counters", {}),
+        "partners": {
+            partner_keyword: {"phases": rounded(section.get("phases", {})),
+                              "counters": section.get("counters", {})}
+            for partner_keyword, section in stats.get("partners", {}).items()
+        },
+        "endpoints": endpoints,
+    }
+    if error is not None:
+        report["error"] = f"{type(error).__name__}: {error}"
+    return report
 
-    if requests_list:
-        service.spreadsheets().batchUpdate(
-            spreadsheetId=GOOGLE_SHEET_ID,
-            body={"requests": requests_list}
-        ).execute()
 
+def endpoint_api(endpoint):
+    """API di un endpoint delle statistiche: "sheets" o "hubspot"."""
+    return "sheets" if endpoint.startswith("sheets ") else "hubspot"
 
-def write_to_sheets(service, rows, sheet_name, partner_keyword):
-    headers = get_headers_for_partner(partner_keyword)
-    data = [headers] + rows
-    result = service.spreadsheets().values().update(
-        spreadsheetId=GOOGLE_SHEET_ID,
-        range=f"'{sheet_name}'!A1",
-        valueInputOption="RAW",
-        body={"values": data}
-    ).execute()
-    return result
 
+def prometheus_label(value):
+    """Valore di una label Prometheus con l'escape di backslash, virgolette e a capo."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
 
-def run_export():
-    """Esegue l'export completo."""
-    print("=" * 50, flush=True)
-    print(f"HubSpot to Google Sheets - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", flush=True)
-    print("=" * 50, flush=True)
 
-    print("\n[1/3] Caricamento stage...", flush=True)
-    load_stage_labels()
-    print(f"  {len(STAGE_LABELS)} stage caricati", flush=True)
+def format_prometheus_metrics(report):
+    """Metriche del report nel formato testuale di Prometheus (tutte gauge: valori dell'ultimo run)."""
+    lines = []
 
-    print("\n[2/3] Caricamento categorie InStore...", flush=True)
-    load_instore_category_labels()
-    print(f"  {len(INSTORE_CATEGORY_LABELS)} categorie caricate", flush=True)
+    def metric(name, help_text, samples):
+        samples = [(labels, value) for labels, value in samples if value is not None]
+        if not samples:
+            return
+        lines.append(f"# HELP {METRICS_PREFIX}_{name} {help_text}")
+        lines.append(f"# TYPE {METRICS_PREFIX}_{name} gauge")
+        for labels, value in samples:
+            label_text = ",".join(f'{key}="{prometheus_label(val)}"' for key, val in labels.items())
+            lines.append(f"{METRICS_PREFIX}_{name}{{{label_text}}} {value}" if label_text
+                         else f"{METRICS_PREFIX}_{name} {value}")
 
-    print("\n[3/3] Connessione a Google Sheets...", flush=True)
-    service = get_google_sheets_service()
-    print("  Connesso!", flush=True)
+    finished = datetime.fromisoformat(report["finished_at"]).timestamp()
+    metric("last_run_success", "1 se l'ultimo run è terminato senza errori",
+           [({}, int(report["status"] == "ok"))])
+    metric("last_run_timestamp_seconds", "Fine dell'ultimo run (epoch)", [({}, int(finished))])
+    metric("run_duration_seconds", "Durata dell'ultimo run", [({}, report["duration_seconds"])])
+    metric("peak_rss_bytes", "Picco di memoria residente del processo", [({}, report["peak_rss_bytes"])])
+    metric("phase_duration_seconds", "Durata delle fasi del run",
+           [({"phase": name}, seconds) for name, seconds in report["phases"].items()])
+    for name, value in report["counters"].items():
+        metric(name, f"Contatore del run: {name}", [({}, value)])
 
-    print("\nExport per partner...", flush=True)
-    total_cells = 0
-    for partner_keyword, config in PARTNERS.items():
-        sheet_name = config["sheet"]
-        pipeline_id = config["pipeline"] or PARTNERSHIP_PIPELINE_ID
+    partners = report["partners"]
+    metric("partner_phase_duration_seconds", "Durata delle fasi per partner", [
+        ({"partner": partner_keyword, "phase": name}, seconds)
+        for partner_keyword, section in partners.items()
+        for name, seconds in section["phases"].items()
+    ])
+    counter_names = sorted({name for section in partners.values() for name in section["counters"]})
+    for name in counter_names:
+        metric(f"partner_{name}", f"Contatore per partner: {name}", [
+            ({"partner": partner_keyword}, section["counters"][name])
+            for partner_keyword, section in partners.items() if name in section["counters"]
+        ])
 
-        print(f"\n  [{partner_keyword}]", flush=True)
-        print(f"    Pipeline: {pipeline_id}", flush=True)
+    endpoints = report["endpoints"]
+    for key, help_text in [
+        ("requests", "Richieste API per endpoint"),
+        ("retries", "Richieste API ritentate per endpoint"),
+        ("errors", "Risposte di errore per endpoint"),
+        ("bytes_sent", "Byte inviati per endpoint"),
+        ("bytes_received", "Byte ricevuti per endpoint"),
+    ]:
+        metric(f"api_{key}", help_text, [
+            ({"api": endpoint_api(endpoint), "endpoint": endpoint}, s[key])
+            for endpoint, s in endpoints.items()
+        ])
+    metric("api_latency_max_seconds", "Latenza massima per endpoint", [
+        ({"api": endpoint_api(endpoint), "endpoint": endpoint},
+         round(s["max_ms"] / 1000, 4))
+        for endpoint, s in endpoints.items()
+    ])
+    return "\n".join(lines) + "\n"
 
-        # Recupera deal direttamente con filtro API per pipeline e partner
-        partner_deals = get_deals_for_partner(pipeline_id, partner_keyword)
-        print(f"    {len(partner_deals)} deal trovati", flush=True)
 
-        if len(partner_deals) == 0:
-            print(f"    Nessun deal per {partner_keyword}, skip.", flush=True)
-            continue
+def write_file_atomic(path, text):
+    """Scrive il file tramite un file temporaneo: chi lo legge non vede mai un file a metà."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
 
-        # Processa i deal con colonne specifiche per partner
-        rows = process_deals(partner_deals, partner_keyword)
 
-        # Crea foglio se non esiste
-        ensure_sheet_exists(service, sheet_name)
+def save_run_report(status, error=None):
+    """Scrive report JSON e metriche Prometheus del run (errori di scrittura solo segnalati)."""
+    report = build_run_report(status, error)
+    try:
+        if RUN_REPORT_FILE:
+            write_file_atomic(RUN_REPORT_FILE, json.dumps(report, indent=2) + "\n")
+        if METRICS_FILE:
+            write_file_atomic(METRICS_FILE, format_prometheus_metrics(report))
+    except OSError as e:
+        print(f"Attenzione: report del run non scritto ({e})", flush=True)
+    return report
 
-        # Pulisci foglio esistente
-        clear_sheet(service, sheet_name)
 
-        # Scrivi dati con header specifici per partner
-        result = write_to_sheets(service, rows, sheet_name, partner_keyword)
-        cells = result.get('updatedCells', 0)
-        total_cells += cells
-        print(f"    {cells} celle scritte su '{sheet_name}'", flush=True)
+@contextmanager
+def run_telemetry(**options):
+    """
+    Telemetria di un run: azzera i contatori e alla fine, anche in caso di
+    errore, scrive report JSON (RUN_REPORT_FILE) e metriche (METRICS_FILE).
+    """
+    start_run_stats(**options)
+    try:
+        yield
+    except Exception as e:
+        save_run_report("error", e)
+        raise
+    save_run_report("ok")
 
-        # Applica formattazione
-        format_sheet(service, sheet_name, len(rows))
-        print(f"    Formattazione applicata", flush=True)
 
-    print("\n" + "=" * 50, flush=True)
-    print(f"FATTO! {total_cells} celle totali aggiornate", flush=True)
-    print(f"https://docs.google.com/spreadsheets/d/{GOOGLE_SHEET_ID}", flush=True)
-    print("=" * 50, flush=True)
+def load_label_cache():
+    """Legge la cache delle label dal disco (una volta per processo)."""
+    global _label_cache
+    with _label_cache_lock:
+        if _label_cache is None:
+            try:
+                with open(LABEL_CACHE_FILE) as f:
+                    _label_cache = json.load(f)
+            except (OSError, ValueError):
+                _label_cache = {}
+        return _label_cache
 
 
-def main():
-    if len(sys.argv) > 1 and sys.argv[1] == "--schedule":
-        print("Modalità schedulata attiva - Export giornaliero alle 05:05", flush=True)
-        print("Premi Ctrl+C per uscire\n", flush=True)
+def save_label_cache():
+    """Salva la cache delle label su disco (scrittura atomica)."""
+    with _label_cache_lock:
+        data = json.dumps(_label_cache, indent=2, sort_keys=True)
+        tmp_path = f"{LABEL_CACHE_FILE}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(data)
+        os.replace(tmp_path, LABEL_CACHE_FILE)
 
-        # Esegui subito la prima volta
-        run_export()
 
-        # Schedula per le 05:05 ogni giorno
-        schedule.every().day.at("05:05").do(run_export)
+def invalidate_label_cache():
+    """Svuota la cache delle label (memoria e disco): il prossimo accesso le riscarica."""
+    global _label_cache
+    with _label_cache_lock:
+        _label_cache = {}
+        if os.path.exists(LABEL_CACHE_FILE):
+            os.remove(LABEL_CACHE_FILE)
 
-        while True:
-            schedule.run_pending()
-            time.sleep(60)
+
+def fetch_label_entry(key, fetch):
+    """Scarica una voce della cache e la salva su disco."""
+    data = fetch()
+    cache = load_label_cache()
+    with _label_cache_lock:
+        cache[key] = {"fetched_at": time.time(), "data": data}
+    save_label_cache()
+    return data
+
+
+def refresh_label_entry_in_background(key, fetch):
+    """Aggiorna una voce scaduta in un thread separato (una sola volta per voce)."""
+    def refresh():
+        try:
+            fetch_label_entry(key, fetch)
+        except Exception as e:
+            log(f"  Aggiornamento label '{key}' fallito: {e}")
+
+    with _label_cache_lock:
+        thread = _label_refresh_threads.get(key)
+        if thread and thread.is_alive():
+            return
+        thread = threading.Thread(target=refresh, name=f"label-refresh-{key}", daemon=True)
+        _label_refresh_threads[key] = thread
+    thread.start()
+
+
+def wait_label_refresh(timeout=30):
+    """Attende gli aggiornamenti in background (a fine run, per non perderli all'uscita)."""
+    with _label_cache_lock:
+        threads = list(_label_refresh_threads.values())
+    for thread in threads:
+        thread.join(timeout)
+
+
+def get_cached_labels(key, fetch):
+    """
+    Ritorna una voce della cache label.
+    Se manca viene scaricata subito; se è più vecchia di LABEL_CACHE_TTL viene
+    restituita comunque e aggiornata in background per il run successivo.
+    """
+    cache = load_label_cache()
+    with _label_cache_lock:
+        entry = cache.get(key)
+    if entry is None:
+        return fetch_label_entry(key, fetch)
+    if time.time() - entry.get("fetched_at", 0) > LABEL_CACHE_TTL:
+        refresh_label_entry_in_background(key, fetch)
+    return entry["data"]
+
+
+def fetch_pipelines():
+    """Scarica le pipeline deal con i loro stage: {pipeline_id: {"label", "stages": [...]}}."""
+    data = hubspot_request("GET", "/crm/v3/pipelines/deals")
+    pipelines = {}
+    for pipeline in data.get("results", []):
+        stages = sorted(pipeline.get("stages", []), key=lambda stage: stage.get("displayOrder", 0))
+        pipelines[pipeline["id"]] = {
+            "label": pipeline.get("label", ""),
+            "stages": [{"id": stage["id"], "label": stage["label"]} for stage in stages]
+        }
+    return pipelines
+
+
+def fetch_property_options(property_name):
+    """Scarica le opzioni di una proprietà enumerata: {valore: label}."""
+    try:
+        data = hubspot_request("GET", f"/crm/v3/properties/deals/{property_name}")
+    except requests.HTTPError as e:
+        # Proprietà inesistente: nessuna label, si esporta il valore interno
+        if e.response is not None and e.response.status_code == 404:
+            return {}
+        raise
+    return {opt["value"]: opt["label"] for opt in data.get("options", [])}
+
+
+def load_stage_labels():
+    """Carica le label e l'ordine degli stage delle pipeline."""
+    global STAGE_LABELS, PIPELINE_STAGES
+    pipelines = get_cached_labels("pipelines", fetch_pipelines)
+    STAGE_LABELS = {
+        stage["id"]: stage["label"]
+        for pipeline in pipelines.values()
+        for stage in pipeline["stages"]
+    }
+    PIPELINE_STAGES = {
+        pipeline_id: [stage["id"] for stage in pipeline["stages"]]
+        for pipeline_id, pipeline in pipelines.items()
+    }
+
+
+def load_property_labels():
+    """Carica le label delle opzioni delle proprietà in LABEL_PROPERTIES."""
+    global PROPERTY_LABELS
+    PROPERTY_LABELS = {
+        name: get_cached_labels(f"property:{name}", lambda name=name: fetch_property_options(name))
+        for name in LABEL_PROPERTIES
+    }
+
+
+def build_partner_filters(pipeline_id, partner_keyword, modified_since=None):
+    """Filtri Search API per pipeline, partner_label_name ed eventuale checkpoint."""
+    filters = [{
+        "propertyName": "pipeline",
+        "operator": "EQ",
+        "value": pipeline_id
+    }]
+
+    # Aggiungi filtro per partner_label_name usando CONTAINS_TOKEN
+    if partner_keyword:
+        filters.append({
+            "propertyName": "partner_label_name",
+            "operator": "CONTAINS_TOKEN",
+            "value": f"{partner_keyword.lower()}*"
+        })
+
+    # Solo deal modificati dopo il checkpoint (modalità incrementale)
+    if modified_since:
+        filters.append({
+            "propertyName": "hs_lastmodifieddate",
+            "operator": "GT",
+            "value": str(modified_since)
+        })
+
+    return filters
+
+
+SEARCH_PATH = "/crm/v3/objects/deals/search"
+
+
+def search_payload(filter_groups, properties=None, direction="ASCENDING", limit=SEARCH_PAGE_SIZE, after=None):
+    """Corpo di una richiesta Search API ordinata per hs_object_id."""
+    payload = {
+        "filterGroups": [{"filters": filters} for filters in filter_groups],
+        "properties": properties or hubspot_properties(),
+        "sorts": [{"propertyName": "hs_object_id", "direction": direction}],
+        "limit": limit
+    }
+    # Aggiungi after solo se presente (non nella prima richiesta)
+    if after:
+        payload["after"] = after
+    return payload
+
+
+def search_steps(filter_groups, properties=None, after=None):
+    """
+    Paginazione della Search API senza I/O, condivisa da client sincrono e
+    asincrono: il generatore produce ("request", payload) e riceve con send()
+    la risposta JSON, poi produce ("page", deal) per ogni pagina non vuota.
+
+    La Search API restituisce al massimo SEARCH_RESULT_LIMIT risultati per
+    query: i deal sono ordinati per hs_object_id e, quando la finestra si
+    riempie, la ricerca riparte con un filtro hs_object_id > ultimo ID letto
+    (keyset pagination), senza limiti sul numero totale di deal.
+    Con after la ricerca prosegue da quel cursore (pagina già letta altrove).
+    """
+    fetched = 0
+    last_id = None
+
+    while True:
+        # Filtro keyset su ogni filterGroup (i gruppi sono in OR)
+        groups = filter_groups
+        if last_id is not None:
+            keyset_filter = {"propertyName": "hs_object_id", "operator": "GT", "value": last_id}
+            groups = [filters + [keyset_filter] for filters in filter_groups]
+            after = None
+
+        while True:
+            data = yield "request", search_payload(groups, properties, after=after)
+
+            results = data.get("results", [])
+            fetched += len(results)
+            if results:
+                yield "page", results
+
+            # Paging per Search API
+            paging = data.get("paging", {})
+            next_page = paging.get("next", {})
+            after = next_page.get("after")
+
+            if not after or len(results) == 0:
+                return
+
+            # La prossima pagina supererebbe il limite: riparti dall'ultimo ID
+            if str(after).isdigit() and int(after) + SEARCH_PAGE_SIZE > SEARCH_RESULT_LIMIT:
+                break
+
+            log(f"    Recuperati {fetched} deal...")
+
+        window_last_id = results[-1]["id"]
+        if last_id is not None and int(window_last_id) <= int(last_id):
+            raise RuntimeError(
+                f"Search API: limite di {SEARCH_RESULT_LIMIT} risultati raggiunto senza "
+                f"avanzare oltre hs_object_id {last_id}, export interrotto"
+            )
+        last_id = window_last_id
+        log(f"    Recuperati {fetched} deal, limite Search API raggiunto: "
+            f"riparto da hs_object_id > {last_id}")
+
+
+def iter_search_pages(filter_groups, properties=None, after=None):
+    """Esegue una Search API paginata (filterGroups in OR) e restituisce i deal una pagina alla volta."""
+    steps = search_steps(filter_groups, properties, after)
+    response = None
+    while True:
+        try:
+            kind, value = steps.send(response)
+        except StopIteration:
+            return
+        response = None
+        if kind == "request":
+            response = hubspot_request("POST", SEARCH_PATH, json_body=value, search=True)
+        else:
+            yield value
+
+
+async def iter_search_pages_async(filter_groups, properties=None, after=None):
+    """Come iter_search_pages(), con il client asincrono."""
+    steps = search_steps(filter_groups, properties, after)
+    response = None
+    while True:
+        try:
+            kind, value = steps.send(response)
+        except StopIteration:
+            return
+        response = None
+        if kind == "request":
+            response = await hubspot_request_async("POST", SEARCH_PATH, json_body=value, search=True)
+        else:
+            yield value
+
+
+def search_deals(filter_groups, properties=None):
+    """Come iter_search_pages(), ma ritorna tutti i deal in una lista."""
+    return [deal for page in iter_search_pages(filter_groups, properties) for deal in page]
+
+
+def prefetch_pages(pages, depth=FETCH_PREFETCH_PAGES):
+    """
+    Legge le pagine di un generatore in un thread dedicato, fino a `depth`
+    pagine in anticipo: la pagina N+1 viene scaricata mentre il chiamante
+    elabora la pagina N. Gli errori del thread vengono rilanciati al chiamante.
+    """
+    buffer = queue.Queue(maxsize=max(1, depth))
+    stop = threading.Event()
+    done = object()
+    partner_keyword = _current_partner.get()
+
+    def put(item):
+        # Timeout per non restare bloccati se il chiamante smette di leggere
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def producer():
+        with partner_context(partner_keyword):
+            try:
+                for page in pages:
+                    if not put((page, None)):
+                        return
+                put((done, None))
+            except Exception as e:
+                put((done, e))
+
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+    try:
+        while True:
+            page, error = buffer.get()
+            if page is done:
+                if error:
+                    raise error
+                return
+            yield page
+    finally:
+        stop.set()
+
+
+def search_first_page(filter_groups, properties=None, direction="ASCENDING", limit=SEARCH_PAGE_SIZE):
+    """Prima pagina di una Search API ordinata per hs_object_id (usata come sonda)."""
+    payload = search_payload(filter_groups, properties, direction, limit)
+    return hubspot_request("POST", SEARCH_PATH, json_body=payload, search=True)
+
+
+def split_id_ranges(min_id, max_id, parts):
+    """Divide [min_id, max_id] in intervalli disgiunti [da, a) di ampiezza uniforme."""
+    step = max(1, math.ceil((max_id - min_id + 1) / parts))
+    return [(low, min(low + step, max_id + 1)) for low in range(min_id, max_id + 1, step)]
+
+
+def partition_count(first_page):
+    """
+    Intervalli di hs_object_id in cui dividere la ricerca, dalla pagina sonda:
+    0 se la prima pagina contiene già tutti i deal.
+    """
+    results = first_page.get("results", [])
+    if not first_page.get("paging", {}).get("next"):
+        return 0
+    total = first_page.get("total", len(results))
+    return max(1, min(FETCH_MAX_PARTITIONS, math.ceil(total / FETCH_PARTITION_SIZE)))
+
+
+def range_filter_groups(filter_groups, id_range):
+    """filterGroups limitati all'intervallo [da, a) di hs_object_id."""
+    low, high = id_range
+    range_filters = [
+        {"propertyName": "hs_object_id", "operator": "GTE", "value": str(low)},
+        {"propertyName": "hs_object_id", "operator": "LT", "value": str(high)},
+    ]
+    return [filters + range_filters for filters in filter_groups]
+
+
+def deals_below(deals, high):
+    """Deal (ordinati per ID) con hs_object_id < high; True se la lista va oltre high."""
+    kept = [deal for deal in deals if int(deal["id"]) < high]
+    return kept, len(kept) < len(deals)
+
+
+def first_range_start(first_page, high):
+    """
+    Inizio del primo intervallo dalla pagina sonda: (deal della sonda sotto
+    high, cursore `after` da cui proseguire la stessa ricerca o None).
+    """
+    deals, past_range = deals_below(first_page.get("results", []), high)
+    after = first_page.get("paging", {}).get("next", {}).get("after")
+    return deals, None if past_range else after
+
+
+def search_first_range(first_page, high, filter_groups, properties=None):
+    """
+    Primo intervallo di search_deals_partitioned(): riusa i deal della sonda e
+    prosegue la stessa ricerca dal suo cursore fino a hs_object_id >= high,
+    senza rileggere la prima pagina.
+    """
+    deals, after = first_range_start(first_page, high)
+    if after:
+        for page in iter_search_pages(filter_groups, properties, after=after):
+            kept, past_range = deals_below(page, high)
+            deals.extend(kept)
+            if past_range:
+                break
+    return deals
+
+
+def search_deals_partitioned(filter_groups, properties=None):
+    """
+    Come search_deals(), ma per result set grandi divide i deal in intervalli
+    di hs_object_id letti in parallelo.
+
+    La prima pagina fa da sonda: se contiene già tutti i deal viene restituita
+    (nessuna richiesta in più per i partner piccoli), altrimenti il campo
+    `total` determina il numero di intervalli. La sonda apre anche il primo
+    intervallo, che prosegue dal suo cursore. Gli intervalli vengono uniti
+    in ordine, quindi il risultato resta ordinato per hs_object_id.
+    """
+    first_page = search_first_page(filter_groups, properties)
+    results = first_page.get("results", [])
+    parts = partition_count(first_page)
+    if parts == 0:
+        return results
+    if parts == 1:
+        return search_first_range(first_page, math.inf, filter_groups, properties)
+
+    # Estremi degli ID: il minimo è nella prima pagina, il massimo da una sonda discendente
+    last_page = search_first_page(filter_groups, ["hs_object_id"], direction="DESCENDING", limit=1)
+    ranges = split_id_ranges(int(results[0]["id"]), int(last_page["results"][0]["id"]), parts)
+    log(f"    {first_page.get('total')} deal: lettura di {len(ranges)} intervalli di hs_object_id in parallelo")
+
+    partner_keyword = _current_partner.get()
+
+    def fetch_range(id_range):
+        with partner_context(partner_keyword):
+            if id_range == ranges[0]:
+                return search_first_range(first_page, id_range[1], filter_groups, properties)
+            return search_deals(range_filter_groups(filter_groups, id_range), properties)
+
+    with ThreadPoolExecutor(max_workers=max(1, FETCH_PARTITION_WORKERS)) as executor:
+        chunks = list(executor.map(fetch_range, ranges))
+    return [deal for chunk in chunks for deal in chunk]
+
+
+async def search_deals_async(filter_groups, properties=None):
+    """Come search_deals(), con il client asincrono."""
+    return [deal async for page in iter_search_pages_async(filter_groups, properties) for deal in page]
+
+
+async def search_first_range_async(first_page, high, filter_groups, properties=None):
+    """Come search_first_range(), con il client asincrono."""
+    deals, after = first_range_start(first_page, high)
+    if after:
+        pages = iter_search_pages_async(filter_groups, properties, after=after)
+        try:
+            async for page in pages:
+                kept, past_range = deals_below(page, high)
+                deals.extend(kept)
+                if past_range:
+                    break
+        finally:
+            await pages.aclose()
+    return deals
+
+
+async def search_deals_partitioned_async(filter_groups, properties=None):
+    """
+    Come search_deals_partitioned(), con il client asincrono: gli intervalli
+    sono task concorrenti (al massimo FETCH_PARTITION_WORKERS alla volta).
+    """
+    first_page = await hubspot_request_async(
+        "POST", SEARCH_PATH, json_body=search_payload(filter_groups, properties), search=True
+    )
+    results = first_page.get("results", [])
+    parts = partition_count(first_page)
+    if parts == 0:
+        return results
+    if parts == 1:
+        return await search_first_range_async(first_page, math.inf, filter_groups, properties)
+
+    last_page = await hubspot_request_async(
+        "POST", SEARCH_PATH, search=True,
+        json_body=search_payload(filter_groups, ["hs_object_id"], direction="DESCENDING", limit=1)
+    )
+    ranges = split_id_ranges(int(results[0]["id"]), int(last_page["results"][0]["id"]), parts)
+    log(f"    {first_page.get('total')} deal: lettura di {len(ranges)} intervalli di hs_object_id in parallelo")
+
+    semaphore = asyncio.Semaphore(max(1, FETCH_PARTITION_WORKERS))
+
+    async def fetch_range(id_range):
+        async with semaphore:
+            if id_range == ranges[0]:
+                return await search_first_range_async(first_page, id_range[1], filter_groups, properties)
+            return await search_deals_async(range_filter_groups(filter_groups, id_range), properties)
+
+    chunks = await asyncio.gather(*(fetch_range(id_range) for id_range in ranges))
+    return [deal for chunk in chunks for deal in chunk]
+
+
+def iter_partner_pages(pipeline_id, partner_keyword, modified_since=None):
+    """
+    Pagine di deal del partner per la modalità stream: lettura sequenziale
+    (keyset) con prefetch, così in memoria restano solo poche pagine.
+    """
+    if pipeline_id is None:
+        pipeline_id = PARTNERSHIP_PIPELINE_ID
+
+    filters = build_partner_filters(pipeline_id, partner_keyword, modified_since)
+    return prefetch_pages(iter_search_pages([filters], get_properties_for_partners([partner_keyword])))
+
+
+def get_deals_for_partner(pipeline_id, partner_keyword, modified_since=None):
+    """
+    Recupera deal per un partner specifico usando Search API con filtri combinati.
+    Se modified_since (epoch ms) è valorizzato recupera solo i deal con
+    hs_lastmodifieddate successivo.
+    """
+    if pipeline_id is None:
+        pipeline_id = PARTNERSHIP_PIPELINE_ID
+
+    # Usa Search API con filtro per pipeline E partner_label_name
+    filters = build_partner_filters(pipeline_id, partner_keyword, modified_since)
+    return search_deals_partitioned([filters], get_properties_for_partners([partner_keyword]))
+
+
+async def get_deals_for_partner_async(pipeline_id, partner_keyword, modified_since=None):
+    """Come get_deals_for_partner(), con il client asincrono."""
+    filters = build_partner_filters(pipeline_id or PARTNERSHIP_PIPELINE_ID, partner_keyword, modified_since)
+    return await search_deals_partitioned_async([filters], get_properties_for_partners([partner_keyword]))
+
+
+def partner_matches(partner_label, partner_keyword):
+    """
+    Replica in locale il filtro CONTAINS_TOKEN "keyword*": il keyword deve
+    comparire all'inizio di una parola di partner_label_name.
+    """
+    if not partner_label:
+        return False
+    pattern = r"(?<![0-9a-z])" + re.escape(partner_keyword.lower())
+    return re.search(pattern, partner_label.lower()) is not None
+
+
+def pipeline_filter_groups(pipeline_id, partners_since):
+    """
+    filterGroups della ricerca combinata, un gruppo per partner, divisi in
+    richieste entro i limiti HubSpot: SEARCH_MAX_FILTER_GROUPS gruppi e
+    SEARCH_MAX_FILTERS filtri in totale, contando anche i filtri che intervalli
+    e ripartenze keyset aggiungono a ogni gruppo.
+    """
+    chunks = []
+    chunk, chunk_filters = [], 0
+    for keyword, modified_since in partners_since.items():
+        filters = build_partner_filters(pipeline_id, keyword, modified_since)
+        cost = len(filters) + SEARCH_EXTRA_FILTERS_PER_GROUP
+        if chunk and (len(chunk) >= SEARCH_MAX_FILTER_GROUPS or chunk_filters + cost > SEARCH_MAX_FILTERS):
+            chunks.append(chunk)
+            chunk, chunk_filters = [], 0
+        chunk.append(filters)
+        chunk_filters += cost
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def route_deals(deals, keywords, deals_by_partner, routed):
+    """
+    Smista i deal della ricerca combinata sui partner. L'indice dei Deal ID
+    già smistati (routed) evita che un deal venga assegnato due volte allo
+    stesso partner.
+    """
+    for deal in deals:
+        deal_id = deal.get("id")
+        label = deal.get("properties", {}).get("partner_label_name")
+        for keyword in keywords:
+            if keyword in routed.setdefault(deal_id, set()):
+                continue
+            if partner_matches(label, keyword):
+                routed[deal_id].add(keyword)
+                deals_by_partner[keyword].append(deal)
+
+
+def get_deals_for_pipeline(pipeline_id, partners_since):
+    """
+    Recupera con un'unica Search API i deal di tutti i partner di una pipeline
+    (un filterGroup per partner, in OR) e li smista in locale per partner.
+
+    partners_since: {partner_keyword: modified_since o None}
+    Ritorna {partner_keyword: [deal, ...]}.
+    """
+    keywords = list(partners_since)
+    deals_by_partner = {keyword: [] for keyword in keywords}
+    routed = {}
+    # Un deal può finire a qualsiasi partner: unione delle colonne di tutti
+    properties = get_properties_for_partners(keywords)
+
+    for filter_groups in pipeline_filter_groups(pipeline_id, partners_since):
+        route_deals(search_deals_partitioned(filter_groups, properties), keywords, deals_by_partner, routed)
+
+    return deals_by_partner
+
+
+async def get_deals_for_pipeline_async(pipeline_id, partners_since):
+    """Come get_deals_for_pipeline(), con il client asincrono."""
+    keywords = list(partners_since)
+    deals_by_partner = {keyword: [] for keyword in keywords}
+    routed = {}
+    properties = get_properties_for_partners(keywords)
+
+    for filter_groups in pipeline_filter_groups(pipeline_id, partners_since):
+        route_deals(await search_deals_partitioned_async(filter_groups, properties), keywords, deals_by_partner, routed)
+
+    return deals_by_partner
+
+
+@lru_cache(maxsize=131072)
+def parse_date(date_string):
+    """
+    Parse una stringa data e ritorna oggetto datetime o None.
+    Con cache: la stessa stringa viene parsata una sola volta per processo.
+    """
+    if not date_string:
+        return None
+    try:
+        return datetime.fromisoformat(date_string.replace("Z", "+00:00"))
+    except:
+        return None
+
+
+# Istante di riferimento del run (epoch ms): tutte le durate "fino a ora"
+# di un export usano lo stesso valore. None = ora corrente.
+RUN_CLOCK_MS = None
+
+
+def set_run_clock(now_ms=None):
+    """Fissa l'istante di riferimento del run (default: adesso). Ritorna il valore fissato."""
+    global RUN_CLOCK_MS
+    RUN_CLOCK_MS = int(time.time() * 1000) if now_ms is None else now_ms
+    return RUN_CLOCK_MS
+
+
+def run_clock_ms():
+    """Istante di riferimento del run in corso (o ora corrente se non fissato)."""
+    return RUN_CLOCK_MS if RUN_CLOCK_MS is not None else int(time.time() * 1000)
+
+
+# Formato fisso dei timestamp HubSpot (2024-01-31T10:00:00.000Z). I giorni oltre
+# il 28 vengono validati da match_hubspot_timestamp().
+HUBSPOT_TIMESTAMP = re.compile(
+    r"(\d{4})-(0[1-9]|1[0-2])-(0[1-9]|[12]\d|3[01])T([01]\d|2[0-3]):([0-5]\d):([0-5]\d)\.(\d{3})Z"
+)
+
+
+def match_hubspot_timestamp(date_string):
+    """Match di HUBSPOT_TIMESTAMP, None se il giorno non esiste nel mese (es. 2025-02-30)."""
+    match = HUBSPOT_TIMESTAMP.fullmatch(date_string)
+    if match and match.group(3) > "28":
+        if int(match.group(3)) > calendar.monthrange(int(match.group(1)), int(match.group(2)))[1]:
+            return None
+    return match
+
+
+def days_from_civil(year, month, day):
+    """Giorni dal 1970-01-01 di una data del calendario gregoriano (aritmetica intera)."""
+    year -= month <= 2
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * (month + (-3 if month > 2 else 9)) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    return era * 146097 + day_of_era - 719468
+
+
+def date_to_ms(date_string):
+    """
+    Converte una data ISO in epoch millisecondi (None se non valida).
+    I timestamp HubSpot vengono convertiti con aritmetica intera, senza datetime;
+    gli altri formati passano da parse_date.
+    """
+    if not date_string:
+        return None
+    match = match_hubspot_timestamp(date_string)
+    if match:
+        year, month, day, hour, minute, second, millis = map(int, match.groups())
+        days = days_from_civil(year, month, day)
+        return (((days * 24 + hour) * 60 + minute) * 60 + second) * 1000 + millis
+    dt = parse_date(date_string)
+    if not dt:
+        return None
+    return int(dt.timestamp() * 1000)
+
+
+def epoch_column(values):
+    """Colonna di date ISO -> lista di epoch ms (None se vuota o non valida), in un solo passaggio."""
+    return [date_to_ms(value) if value else None for value in values]
+
+
+@lru_cache(maxsize=131072)
+def format_date(date_string):
+    """Formatta data come stringa YYYY-MM-DD HH:MM:SS."""
+    if not date_string:
+        return ""
+    dt = parse_date(date_string)
+    if not dt:
+        return date_string
+    return dt.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def format_timestamp(date_string):
+    """
+    Come format_date, ma i timestamp HubSpot (UTC) vengono formattati tagliando
+    la stringa: nessuna conversione in datetime per le colonne di sola visualizzazione.
+    """
+    if date_string and match_hubspot_timestamp(date_string):
+        return f"{date_string[:10]} {date_string[11:19]}"
+    return format_date(date_string)
+
+
+def format_euro(value):
+    """Converte valore in numero per formato Euro."""
+    if not value:
+        return ""
+    try:
+        return float(str(value).replace(",", ".").replace(" ", ""))
+    except:
+        return value
+
+
+def classify_deal_size(value, store_type="", partner=""):
+    """Classifica il deal in base all'amount. Per SmallPay/PostePay con Physical store, usa amount/0.05."""
+    if not value:
+        return ""
+    try:
+        amount = float(str(value).replace(",", ".").replace(" ", ""))
+        # Solo per SmallPay e PostePay: se Physical store, usa amount/0.05
+        partner_lower = partner.lower() if partner else ""
+        if partner_lower in ["smallpay", "postepay"]:
+            if store_type and "physical store" in store_type.lower():
+                amount = amount / 0.05
+        if amount < 50000:
+            return "0 - 50.000 €"
+        elif amount < 100000:
+            return "50.000 € - 100.000 €"
+        elif amount < 300000:
+            return "100.000 € - 300.000 €"
+        elif amount < 500000:
+            return "300.000 € - 500.000 €"
+        elif amount < 1000000:
+            return "500.000 € - 1M €"
+        elif amount < 5000000:
+            return "1M € - 5M €"
+        elif amount < 10000000:
+            return "5M € - 10M €"
+        else:
+            return "Oltre 10M €"
+    except:
+        return ""
+
+
+def format_ms_to_minutes(ms_string):
+    """Converte millisecondi in minuti."""
+    if not ms_string:
+        return ""
+    try:
+        # Caso comune: valore numerico HubSpot, senza normalizzazione della stringa
+        return round(float(ms_string) / 1000 / 60, 2)
+    except (TypeError, ValueError):
+        pass
+    try:
+        ms = float(str(ms_string).replace(",", ".").replace(" ", ""))
+        return round(ms / 1000 / 60, 2)
+    except:
+        return ms_string
+
+
+def days_between(entered_ms, exited_ms, open_ms):
+    """Giorni tra ingresso e uscita; senza uscita fino a open_ms (None = vuoto)."""
+    if entered_ms is None:
+        return ""
+    end_ms = exited_ms if exited_ms is not None else open_ms
+    if end_ms is None:
+        return ""
+    return round((end_ms - entered_ms) / 1000 / 3600 / 24, 2)
+
+
+def calculate_days_in_proposal(date_entered, date_exited, stage_label):
+    """
+    Calcola giorni in Proposal sent:
+    - Se date_entered e date_exited presenti: diff in giorni
+    - Se solo date_entered e stage = "Proposal sent": giorni da entered all'istante del run
+    - Altrimenti: vuoto
+    """
+    is_open = bool(stage_label) and "proposal sent" in stage_label.lower()
+    return days_between(date_to_ms(date_entered), date_to_ms(date_exited), run_clock_ms() if is_open else None)
+
+
+def days_in_proposal_column(entered, exited, stages):
+    """
+    Versione a colonna di calculate_days_in_proposal: date convertite in epoch ms
+    in un passaggio, stage aperti risolti una volta per stage ID e un solo
+    istante di riferimento per tutti i deal.
+    """
+    now_ms = run_clock_ms()
+    open_stages = {
+        stage_id for stage_id in set(stages)
+        if "proposal sent" in (stage_label(stage_id) or "").lower()
+    }
+    return [
+        days_between(entered_ms, exited_ms, now_ms if stage_id in open_stages else None)
+        for entered_ms, exited_ms, stage_id in zip(epoch_column(entered), epoch_column(exited), stages)
+    ]
+
+
+def first_value_getter(keys):
+    """Ritorna una funzione props -> primo valore non vuoto tra le proprietà indicate."""
+    keys = tuple(keys)
+
+    def get(props):
+        for key in keys:
+            value = props.get(key)
+            if value:
+                return value
+        return ""
+    return get
+
+
+def stage_label(stage_id):
+    """Label dello stage (l'ID se sconosciuto)."""
+    return STAGE_LABELS.get(stage_id, stage_id)
+
+
+def option_label(property_name):
+    """Ritorna una funzione valore -> label HubSpot dell'opzione, se disponibile."""
+    return lambda value: PROPERTY_LABELS.get(property_name, {}).get(value, value)
+
+
+# Trasformazioni dello schema: (colonna, partner) -> funzione(valori delle sources).
+# None = valore della proprietà invariato.
+COLUMN_TRANSFORMS = {
+    "text": lambda column, partner_keyword: None,
+    "date": lambda column, partner_keyword: format_timestamp,
+    "euro": lambda column, partner_keyword: format_euro,
+    "minutes": lambda column, partner_keyword: format_ms_to_minutes,
+    "label": lambda column, partner_keyword: option_label(column["sources"][0]),
+    "stage": lambda column, partner_keyword: stage_label,
+    "deal_size": lambda column, partner_keyword: (
+        lambda amount, store_type: classify_deal_size(amount, store_type, partner_keyword)
+    ),
+}
+
+# Trasformazioni a colonna intera: (colonna, partner) -> funzione(colonne delle sources)
+# -> valori. Per le durate, calcolate in batch rispetto all'istante del run.
+BATCH_COLUMN_TRANSFORMS = {
+    "days_in_proposal": lambda column, partner_keyword: days_in_proposal_column,
+}
+
+
+def source_values(source, props_list):
+    """Valori di una source dello schema per tutti i deal."""
+    if isinstance(source, list):
+        get = first_value_getter(source)
+        return [get(props) for props in props_list]
+    return [props.get(source, "") for props in props_list]
+
+
+def compile_column(column, partner_keyword):
+    """Estrattore (deal, props dei deal) -> valori di una colonna dello schema per tutti i deal."""
+    if column["transform"] == "id":
+        return lambda deals, props_list: [deal.get("id", "") for deal in deals]
+
+    sources = column["sources"]
+    if column["transform"] in BATCH_COLUMN_TRANSFORMS:
+        transform = BATCH_COLUMN_TRANSFORMS[column["transform"]](column, partner_keyword)
+        return lambda deals, props_list: transform(*[source_values(source, props_list) for source in sources])
+
+    transform = COLUMN_TRANSFORMS[column["transform"]](column, partner_keyword)
+
+    # Caso più frequente: una sola proprietà, lettura diretta senza getter
+    if len(sources) == 1 and not isinstance(sources[0], list):
+        name = sources[0]
+        if transform is None:
+            return lambda deals, props_list: [props.get(name, "") for props in props_list]
+        return lambda deals, props_list: [transform(props.get(name, "")) for props in props_list]
+
+    if transform is None:
+        return lambda deals, props_list: source_values(sources[0], props_list)
+    return lambda deals, props_list: list(map(transform, *[source_values(source, props_list) for source in sources]))
+
+
+def compile_column_plan(partner_keyword=""):
+    """
+    Compila le colonne dello schema del partner in una lista di estrattori
+    (deal, props dei deal) -> valori, nello stesso ordine di get_headers_for_partner().
+    Proprietà, label e trasformazioni vengono risolte qui una volta sola
+    invece che per ogni deal.
+    """
+    return [compile_column(column, partner_keyword) for column in get_columns_for_partner(partner_keyword)]
+
+
+def apply_column_plan(plan, deals):
+    """
+    Applica un piano colonne compilato a tutti i deal e ritorna le righe.
+    Il piano lavora colonna per colonna (le durate vengono calcolate in batch),
+    le righe vengono composte alla fine.
+    """
+    props_list = [deal.get("properties", {}) for deal in deals]
+    columns = [extract(deals, props_list) for extract in plan]
+    return [list(row) for row in zip(*columns)]
+
+
+def process_deals(deals, partner_keyword=""):
+    """Processa i deal e ritorna righe formattate."""
+    return apply_column_plan(compile_column_plan(partner_keyword), deals)
+
+
+# Tipi dell'export colonnare per trasformazione dello schema: numeri e istanti
+# restano valori grezzi invece delle stringhe formattate per il foglio
+COLUMN_TYPES = {
+    "id": "int",
+    "text": "string",
+    "date": "timestamp",
+    "euro": "float",
+    "minutes": "float",
+    "days_in_proposal": "float",
+    "label": "string",
+    "stage": "string",
+    "deal_size": "string",
+}
+
+
+def column_name(header):
+    """Nome di colonna per i formati colonnari: minuscole, cifre e underscore."""
+    return re.sub(r"[^a-z0-9]+", "_", header.lower()).strip("_")
+
+
+def compile_typed_column(column, partner_keyword):
+    """Estrattore (deal, props dei deal) -> valori tipizzati della colonna (None se vuoti)."""
+    column_type = COLUMN_TYPES[column["transform"]]
+    if column_type == "timestamp":
+        # Epoch ms UTC dalla proprietà, senza passare dalla stringa formattata
+        source = column["sources"][0]
+        return lambda deals, props_list: epoch_column(source_values(source, props_list))
+
+    extract = compile_column(column, partner_keyword)
+    if column_type == "int":
+        return lambda deals, props_list: [int(value) if value else None for value in extract(deals, props_list)]
+    if column_type == "float":
+        # Valori non numerici (es. importi non convertibili) diventano nulli
+        return lambda deals, props_list: [
+            float(value) if isinstance(value, (int, float)) else None for value in extract(deals, props_list)
+        ]
+    return lambda deals, props_list: [
+        str(value) if value not in ("", None) else None for value in extract(deals, props_list)
+    ]
+
+
+def compile_typed_plan(partner_keyword=""):
+    """Colonne del partner per l'export colonnare: [(nome, tipo, estrattore)]."""
+    return [
+        (column_name(column["header"]), COLUMN_TYPES[column["transform"]], compile_typed_column(column, partner_keyword))
+        for column in get_columns_for_partner(partner_keyword)
+    ]
+
+
+VALUE_RANGE_START = re.compile(r"^(.*!)A(\d+)$")
+
+
+def split_value_range(range_name, values, max_bytes=SHEETS_MAX_REQUEST_BYTES):
+    """
+    Divide un blocco di righe che parte dalla colonna A in blocchi consecutivi
+    la cui codifica JSON resta entro max_bytes (una riga più grande resta da sola).
+    Ritorna [(range, righe, byte stimati)].
+    """
+    size = len(json.dumps(values))
+    match = VALUE_RANGE_START.match(range_name)
+    if size <= max_bytes or match is None:
+        return [(range_name, values, size)]
+
+    prefix, first_row = match.group(1), int(match.group(2))
+    parts = []
+    start = 0
+    part_size = 0
+    for index, row in enumerate(values):
+        row_size = len(json.dumps(row)) + 2
+        if index > start and part_size + row_size > max_bytes:
+            parts.append((f"{prefix}A{first_row + start}", values[start:index], part_size))
+            start, part_size = index, 0
+        part_size += row_size
+    parts.append((f"{prefix}A{first_row + start}", values[start:], part_size))
+    return parts
+
+
+class SheetsSession:
+    """
+    Sessione di lavoro su uno spreadsheet Google per un singolo run.
+
+    Legge una sola volta i metadati (titoli, ID e dimensioni dei fogli),
+    accoda le richieste di tutti i partner e le invia con flush(): una
+    spreadsheets.batchUpdate (addSheet, dimensioni griglia, pulizia,
+    formattazione) seguita dalle values.batchUpdate dei valori, divise in
+    chiamate da SHEETS_MAX_REQUEST_BYTES al massimo.
+    I worker accodano in modo thread-safe; le chiamate API avvengono sotto lock
+    perché il client Google (httplib2) non è thread-safe.
+    """
+
+    def __init__(self, service, spreadsheet_id=GOOGLE_SHEET_ID):
+        self.service = service
+        self.spreadsheet_id = spreadsheet_id
+        self.lock = threading.RLock()
+        self.sheets = {}        # titolo -> {"sheetId", "rowCount", "columnCount"}
+        self.values = {}        # titolo -> valori letti (UNFORMATTED_VALUE)
+        self.requests = []      # richieste spreadsheets.batchUpdate
+        self.value_ranges = []  # (byte stimati, dati values.batchUpdate)
+        self.streamed_cells = 0  # celle già scritte da write_rows_now()
+        self.overflow = []      # sessioni degli spreadsheet per i fogli oltre il limite di celle
+        self.shards = {}        # partner -> [(spreadsheet, foglio, righe, primo e ultimo Deal ID)]
+        self.load_metadata()
+
+    def execute(self, endpoint, request):
+        """
+        Esegue una richiesta del client Google registrandola nelle statistiche
+        per endpoint. I byte ricevuti sono quelli del JSON decodificato (il client
+        non espone la risposta grezza).
+        """
+        endpoint = f"sheets {endpoint}"
+        sent = len(request.body or "")
+        start = time.monotonic()
+        try:
+            result = request.execute()
+        except Exception:
+            record_endpoint_call(endpoint, time.monotonic() - start, failed=True, bytes_sent=sent)
+            raise
+        record_endpoint_call(endpoint, time.monotonic() - start, bytes_sent=sent,
+                             bytes_received=len(json.dumps(result)))
+        return result
+
+    def load_metadata(self):
+        """Legge titoli, ID e dimensioni di tutti i fogli con una sola chiamata."""
+        spreadsheet = self.execute("spreadsheets.get", self.service.spreadsheets().get(
+            spreadsheetId=self.spreadsheet_id,
+            fields="sheets(properties(sheetId,title,gridProperties),developerMetadata(metadataKey,metadataValue))"
+        ))
+        self.sheets = {}
+        for sheet in spreadsheet.get("sheets", []):
+            props = sheet["properties"]
+            grid = props.get("gridProperties", {})
+            self.sheets[props["title"]] = {
+                "sheetId": props["sheetId"],
+                "rowCount": grid.get("rowCount", 1000),
+                "columnCount": grid.get("columnCount", 26),
+                "shard": any(
+                    metadata.get("metadataKey") == SHARD_METADATA_KEY
+                    and metadata.get("metadataValue") == str(props["sheetId"])
+                    for metadata in sheet.get("developerMetadata", [])
+                ),
+            }
+
+    def get_sheet_id(self, title):
+        with self.lock:
+            sheet = self.sheets.get(title)
+            return sheet["sheetId"] if sheet else None
+
+    def ensure_sheet(self, title, rows=1000, columns=26):
+        """Accoda addSheet se il foglio non esiste. Ritorna True se il foglio è nuovo."""
+        with self.lock:
+            if title in self.sheets:
+                return False
+            # L'ID viene scelto qui così le richieste successive possono già usarlo
+            sheet_id = max([sheet["sheetId"] for sheet in self.sheets.values()] + [0]) + 1
+            self.sheets[title] = {"sheetId": sheet_id, "rowCount": rows, "columnCount": columns}
+            self.values[title] = []
+            self.requests.append({
+                "addSheet": {
+                    "properties": {
+                        "title": title,
+                        "sheetId": sheet_id,
+                        "gridProperties": {"rowCount": rows, "columnCount": columns}
+                    }
+                }
+            })
+            return True
+
+    def cell_count(self, exclude=None):
+        """Celle occupate dalle griglie di tutti i fogli (escluso il foglio exclude)."""
+        with self.lock:
+            return sum(sheet["rowCount"] * sheet["columnCount"]
+                       for title, sheet in self.sheets.items() if title != exclude)
+
+    def grid_fits(self, title, rows, columns):
+        """True se il foglio può avere almeno rows x columns celle senza superare SHEETS_CELL_LIMIT."""
+        with self.lock:
+            sheet = self.sheets.get(title, {"rowCount": rows, "columnCount": columns})
+            cells = max(rows, sheet["rowCount"]) * max(columns, sheet["columnCount"])
+            return self.cell_count(exclude=title) + cells <= SHEETS_CELL_LIMIT
+
+    def reserve_grid(self, title, rows, columns):
+        """
+        Crea il foglio (se manca, con la griglia esatta) e ne amplia la griglia a
+        rows x columns solo se lo spreadsheet resta entro SHEETS_CELL_LIMIT.
+        Controllo e ampliamento avvengono sotto lock, così due partner non si
+        contendono le stesse celle. Ritorna True se la griglia è riservata.
+        """
+        with self.lock:
+            if not self.grid_fits(title, rows, columns):
+                return False
+            self.ensure_sheet(title, rows, columns)
+            self.ensure_grid(title, rows, columns)
+            return True
+
+    def tag_shard(self, title):
+        """Marca il foglio come foglio di un partner scritto dall'export (developer metadata)."""
+        with self.lock:
+            sheet = self.sheets[title]
+            if sheet.get("shard"):
+                return
+            sheet["shard"] = True
+            self.requests.append({
+                "createDeveloperMetadata": {
+                    "developerMetadata": {
+                        "metadataKey": SHARD_METADATA_KEY,
+                        "metadataValue": str(sheet["sheetId"]),
+                        "location": {"sheetId": sheet["sheetId"]},
+                        "visibility": "DOCUMENT",
+                    }
+                }
+            })
+
+    def delete_sheet(self, title):
+        """
+        Accoda deleteSheet in testa alle richieste: le celle liberate devono
+        valere già per gli ampliamenti della stessa batchUpdate.
+        """
+        with self.lock:
+            sheet = self.sheets.pop(title, None)
+            if sheet is None:
+                return
+            self.values.pop(title, None)
+            self.requests.insert(0, {"deleteSheet": {"sheetId": sheet["sheetId"]}})
+
+    def ensure_grid(self, title, rows, columns):
+        """Accoda l'ampliamento della griglia (la formattazione oltre la griglia fallisce)."""
+        with self.lock:
+            sheet = self.sheets[title]
+            if rows <= sheet["rowCount"] and columns <= sheet["columnCount"]:
+                return
+            sheet["rowCount"] = max(rows, sheet["rowCount"])
+            sheet["columnCount"] = max(columns, sheet["columnCount"])
+            self.requests.append({
+                "updateSheetProperties": {
+                    "properties": {
+                        "sheetId": sheet["sheetId"],
+                        "gridProperties": {
+                            "rowCount": sheet["rowCount"],
+                            "columnCount": sheet["columnCount"]
+                        }
+                    },
+                    "fields": "gridProperties(rowCount,columnCount)"
+                }
+            })
+
+    def queue_requests(self, requests_list):
+        """Accoda richieste per spreadsheets.batchUpdate."""
+        with self.lock:
+            self.requests.extend(requests_list)
+
+    def clear_rows(self, title, start_row=0, end_row=None, start_column=0):
+        """
+        Accoda la pulizia dei valori (non dei formati) delle righe [start_row, end_row),
+        dalla colonna start_column in poi, 0-based.
+        """
+        grid_range = {"sheetId": self.get_sheet_id(title), "startRowIndex": start_row}
+        if end_row is not None:
+            grid_range["endRowIndex"] = end_row
+        if start_column:
+            grid_range["startColumnIndex"] = start_column
+        self.queue_requests([{
+            "updateCells": {"range": grid_range, "fields": "userEnteredValue"}
+        }])
+
+    def update_values(self, range_name, values):
+        """
+        Accoda la scrittura RAW di un blocco di valori (diviso se supera
+        SHEETS_MAX_REQUEST_BYTES). Ritorna le celle accodate.
+        """
+        parts = split_value_range(range_name, values)
+        with self.lock:
+            self.value_ranges.extend(
+                (size, {"range": part_range, "values": part_values}) for part_range, part_values, size in parts
+            )
+        return sum(len(row) for row in values)
+
+    def prefetch_values(self, titles):
+        """Legge con una sola values.batchGet i valori dei fogli esistenti tra quelli indicati."""
+        titles = [title for title in titles if title in self.sheets]
+        if not titles:
+            return
+        with self.lock:
+            result = self.execute("values.batchGet", self.service.spreadsheets().values().batchGet(
+                spreadsheetId=self.spreadsheet_id,
+                ranges=[f"'{title}'" for title in titles],
+                valueRenderOption="UNFORMATTED_VALUE"
+            ))
+            for title, value_range in zip(titles, result.get("valueRanges", [])):
+                self.values[title] = value_range.get("values", [])
+
+    def get_values(self, title):
+        """Valori attuali del foglio: da prefetch_values o letti al momento."""
+        with self.lock:
+            if title not in self.values:
+                if title not in self.sheets:
+                    return []
+                result = self.execute("values.get", self.service.spreadsheets().values().get(
+                    spreadsheetId=self.spreadsheet_id,
+                    range=f"'{title}'",
+                    valueRenderOption="UNFORMATTED_VALUE"
+                ))
+                self.values[title] = result.get("values", [])
+            return self.values[title]
+
+    def send_requests(self):
+        """Invia subito le richieste spreadsheets.batchUpdate accodate (se presenti)."""
+        with self.lock:
+            requests_list, self.requests = self.requests, []
+            if requests_list:
+                self.execute("spreadsheets.batchUpdate", self.service.spreadsheets().batchUpdate(
+                    spreadsheetId=self.spreadsheet_id,
+                    body={"requests": requests_list}
+                ))
+
+    def write_rows_now(self, title, start_row, values):
+        """
+        Scrive subito un blocco di righe a partire da start_row (0-based), senza
+        accodarlo: usato dalla modalità stream. La griglia viene raddoppiata
+        quando non basta (se le celle dello spreadsheet lo consentono), così gli
+        ampliamenti restano pochi. Ritorna le celle scritte.
+        """
+        with self.lock:
+            sheet = self.sheets[title]
+            rows = start_row + len(values)
+            columns = max(len(row) for row in values)
+            if rows > sheet["rowCount"] and self.grid_fits(title, sheet["rowCount"] * 2, columns):
+                self.ensure_grid(title, max(rows, sheet["rowCount"] * 2), columns)
+            else:
+                self.ensure_grid(title, rows, columns)
+            # addSheet e ampliamenti della griglia devono precedere i valori
+            self.send_requests()
+            self.values.pop(title, None)
+
+            cells = 0
+            for part_range, part_values, _ in split_value_range(f"'{title}'!A{start_row + 1}", values):
+                result = self.execute("values.update", self.service.spreadsheets().values().update(
+                    spreadsheetId=self.spreadsheet_id,
+                    range=part_range,
+                    valueInputOption="RAW",
+                    body={"values": part_values}
+                ))
+                cells += result.get("updatedCells", 0)
+            self.streamed_cells += cells
+            return cells
+
+    def flush(self):
+        """Invia le richieste accodate. Ritorna le celle aggiornate (comprese quelle in stream)."""
+        with self.lock:
+            value_ranges, self.value_ranges = self.value_ranges, []
+            # Dopo la scrittura i valori letti non sono più attuali
+            self.values.clear()
+
+            self.send_requests()
+
+            cells, self.streamed_cells = self.streamed_cells, 0
+            for batch in self.value_batches(value_ranges):
+                result = self.execute("values.batchUpdate", self.service.spreadsheets().values().batchUpdate(
+                    spreadsheetId=self.spreadsheet_id,
+                    body={"valueInputOption": "RAW", "data": batch}
+                ))
+                cells += result.get("totalUpdatedCells", 0)
+            return cells
+
+    @staticmethod
+    def value_batches(value_ranges, max_bytes=SHEETS_MAX_REQUEST_BYTES):
+        """Raggruppa i blocchi accodati in chiamate values.batchUpdate entro max_bytes ciascuna."""
+        batches = []
+        batch_size = 0
+        for size, value_range in value_ranges:
+            if not batches or batch_size + size > max_bytes:
+                batches.append([])
+                batch_size = 0
+            batches[-1].append(value_range)
+            batch_size += size
+        return batches
+
+
+def ensure_sheet_exists(session, sheet_name):
+    """Crea il foglio se non esiste (richiesta accodata nella sessione)."""
+    if session.ensure_sheet(sheet_name):
+        log(f"    Nuovo foglio '{sheet_name}'")
+
+
+def clear_sheet(session, sheet_name):
+    """Pulisce il contenuto del foglio (tutte le colonne, formati esclusi)."""
+    session.clear_rows(sheet_name)
+
+
+def get_sheet_id(session, sheet_name):
+    """Ottiene l'ID del foglio dal nome (dai metadati della sessione)."""
+    return session.get_sheet_id(sheet_name)
+
+
+def format_sheet(session, sheet_name, num_rows, partner_keyword=""):
+    """Applica i formati numerici dello schema (Euro, minuti, giorni) alle colonne."""
+    sheet_id = get_sheet_id(session, sheet_name)
+    if sheet_id is None:
+        return
+
+    requests_list = []
+    for col_idx, column in enumerate(get_columns_for_partner(partner_keyword)):
+        if not column.get("format"):
+            continue
+        requests_list.append({
+            "repeatCell": {
+                "range": {
+                    "sheetId": sheet_id,
+                    "startRowIndex": 1,
+                    "endRowIndex": num_rows + 1,
+                    "startColumnIndex": col_idx,
+                    "endColumnIndex": col_idx + 1
+                },
+                "cell": {
+                    "userEnteredFormat": {
+                        "numberFormat": {
+                            "type": "NUMBER",
+                            "pattern": NUMBER_FORMATS[column["format"]]
+                        }
+                    }
+                },
+                "fields": "userEnteredFormat.numberFormat"
+            }
+        })
+
+    if requests_list:
+        session.queue_requests(requests_list)
+
+
+def write_to_sheets(session, rows, sheet_name, partner_keyword):
+    """Accoda header e righe a partire da A1. Ritorna le celle accodate."""
+    headers = get_headers_for_partner(partner_keyword)
+    data = [headers] + rows
+    session.ensure_grid(sheet_name, len(data), len(headers))
+    return session.update_values(f"'{sheet_name}'!A1", data)
+
+
+def write_stream(session, sheet_name, partner_keyword, pages):
+    """
+    Modalità stream: trasforma le pagine di deal man mano che arrivano e scrive
+    le righe a blocchi di SHEETS_STREAM_CHUNK_ROWS, sovrascrivendo il foglio
+    dall'alto. In memoria restano solo il blocco corrente e le pagine in prefetch.
+    Un foglio pieno (SHEETS_MAX_ROWS_PER_TAB righe o celle dello spreadsheet
+    esaurite) viene chiuso e le righe proseguono nel successivo.
+    Ritorna (celle scritte, righe dati, deal letti, hs_lastmodifieddate massimo).
+    """
+    plan = compile_column_plan(partner_keyword)
+    headers = get_headers_for_partner(partner_keyword)
+    width = len(headers)
+    chunk = []
+    shards = []         # [sessione, titolo, righe, primo Deal ID, ultimo Deal ID]
+    next_row = 0        # prima riga libera (0-based) del foglio corrente
+    cells = 0
+    total_rows = 0
+    deal_count = 0
+    last_modified = None
+
+    def close_tab():
+        target, title, count = shards[-1][:3]
+        # Righe e colonne rimaste dal contenuto precedente (accodate al flush finale)
+        target.clear_rows(title, start_row=next_row)
+        target.clear_rows(title, start_row=0, end_row=next_row, start_column=width)
+        format_sheet(target, title, count, partner_keyword)
+
+    def open_tab(rows):
+        nonlocal next_row
+        if shards:
+            close_tab()
+        title = shard_title(sheet_name, len(shards))
+        shards.append([place_shard(session, title, rows + 1, width), title, 0, "", ""])
+        next_row = 0
+
+    def write_chunk():
+        nonlocal chunk, next_row, cells, total_rows
+        while chunk:
+            # Solo righe dati: l'intestazione non conta nel limite del foglio (come in write_partner_sheet)
+            room = SHEETS_MAX_ROWS_PER_TAB - max(0, next_row - 1)
+            part = chunk[:room]
+            block = [headers] + part if next_row == 0 else part
+            if not shards or room <= 0 or not shards[-1][0].reserve_grid(shards[-1][1], next_row + len(block), width):
+                open_tab(min(len(chunk), SHEETS_MAX_ROWS_PER_TAB))
+                continue
+            shard = shards[-1]
+            cells += shard[0].write_rows_now(shard[1], next_row, block)
+            next_row += len(block)
+            shard[2] += len(part)
+            shard[3] = shard[3] or part[0][0]
+            shard[4] = part[-1][0]
+            total_rows += len(part)
+            chunk = chunk[len(part):]
+
+    for page in pages:
+        deal_count += len(page)
+        chunk.extend(apply_column_plan(plan, page))
+        page_modified = get_last_modified_ms(page)
+        if page_modified and (last_modified is None or page_modified > last_modified):
+            last_modified = page_modified
+        if len(chunk) >= SHEETS_STREAM_CHUNK_ROWS:
+            write_chunk()
+            log(f"    {total_rows} righe scritte su '{shards[-1][1]}'")
+
+    if deal_count == 0:
+        return 0, 0, 0, None
+    write_chunk()
+    close_tab()
+    record_shards(session, partner_keyword, [tuple(shard) for shard in shards])
+    return cells, total_rows, deal_count, last_modified
+
+
+def normalize_row(row, width):
+    """Normalizza una riga per il confronto con i valori letti dal foglio."""
+    normalized = []
+    for value in list(row)[:width]:
+        if value is None:
+            value = ""
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            value = float(value)
+        normalized.append(value)
+    normalized.extend([""] * (width - len(normalized)))
+    return normalized
+
+
+def group_consecutive(positions):
+    """Raggruppa posizioni ordinate in blocchi consecutivi: [[3, 4, 5], [9], ...]."""
+    blocks = []
+    for position in sorted(positions):
+        if blocks and position == blocks[-1][-1] + 1:
+            blocks[-1].append(position)
+        else:
+            blocks.append([position])
+    return blocks
+
+
+def write_delta(session, sheet_name, partner_keyword, rows, existing_values=None, delete_missing=True,
+                remove_ids=()):
+    """
+    Scrive solo le differenze rispetto al contenuto attuale del foglio,
+    usando il Deal ID (prima colonna) come chiave di riga.
+
+    - righe cambiate: riscritte nella loro posizione
+    - righe nuove: occupano prima le posizioni dei deal rimossi, poi vengono accodate
+    - righe rimosse (tutte quelle assenti da rows se delete_missing, altrimenti solo
+      i Deal ID in remove_ids): le ultime righe vengono spostate nei buchi e la coda
+      del foglio viene svuotata, senza riscrivere il resto
+
+    Le scritture sono raggruppate in blocchi di righe consecutive e accodate
+    nella sessione. Se il foglio è vuoto o ha header diversi viene riscritto
+    per intero.
+    existing_values: [header] + righe già lette dal foglio (evita una lettura).
+    Ritorna (celle accodate, righe di dati nel foglio).
+    """
+    headers = get_headers_for_partner(partner_keyword)
+    if existing_values is None:
+        existing_headers, existing_rows = read_sheet_rows(session, sheet_name)
+    else:
+        existing_headers, existing_rows = existing_values[0], existing_values[1:]
+
+    if existing_headers != headers:
+        clear_sheet(session, sheet_name)
+        cells = write_to_sheets(session, rows, sheet_name, partner_keyword)
+        log(f"    Foglio riscritto per intero ({len(rows)} righe)")
+        return cells, len(rows)
+
+    width = len(headers)
+    positions = {}
+    duplicates = []
+    for position, row in enumerate(existing_rows):
+        if row and str(row[0]):
+            if str(row[0]) in positions:
+                duplicates.append(position)
+            else:
+                positions[str(row[0])] = position
+
+    new_rows = {str(row[0]): row for row in rows}
+    writes = {}
+    appended = []
+    updated = 0
+    for deal_id, row in new_rows.items():
+        position = positions.get(deal_id)
+        if position is None:
+            appended.append(row)
+        elif normalize_row(row, width) != normalize_row(existing_rows[position], width):
+            writes[position] = row
+            updated += 1
+
+    # Posizioni libere: righe vuote e deal non più presenti
+    holes = [p for p in range(len(existing_rows)) if not existing_rows[p] or not str(existing_rows[p][0])]
+    holes.extend(duplicates)
+    if delete_missing:
+        holes.extend(p for deal_id, p in positions.items() if deal_id not in new_rows)
+    else:
+        holes.extend(positions[str(deal_id)] for deal_id in remove_ids
+                     if str(deal_id) in positions and str(deal_id) not in new_rows)
+    holes.sort()
+    removed = len(holes)
+
+    # Le righe nuove riempiono prima i buchi, poi vengono accodate
+    next_position = len(existing_rows)
+    for row in appended:
+        if holes:
+            writes[holes.pop(0)] = row
+        else:
+            writes[next_position] = row
+            next_position += 1
+
+    # Buchi rimasti: compatta spostando le ultime righe e svuota la coda
+    final_count = next_position - len(holes)
+    if holes:
+        tail = [
+            p for p in range(final_count, next_position)
+            if p not in holes and p < len(existing_rows)
+        ]
+        for hole, source in zip([h for h in holes if h < final_count], tail):
+            row = writes.pop(source, None)
+            if row is None:
+                row = new_rows.get(str(existing_rows[source][0]), existing_rows[source])
+            writes[hole] = row
+
+    session.ensure_grid(sheet_name, final_count + 1, width)
+    blocks = group_consecutive(writes)
+    cells = 0
+    for block in blocks:
+        cells += session.update_values(
+            f"'{sheet_name}'!A{block[0] + 2}",
+            [list(writes[p]) + [""] * (width - len(writes[p])) for p in block]
+        )
+
+    # Righe in coda non più usate (indici 0-based, +1 per l'header)
+    if final_count < len(existing_rows):
+        session.clear_rows(sheet_name, final_count + 1, len(existing_rows) + 1)
+
+    log(f"    Delta: {updated} righe modificate, {len(appended)} nuove, "
+        f"{removed if delete_missing or remove_ids else 0} rimosse, {len(blocks)} blocchi da scrivere")
+    return cells, final_count
+
+
+def load_sync_state():
+    """Legge i checkpoint incrementali per partner dal file di stato."""
+    try:
+        with open(SYNC_STATE_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_sync_state(state):
+    """Salva i checkpoint su file (scrittura atomica)."""
+    tmp_path = f"{SYNC_STATE_FILE}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, SYNC_STATE_FILE)
+
+
+def get_last_modified_ms(deals):
+    """Ritorna il massimo hs_lastmodifieddate (epoch ms) tra i deal."""
+    last_modified = None
+    for deal in deals:
+        value = date_to_ms(deal.get("properties", {}).get("hs_lastmodifieddate"))
+        if value and (last_modified is None or value > last_modified):
+            last_modified = value
+    return last_modified
+
+
+def read_sheet_rows(session, sheet_name):
+    """Header e righe attuali del foglio (valori non formattati)."""
+    values = session.get_values(sheet_name)
+    if not values:
+        return [], []
+    return values[0], values[1:]
+
+
+STAGE_ENTERED_PREFIX = "hs_v2_date_entered_"
+
+
+def stage_entries_changed(previous, properties):
+    """True se stage attuale o date di ingresso negli stage differiscono dalla versione salvata."""
+    if previous is None:
+        return True
+    return any(
+        previous.get(key) != value
+        for key, value in properties.items()
+        if key == "dealstage" or key.startswith(STAGE_ENTERED_PREFIX)
+    )
+
+
+def observed_stage_entries(previous, properties):
+    """
+    Ingressi negli stage (stage, epoch ms) da registrare nello storico:
+    - le date di ingresso V2 lette da HubSpot
+    - lo stage attuale se nuovo o cambiato rispetto alla versione salvata; senza
+      data di ingresso V2 si usa hs_lastmodifieddate (cambio osservato tra due run)
+    """
+    entries = []
+    for key, value in properties.items():
+        if key.startswith(STAGE_ENTERED_PREFIX) and value:
+            entered_at = date_to_ms(value)
+            if entered_at:
+                entries.append((key[len(STAGE_ENTERED_PREFIX):], entered_at))
+
+    stage = properties.get("dealstage")
+    if stage and (previous is None or previous.get("dealstage") != stage):
+        entered_at = (date_to_ms(properties.get(f"{STAGE_ENTERED_PREFIX}{stage}"))
+                      or date_to_ms(properties.get("hs_lastmodifieddate")))
+        if entered_at:
+            entries.append((stage, entered_at))
+    return entries
+
+
+class DealStore:
+    """
+    Archivio locale dei deal (SQLite), chiave Deal ID.
+
+    Per ogni deal conserva pipeline, partner_label_name, hs_lastmodifieddate e
+    le proprietà grezze lette da HubSpot. Le letture HubSpot vengono unite
+    all'archivio (upsert) e i fogli vengono generati dall'archivio: un cambio di
+    colonne o formati si applica senza riscaricare i deal (--render-from-store).
+    Le scritture avvengono sotto lock perché la connessione è condivisa tra i worker.
+    """
+
+    def __init__(self, path=DEAL_STORE_FILE):
+        self.path = path
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS deals (
+                id INTEGER PRIMARY KEY,
+                pipeline TEXT,
+                partner_label_name TEXT,
+                last_modified INTEGER,
+                properties TEXT NOT NULL,
+                fetched_at INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS deals_pipeline ON deals (pipeline);
+            -- Partner con almeno un export completo nell'archivio
+            CREATE TABLE IF NOT EXISTS synced_partners (
+                partner TEXT PRIMARY KEY,
+                synced_at INTEGER NOT NULL
+            );
+            -- Storico (solo inserimenti) degli ingressi negli stage osservati
+            CREATE TABLE IF NOT EXISTS stage_history (
+                deal_id INTEGER NOT NULL,
+                pipeline TEXT,
+                stage TEXT NOT NULL,
+                entered_at INTEGER NOT NULL,
+                observed_at INTEGER NOT NULL,
+                PRIMARY KEY (deal_id, stage, entered_at)
+            );
+            -- Metriche di funnel per partner, ricalcolate solo se lo storico cambia
+            CREATE TABLE IF NOT EXISTS funnel_stats (
+                partner TEXT NOT NULL,
+                stage TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                deals INTEGER NOT NULL,
+                share REAL,
+                conversion REAL,
+                median_days_in_stage REAL,
+                median_days_from_create REAL,
+                updated_at INTEGER NOT NULL,
+                PRIMARY KEY (partner, stage)
+            );
+            -- Cache dell'arricchimento: azienda dei deal, aziende e owner (valori JSON)
+            CREATE TABLE IF NOT EXISTS lookups (
+                kind TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                fetched_at INTEGER NOT NULL,
+                PRIMARY KEY (kind, key)
+            );
+        """)
+        # (pipeline, partner_label_name) dei deal con nuovi ingressi negli stage in questo run
+        self.dirty_labels = set()
+        # (pipeline, partner_label_name) precedenti dei deal che in questo run hanno
+        # cambiato pipeline o partner: i fogli di quei partner vanno rigenerati
+        self.moved_labels = set()
+
+    def upsert(self, deals):
+        """
+        Inserisce o aggiorna i deal. Le proprietà vengono unite a quelle già
+        salvate (i partner leggono proprietà diverse); una versione più vecchia
+        di quella in archivio viene ignorata. Ritorna i deal scritti.
+        """
+        if not deals:
+            return 0
+        now = int(time.time() * 1000)
+        with self.lock:
+            stored = {}
+            ids = [int(deal["id"]) for deal in deals]
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                cursor = self.conn.execute(
+                    f"SELECT id, properties FROM deals WHERE id IN ({','.join('?' * len(chunk))})", chunk
+                )
+                stored.update((deal_id, json.loads(properties)) for deal_id, properties in cursor)
+
+            records = []
+            history = []
+            for deal_id, deal in zip(ids, deals):
+                previous = stored.get(deal_id)
+                properties = {**(previous or {}), **deal.get("properties", {})}
+                records.append((
+                    deal_id, properties.get("pipeline"), properties.get("partner_label_name"),
+                    date_to_ms(properties.get("hs_lastmodifieddate")), json.dumps(properties), now,
+                ))
+                if previous is not None and (
+                        (previous.get("pipeline"), previous.get("partner_label_name"))
+                        != (properties.get("pipeline"), properties.get("partner_label_name"))):
+                    self.moved_labels.add((previous.get("pipeline"), previous.get("partner_label_name")))
+                if stage_entries_changed(previous, properties):
+                    self.dirty_labels.add((properties.get("pipeline"), properties.get("partner_label_name")))
+                    history.extend(
+                        (deal_id, properties.get("pipeline"), stage, entered_at, now)
+                        for stage, entered_at in observed_stage_entries(previous, properties)
+                    )
+            with self.conn:
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO stage_history (deal_id, pipeline, stage, entered_at, observed_at) "
+                    "VALUES (?, ?, ?, ?, ?)", history
+                )
+                self.conn.executemany("""
+                    INSERT INTO deals (id, pipeline, partner_label_name, last_modified, properties, fetched_at)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (id) DO UPDATE SET
+                        pipeline = excluded.pipeline,
+                        partner_label_name = excluded.partner_label_name,
+                        last_modified = excluded.last_modified,
+                        properties = excluded.properties,
+                        fetched_at = excluded.fetched_at
+                    WHERE COALESCE(excluded.last_modified, 0) >= COALESCE(deals.last_modified, 0)
+                """, records)
+            return len(records)
+
+    def iter_partner_deals(self, pipeline_id, partner_keyword):
+        """Deal del partner in archivio (stesso filtro della Search API), in ordine di ID."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT id, partner_label_name, properties FROM deals WHERE pipeline = ? ORDER BY id",
+                (pipeline_id,)
+            ).fetchall()
+        for deal_id, label, properties in rows:
+            if partner_matches(label, partner_keyword):
+                yield {"id": str(deal_id), "properties": json.loads(properties)}
+
+    def get_deals(self, deal_ids):
+        """Proprietà dei deal in archivio tra quelli indicati: {Deal ID (stringa): proprietà}."""
+        ids = [int(deal_id) for deal_id in deal_ids]
+        deals = {}
+        with self.lock:
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                cursor = self.conn.execute(
+                    f"SELECT id, properties FROM deals WHERE id IN ({','.join('?' * len(chunk))})", chunk
+                )
+                deals.update((str(deal_id), json.loads(properties)) for deal_id, properties in cursor)
+        return deals
+
+    def partner_deal_ids(self, pipeline_id, partner_keyword):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT id, partner_label_name FROM deals WHERE pipeline = ?", (pipeline_id,)
+            ).fetchall()
+        return {deal_id for deal_id, label in rows if partner_matches(label, partner_keyword)}
+
+    def prune_partner(self, pipeline_id, partner_keyword, fetched_ids):
+        """
+        Dopo un export completo rimuove i deal del partner non più restituiti
+        da HubSpot (eliminati o usciti dal filtro). Ritorna i deal rimossi.
+        """
+        with self.lock:
+            fetched_ids = {int(deal_id) for deal_id in fetched_ids}
+            stale = [(deal_id,) for deal_id in self.partner_deal_ids(pipeline_id, partner_keyword)
+                     if deal_id not in fetched_ids]
+            with self.conn:
+                self.conn.executemany("DELETE FROM deals WHERE id = ?", stale)
+            if stale:
+                # Le metriche di funnel non devono più contare i deal rimossi
+                self.dirty_labels.add((pipeline_id, partner_keyword))
+            return len(stale)
+
+    def mark_synced(self, partner_keyword):
+        """Registra l'export completo del partner (condizione per l'incrementale)."""
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO synced_partners (partner, synced_at) VALUES (?, ?)",
+                (partner_keyword, int(time.time() * 1000))
+            )
+
+    def is_synced(self, partner_keyword):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT 1 FROM synced_partners WHERE partner = ?", (partner_keyword,)
+            ).fetchone()
+        return row is not None
+
+    def partner_stage_history(self, pipeline_id, partner_keyword):
+        """
+        Storico degli stage dei deal del partner presenti in archivio:
+        {deal_id: {"created": epoch ms, "entries": [(stage, entered_at), ...] in ordine di tempo}}
+        """
+        with self.lock:
+            rows = self.conn.execute("""
+                SELECT h.deal_id, h.stage, h.entered_at, d.partner_label_name,
+                       json_extract(d.properties, '$.createdate')
+                FROM stage_history h JOIN deals d ON d.id = h.deal_id
+                WHERE d.pipeline = ?
+                ORDER BY h.deal_id, h.entered_at
+            """, (pipeline_id,)).fetchall()
+        history = {}
+        for deal_id, stage, entered_at, label, createdate in rows:
+            if not partner_matches(label, partner_keyword):
+                continue
+            deal = history.setdefault(deal_id, {"created": date_to_ms(createdate), "entries": []})
+            deal["entries"].append((stage, entered_at))
+        return history
+
+    def partner_lost_deals(self, pipeline_id, partner_keyword):
+        """True se in questo run deal del partner sono passati ad altra pipeline o ad altro partner."""
+        with self.lock:
+            return any(pipeline == pipeline_id and partner_matches(label, partner_keyword)
+                       for pipeline, label in self.moved_labels)
+
+    def partner_is_dirty(self, pipeline_id, partner_keyword):
+        """True se in questo run sono entrati in uno stage deal del partner o se mancano le metriche."""
+        with self.lock:
+            if any(pipeline == pipeline_id and partner_matches(label, partner_keyword)
+                   for pipeline, label in self.dirty_labels):
+                return True
+            row = self.conn.execute(
+                "SELECT 1 FROM funnel_stats WHERE partner = ? LIMIT 1", (partner_keyword,)
+            ).fetchone()
+            return row is None
+
+    def save_funnel(self, partner_keyword, metrics):
+        """Sostituisce le metriche di funnel del partner."""
+        now = int(time.time() * 1000)
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM funnel_stats WHERE partner = ?", (partner_keyword,))
+            self.conn.executemany("""
+                INSERT INTO funnel_stats (partner, stage, position, deals, share, conversion,
+                                          median_days_in_stage, median_days_from_create, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, [
+                (partner_keyword, m["stage"], position, m["deals"], m["share"], m["conversion"],
+                 m["median_days_in_stage"], m["median_days_from_create"], now)
+                for position, m in enumerate(metrics)
+            ])
+
+    def load_funnel(self):
+        """Metriche di funnel salvate: {partner: [riga per stage, in ordine]}."""
+        with self.lock:
+            rows = self.conn.execute("""
+                SELECT partner, stage, deals, share, conversion, median_days_in_stage,
+                       median_days_from_create, updated_at
+                FROM funnel_stats ORDER BY partner, position
+            """).fetchall()
+        funnel = {}
+        for partner, stage, deals, share, conversion, in_stage, from_create, updated_at in rows:
+            funnel.setdefault(partner, []).append({
+                "stage": stage, "deals": deals, "share": share, "conversion": conversion,
+                "median_days_in_stage": in_stage, "median_days_from_create": from_create,
+                "updated_at": updated_at,
+            })
+        return funnel
+
+    def get_lookups(self, kind, keys, max_age):
+        """Voci della cache di arricchimento lette da meno di max_age secondi: {chiave: valore}."""
+        keys = list(keys)
+        oldest = int((time.time() - max_age) * 1000)
+        values = {}
+        with self.lock:
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                cursor = self.conn.execute(
+                    f"SELECT key, value FROM lookups WHERE kind = ? AND fetched_at >= ? "
+                    f"AND key IN ({','.join('?' * len(chunk))})", [kind, oldest] + chunk
+                )
+                values.update((key, json.loads(value)) for key, value in cursor)
+        return values
+
+    def save_lookups(self, kind, values):
+        """Inserisce o aggiorna voci della cache di arricchimento ({chiave: valore})."""
+        now = int(time.time() * 1000)
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO lookups (kind, key, value, fetched_at) VALUES (?, ?, ?, ?)",
+                [(kind, key, json.dumps(value), now) for key, value in values.items()]
+            )
+
+    def evict_lookups(self, max_age):
+        """Elimina le voci di arricchimento non più aggiornate da max_age secondi. Ritorna quante."""
+        oldest = int((time.time() - max_age) * 1000)
+        with self.lock, self.conn:
+            return self.conn.execute("DELETE FROM lookups WHERE fetched_at < ?", (oldest,)).rowcount
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+# Arricchimento dei deal con azienda associata e owner, letti con le batch API
+DEAL_COMPANIES_PATH = "/crm/v4/associations/deals/companies/batch/read"
+COMPANIES_BATCH_READ_PATH = "/crm/v3/objects/companies/batch/read"
+OWNERS_PATH = "/crm/v3/owners/"
+PRIMARY_COMPANY_TYPE_ID = 5  # associazione deal -> azienda primaria (HUBSPOT_DEFINED)
+
+# L'elenco owner è unico per l'account: una sola lettura anche con più partner in parallelo
+_owner_lock = threading.Lock()
+
+
+def fetch_deal_companies(deal_ids):
+    """Azienda associata a ogni deal (la primaria, se indicata): {Deal ID: company ID o ""}."""
+    companies = dict.fromkeys(deal_ids, "")
+    for i in range(0, len(deal_ids), HUBSPOT_BATCH_READ_LIMIT):
+        # I deal senza aziende tornano tra gli errori della risposta 207
+        data = hubspot_request("POST", DEAL_COMPANIES_PATH, json_body={
+            "inputs": [{"id": deal_id} for deal_id in deal_ids[i:i + HUBSPOT_BATCH_READ_LIMIT]],
+        })
+        for result in data.get("results", []):
+            targets = result.get("to", [])
+            primary = [
+                target for target in targets
+                if any(kind.get("typeId") == PRIMARY_COMPANY_TYPE_ID for kind in target.get("associationTypes", []))
+            ]
+            if primary or targets:
+                companies[str(result["from"]["id"])] = str((primary or targets)[0]["toObjectId"])
+    return companies
+
+
+def fetch_companies(company_ids):
+    """Campi "company.*" delle aziende indicate: {company ID: {source: valore}}."""
+    empty = dict.fromkeys(COMPANY_PROPERTIES, "")
+    companies = {company_id: empty for company_id in company_ids}
+    for i in range(0, len(company_ids), HUBSPOT_BATCH_READ_LIMIT):
+        data = hubspot_request("POST", COMPANIES_BATCH_READ_PATH, json_body={
+            "properties": list(COMPANY_PROPERTIES.values()),
+            "inputs": [{"id": company_id} for company_id in company_ids[i:i + HUBSPOT_BATCH_READ_LIMIT]],
+        })
+        for company in data.get("results", []):
+            properties = company.get("properties", {})
+            companies[str(company["id"])] = {
+                source: properties.get(name) or "" for source, name in COMPANY_PROPERTIES.items()
+            }
+    return companies
+
+
+def owner_name(owner):
+    """Nome e cognome dell'owner (l'email se mancano)."""
+    return f"{owner.get('firstName') or ''} {owner.get('lastName') or ''}".strip() or owner.get("email") or ""
+
+
+def fetch_owners(owner_ids):
+    """
+    Nomi degli owner dall'elenco owner HubSpot (pagine da HUBSPOT_BATCH_READ_LIMIT):
+    tutti quelli attivi, più gli archiviati se tra gli indicati ne manca qualcuno.
+    Ritorna {owner ID: nome} per tutti gli owner letti.
+    """
+    names = {}
+    for archived in ("false", "true"):
+        after = None
+        while True:
+            params = {"limit": HUBSPOT_BATCH_READ_LIMIT, "archived": archived}
+            if after:
+                params["after"] = after
+            data = hubspot_request("GET", OWNERS_PATH, params=params)
+            names.update((str(owner["id"]), owner_name(owner)) for owner in data.get("results", []))
+            after = data.get("paging", {}).get("next", {}).get("after")
+            if not after:
+                break
+        if set(owner_ids) <= names.keys():
+            break
+    names.update((owner_id, "") for owner_id in owner_ids if owner_id not in names)
+    return names
+
+
+def resolve_lookups(store, kind, keys, fetch):
+    """
+    Valori di arricchimento per le chiavi indicate: dalla cache dell'archivio
+    se letti da meno di ENRICHMENT_CACHE_TTL, altrimenti con fetch(chiavi mancanti),
+    il cui risultato viene salvato in cache. Ritorna {chiave: valore}.
+    """
+    keys = sorted({str(key) for key in keys if key})
+    values = store.get_lookups(kind, keys, ENRICHMENT_CACHE_TTL)
+    missing = [key for key in keys if key not in values]
+    if missing:
+        fetched = fetch(missing)
+        store.save_lookups(kind, fetched)
+        values.update(fetched)
+        count_stat("enrichment_lookups", len(missing))
+    log(f"    Arricchimento {kind}: {len(keys) - len(missing)} dalla cache, {len(missing)} letti da HubSpot")
+    return values
+
+
+def enrich_deals(store, deals, partner_keywords):
+    """
+    Aggiunge alle proprietà dei deal i campi delle colonne di arricchimento
+    dei partner indicati: azienda associata ("company.*") e nome dell'owner ("owner.name").
+    Associazioni, aziende e owner vengono risolti per l'intero insieme di deal
+    con le batch API e memorizzati nell'archivio, condivisi tra partner e run;
+    i campi vengono salvati con il deal, quindi valgono anche per --render-from-store.
+    """
+    kinds = {
+        column["enrichment"]
+        for partner_keyword in partner_keywords
+        for column in get_columns_for_partner(partner_keyword) if "enrichment" in column
+    }
+    if not kinds or not deals:
+        return
+
+    if "company" in kinds:
+        deal_companies = resolve_lookups(store, "deal_company", [deal["id"] for deal in deals], fetch_deal_companies)
+        companies = resolve_lookups(store, "company", deal_companies.values(), fetch_companies)
+        empty = dict.fromkeys(COMPANY_PROPERTIES, "")
+        for deal in deals:
+            company_id = deal_companies.get(str(deal["id"]), "")
+            deal.setdefault("properties", {}).update(companies.get(company_id, empty))
+
+    if "owner" in kinds:
+        owner_ids = [deal.get("properties", {}).get("hubspot_owner_id") for deal in deals]
+        with _owner_lock:
+            owners = resolve_lookups(store, "owner", owner_ids, fetch_owners)
+        for deal in deals:
+            properties = deal.setdefault("properties", {})
+            properties["owner.name"] = owners.get(str(properties.get("hubspot_owner_id") or ""), "")
+
+
+def group_partners_by_pipeline(partners=None):
+    """Raggruppa i partner (default tutti) per pipeline: {pipeline_id: [partner_keyword, ...]}."""
+    groups = {}
+    for partner_keyword in partners or PARTNERS:
+        pipeline_id = PARTNERS[partner_keyword]["pipeline"] or PARTNERSHIP_PIPELINE_ID
+        groups.setdefault(pipeline_id, []).append(partner_keyword)
+    return groups
+
+
+def timeline_stages(partner_keyword):
+    """Stage ID della timeline del partner (le proprietà hs_v2_* presenti nell'archivio)."""
+    return [column["stage"] for column in partner_timeline_columns([partner_keyword]) if "stage" in column]
+
+
+def update_checkpoint(sync_state, partner_keyword, last_modified):
+    """
+    Avanza il checkpoint del partner e registra gli stage della timeline letti.
+    Ritorna True se è cambiato.
+    """
+    checkpoint = sync_state.get(partner_keyword, {})
+    stages = timeline_stages(partner_keyword)
+    if not last_modified or last_modified <= checkpoint.get("last_modified", 0):
+        if not checkpoint.get("last_modified") or checkpoint.get("timeline_stages", []) == stages:
+            return False
+        last_modified = checkpoint["last_modified"]
+    sync_state[partner_keyword] = {
+        "last_modified": last_modified,
+        "last_modified_date": datetime.fromtimestamp(last_modified / 1000, timezone.utc).strftime("%Y-%m-%d %H:%M:%S"),
+        "timeline_stages": stages,
+    }
+    return True
+
+
+def prepare_partner(store, partner_keyword, sync_state, incremental):
+    """
+    Calcola il checkpoint incrementale del partner. Il checkpoint è valido solo
+    se l'archivio contiene già un export completo del partner, da cui vengono
+    generate anche le righe non modificate.
+    Ritorna modified_since (None per l'export completo).
+    """
+    checkpoint = sync_state.get(partner_keyword, {})
+    if not incremental or not checkpoint.get("last_modified"):
+        return None
+
+    if not store.is_synced(partner_keyword):
+        log("Archivio locale senza export completo del partner, export completo")
+        return None
+
+    # Stage nuovi nella timeline: i deal in archivio non hanno le loro proprietà
+    if not set(timeline_stages(partner_keyword)) <= set(checkpoint.get("timeline_stages", [])):
+        log("Nuovi stage nella timeline, export completo")
+        return None
+
+    log(f"Deal modificati dopo {checkpoint.get('last_modified_date')}")
+    return checkpoint["last_modified"] - INCREMENTAL_OVERLAP_MS
+
+
+def complete_partner_sync(store, partner_keyword, fetched_ids):
+    """Dopo un export completo rimuove dall'archivio i deal del partner non più restituiti."""
+    pipeline_id = PARTNERS[partner_keyword]["pipeline"] or PARTNERSHIP_PIPELINE_ID
+    removed = store.prune_partner(pipeline_id, partner_keyword, fetched_ids)
+    if removed:
+        log(f"    {removed} deal rimossi dall'archivio locale")
+    store.mark_synced(partner_keyword)
+
+
+def render_partner(session, store, partner_keyword):
+    """
+    Genera il foglio del partner dai deal in archivio e accoda scrittura e
+    formattazione nella sessione. Ritorna le celle accodate.
+    """
+    # Processa i deal con colonne specifiche per partner
+    rows = partner_rows(store, partner_keyword)
+    cells = write_partner_sheet(session, partner_keyword, rows)
+
+    # Stesse righe alle destinazioni aggiuntive (altri spreadsheet, file locali)
+    write_destinations(store, partner_keyword, rows)
+
+    count_stat("rows", len(rows))
+    count_stat("cells", cells)
+    return cells
+
+
+def partner_rows(store, partner_keyword):
+    """Righe del partner generate dai deal in archivio."""
+    pipeline_id = PARTNERS[partner_keyword]["pipeline"] or PARTNERSHIP_PIPELINE_ID
+    return process_deals(list(store.iter_partner_deals(pipeline_id, partner_keyword)), partner_keyword)
+
+
+def write_partner_sheet(session, partner_keyword, rows):
+    """
+    Accoda nella sessione la scrittura delle righe nel foglio del partner
+    (delta o completa secondo SHEETS_WRITE_MODE) e la formattazione. Oltre
+    SHEETS_MAX_ROWS_PER_TAB righe il partner prosegue nei fogli successivi,
+    ognuno nello spreadsheet scelto da place_shard. Ritorna le celle accodate.
+    """
+    sheet_name = PARTNERS[partner_keyword]["sheet"]
+    width = len(get_headers_for_partner(partner_keyword))
+    # Le righe arrivano in ordine di Deal ID: ogni foglio copre un intervallo di ID
+    chunks = [rows[i:i + SHEETS_MAX_ROWS_PER_TAB] for i in range(0, len(rows), SHEETS_MAX_ROWS_PER_TAB)] or [[]]
+    cells = 0
+    shards = []
+    for index, chunk in enumerate(chunks):
+        title = shard_title(sheet_name, index)
+        target = place_shard(session, title, len(chunk) + 1, width)
+        cells += write_shard(target, title, partner_keyword, chunk)
+        shards.append((target, title, len(chunk), chunk[0][0] if chunk else "", chunk[-1][0] if chunk else ""))
+    record_shards(session, partner_keyword, shards)
+    return cells
+
+
+def write_shard(session, sheet_name, partner_keyword, rows):
+    """Scrive le righe in un foglio già creato e dimensionato, poi lo formatta. Ritorna le celle accodate."""
+    if SHEETS_WRITE_MODE in ("delta", "stream"):
+        # Solo le righe cambiate (anche in modalità stream, che vale solo per
+        # l'export completo letto da HubSpot)
+        cells, num_rows = write_delta(session, sheet_name, partner_keyword, rows)
+    else:
+        # Pulisci foglio esistente
+        clear_sheet(session, sheet_name)
+
+        # Scrivi dati con header specifici per partner
+        cells = write_to_sheets(session, rows, sheet_name, partner_keyword)
+        num_rows = len(rows)
+    log(f"    {cells} celle da scrivere su '{sheet_name}' ({num_rows} righe)")
+
+    # Applica formattazione
+    format_sheet(session, sheet_name, num_rows, partner_keyword)
+    return cells
+
+
+def shard_title(sheet_name, index):
+    """Titolo del foglio index-esimo (0-based) di un partner: "Partner", "Partner (2)", ..."""
+    return sheet_name if index == 0 else f"{sheet_name} ({index + 1})"
+
+
+def partner_shard_titles(session, sheet_name):
+    """Fogli esistenti del partner nello spreadsheet e in quelli di overflow: [(sessione, titolo)]."""
+    pattern = re.compile(re.escape(sheet_name) + r"( \(\d+\))?")
+    return [
+        (target, title)
+        for target in [session] + session.overflow
+        for title in list(target.sheets)
+        if pattern.fullmatch(title)
+    ]
+
+
+def place_shard(session, title, rows, columns):
+    """
+    Sceglie lo spreadsheet del foglio title e ne riserva la griglia di rows x columns:
+    quello che già contiene il foglio se ha spazio, altrimenti il primo con celle
+    libere tra il principale e gli spreadsheet di overflow. Ritorna la sessione scelta.
+    """
+    if columns > SHEETS_MAX_COLUMNS:
+        raise RuntimeError(f"'{title}': {columns} colonne, oltre il limite di {SHEETS_MAX_COLUMNS} di Google Sheets")
+    candidates = sorted([session] + session.overflow, key=lambda target: title not in target.sheets)
+    for target in candidates:
+        is_new = title not in target.sheets
+        if target.reserve_grid(title, rows, columns):
+            if is_new:
+                where = "" if target is session else f" nello spreadsheet {target.spreadsheet_id}"
+                log(f"    Nuovo foglio '{title}'{where}")
+            # Solo i fogli marcati possono essere rimossi da record_shards
+            target.tag_shard(title)
+            return target
+    hint = "anche negli spreadsheet di overflow" if session.overflow else "(vedi OVERFLOW_SPREADSHEET_IDS)"
+    raise RuntimeError(
+        f"Spreadsheet {session.spreadsheet_id}: '{title}' ({rows} righe) supera il limite "
+        f"di {SHEETS_CELL_LIMIT} celle {hint}"
+    )
+
+
+def open_overflow_sessions(session):
+    """Collega alla sessione principale quelle degli spreadsheet di OVERFLOW_SPREADSHEET_IDS."""
+    session.overflow = [
+        SheetsSession(get_google_sheets_service(spreadsheet_id), spreadsheet_id)
+        for spreadsheet_id in OVERFLOW_SPREADSHEET_IDS
+    ]
+
+
+def prefetch_partner_sheets(session, partner_keywords):
+    """Legge i valori di tutti i fogli dei partner con una values.batchGet per spreadsheet."""
+    titles = {}
+    for partner_keyword in partner_keywords:
+        for target, title in partner_shard_titles(session, PARTNERS[partner_keyword]["sheet"]):
+            titles.setdefault(id(target), (target, []))[1].append(title)
+    for target, target_titles in titles.values():
+        target.prefetch_values(target_titles)
+
+
+def record_shards(session, partner_keyword, shards):
+    """
+    Registra i fogli usati dal partner per il foglio indice ed elimina quelli
+    non più usati (meno righe di prima o foglio spostato in un altro spreadsheet).
+    Vengono rimossi solo il foglio del partner e i fogli marcati da tag_shard:
+    un foglio "Partner (2)" creato a mano (es. con "Duplica") resta.
+    shards: [(sessione, titolo, righe, primo Deal ID, ultimo Deal ID)].
+    """
+    sheet_name = PARTNERS[partner_keyword]["sheet"]
+    used = {(id(target), title) for target, title, *_ in shards}
+    for target, title in partner_shard_titles(session, sheet_name):
+        if (id(target), title) in used:
+            continue
+        if title != sheet_name and not target.sheets[title].get("shard"):
+            continue
+        if len(target.sheets) == 1:
+            # Uno spreadsheet non può restare senza fogli: viene solo svuotato
+            target.clear_rows(title)
+        else:
+            target.delete_sheet(title)
+        log(f"    Foglio '{title}' non più usato rimosso ({target.spreadsheet_id})")
+    session.shards[partner_keyword] = [
+        (target.spreadsheet_id, title, count, first_id, last_id)
+        for target, title, count, first_id, last_id in shards
+    ]
+
+
+SHARD_INDEX_HEADERS = ["Partner", "Foglio", "Spreadsheet", "Righe", "Primo Deal ID", "Ultimo Deal ID", "Aggiornato il"]
+
+
+def update_shard_index(session):
+    """
+    Accoda la riscrittura del foglio SHEETS_INDEX_SHEET con i fogli di ogni
+    partner. Il foglio viene creato solo quando un partner occupa più fogli o
+    uno spreadsheet di overflow; le righe dei partner non scritti nel run restano.
+    Ritorna le celle accodate.
+    """
+    if not session.shards:
+        return 0
+    split = any(
+        len(shards) > 1 or shards[0][0] != session.spreadsheet_id
+        for shards in session.shards.values()
+    )
+    if not split and SHEETS_INDEX_SHEET not in session.sheets:
+        return 0
+
+    existing_headers, existing_rows = read_sheet_rows(session, SHEETS_INDEX_SHEET)
+    rows = []
+    if existing_headers == SHARD_INDEX_HEADERS:
+        rows = [row for row in existing_rows if row and row[0] not in session.shards]
+    updated_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    for partner_keyword, shards in session.shards.items():
+        for spreadsheet_id, title, count, first_id, last_id in shards:
+            rows.append([
+                partner_keyword, title, f"https://docs.google.com/spreadsheets/d/{spreadsheet_id}",
+                count, first_id, last_id, updated_at,
+            ])
+    order = {partner_keyword: position for position, partner_keyword in enumerate(PARTNERS)}
+    rows.sort(key=lambda row: order.get(row[0], len(order)))
+
+    data = [SHARD_INDEX_HEADERS] + rows
+    is_new = SHEETS_INDEX_SHEET not in session.sheets
+    if not session.reserve_grid(SHEETS_INDEX_SHEET, len(data), len(SHARD_INDEX_HEADERS)):
+        print(f"  Foglio '{SHEETS_INDEX_SHEET}' non aggiornato: spreadsheet al limite di {SHEETS_CELL_LIMIT} celle",
+              flush=True)
+        return 0
+    if is_new:
+        print(f"  Nuovo foglio '{SHEETS_INDEX_SHEET}'", flush=True)
+    clear_sheet(session, SHEETS_INDEX_SHEET)
+    return session.update_values(f"'{SHEETS_INDEX_SHEET}'!A1", data)
+
+
+# Destinazioni aggiuntive: le righe generate una volta per partner vengono
+# scritte anche in altri spreadsheet e in file locali
+class SheetsDestination:
+    """
+    Spreadsheet aggiuntivo (copia interna con tutti i partner o spreadsheet di
+    un partner): riceve le stesse righe del principale, con la stessa scrittura
+    delta o completa, in una sessione propria inviata a fine run.
+    """
+
+    uses_rows = True
+
+    def __init__(self, spreadsheet_id, partners):
+        self.name = f"spreadsheet {spreadsheet_id}"
+        self.spreadsheet_id = spreadsheet_id
+        self.partners = partners
+        self.session = None
+
+    def open(self, prefetch):
+        self.session = SheetsSession(get_google_sheets_service(self.spreadsheet_id), self.spreadsheet_id)
+        if prefetch:
+            prefetch_partner_sheets(self.session, self.partners)
+
+    def write_partner(self, store, partner_keyword, rows):
+        return write_partner_sheet(self.session, partner_keyword, rows)
+
+    def flush(self):
+        return self.session.flush()
+
+
+class FileDestination:
+    """
+    File CSV locali in EXPORT_DIR (UTF-8, con header), uno per partner (nome
+    del foglio), con gli stessi valori del foglio. Ogni run riscrive il file
+    intero con scrittura atomica. Per la BI i valori tipizzati sono nell'export
+    colonnare (ColumnarDestination), l'unico a scrivere Parquet.
+    """
+
+    uses_rows = True
+
+    def __init__(self, directory, file_format, partners):
+        if file_format == "parquet":
+            raise ValueError("Parquet non è più un formato di EXPORT_FORMATS: usa COLUMNAR_EXPORT_DIR "
+                             "(COLUMNAR_FORMAT=parquet) per l'export tipizzato")
+        if file_format != "csv":
+            raise ValueError(f"Formato di export non supportato: {file_format}")
+        self.name = f"{file_format} {directory}"
+        self.directory = directory
+        self.file_format = file_format
+        self.partners = partners
+
+    def open(self, prefetch):
+        os.makedirs(self.directory, exist_ok=True)
+
+    def write_partner(self, store, partner_keyword, rows):
+        headers = get_headers_for_partner(partner_keyword)
+        path = os.path.join(self.directory, f"{PARTNERS[partner_keyword]['sheet']}.{self.file_format}")
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(headers)
+            writer.writerows(rows)
+        os.replace(tmp_path, path)
+        return len(rows) * len(headers)
+
+    def flush(self):
+        # I file vengono scritti subito da write_partner
+        return 0
+
+
+def ms_to_iso(ms):
+    """Epoch ms -> istante ISO 8601 UTC con millisecondi (2024-01-31T10:00:00.000Z)."""
+    return datetime.fromtimestamp(ms // 1000, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S") + f".{ms % 1000:03d}Z"
+
+
+def ms_to_month(ms):
+    return datetime.fromtimestamp(ms // 1000, timezone.utc).strftime("%Y-%m") if ms is not None else "unknown"
+
+
+class ParquetChunkWriter:
+    """File Parquet scritto un row group per blocco di righe, con schema tipizzato."""
+
+    def __init__(self, path, names, types):
+        arrow_types = {
+            "int": pyarrow.int64(), "float": pyarrow.float64(), "string": pyarrow.string(),
+            "timestamp": pyarrow.timestamp("ms", tz="UTC"),
+        }
+        self.schema = pyarrow.schema([(name, arrow_types[column_type]) for name, column_type in zip(names, types)])
+        self.writer = pq.ParquetWriter(path, self.schema, compression="zstd")
+
+    def write(self, columns):
+        self.writer.write_table(pyarrow.Table.from_arrays(
+            [pyarrow.array(values, type=field.type) for values, field in zip(columns, self.schema)],
+            schema=self.schema
+        ))
+
+    def close(self):
+        self.writer.close()
+
+
+class CsvGzChunkWriter:
+    """CSV compresso con gzip: istanti in ISO 8601 UTC, nulli come campo vuoto."""
+
+    def __init__(self, path, names, types):
+        self.file = gzip.open(path, "wt", newline="", encoding="utf-8")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(names)
+        self.timestamps = [column_type == "timestamp" for column_type in types]
+
+    def write(self, columns):
+        columns = [
+            [ms_to_iso(value) if value is not None else None for value in values] if is_timestamp else values
+            for values, is_timestamp in zip(columns, self.timestamps)
+        ]
+        self.writer.writerows(zip(*columns))
+
+    def close(self):
+        self.file.close()
+
+
+COLUMNAR_WRITERS = {"parquet": ParquetChunkWriter, "csv.gz": CsvGzChunkWriter}
+
+
+class ColumnarDestination:
+    """
+    Export colonnare per la BI in COLUMNAR_EXPORT_DIR: valori tipizzati (interi,
+    decimali, istanti UTC, stringhe) in Parquet o CSV compresso, partizionati
+    alla Hive per partner e mese di creazione
+    (partner=Attitude/created_month=2024-02/part-0.parquet). I deal vengono letti
+    dall'archivio e scritti a blocchi di COLUMNAR_CHUNK_ROWS con un writer aperto
+    per partizione, quindi in memoria resta un solo blocco di righe tipizzate.
+    La cartella del partner viene scritta accanto a quella attuale e poi
+    sostituita: chi legge vede sempre un export completo.
+    """
+
+    uses_rows = False
+
+    def __init__(self, directory, file_format, partners):
+        if file_format not in COLUMNAR_WRITERS:
+            raise ValueError(f"Formato colonnare non supportato: {file_format} (parquet o csv.gz)")
+        self.name = f"colonnare {file_format} {directory}"
+        self.directory = directory
+        self.file_format = file_format
+        self.partners = partners
+
+    def open(self, prefetch):
+        if self.file_format == "parquet" and pq is None:
+            raise RuntimeError("L'export Parquet richiede pyarrow (pip install pyarrow)")
+        os.makedirs(self.directory, exist_ok=True)
+
+    def write_partner(self, store, partner_keyword, rows):
+        pipeline_id = PARTNERS[partner_keyword]["pipeline"] or PARTNERSHIP_PIPELINE_ID
+        plan = compile_typed_plan(partner_keyword)
+        names = [name for name, _, _ in plan]
+        types = [column_type for _, column_type, _ in plan]
+        created = names.index("deal_create_date")
+
+        target = os.path.join(self.directory, f"partner={PARTNERS[partner_keyword]['sheet']}")
+        staging = f"{target}.tmp"
+        shutil.rmtree(staging, ignore_errors=True)
+        writers = {}
+        count = 0
+        try:
+            deals = store.iter_partner_deals(pipeline_id, partner_keyword)
+            while True:
+                chunk = [deal for _, deal in zip(range(COLUMNAR_CHUNK_ROWS), deals)]
+                if not chunk:
+                    break
+                count += len(chunk)
+                props_list = [deal.get("properties", {}) for deal in chunk]
+                columns = [extract(chunk, props_list) for _, _, extract in plan]
+
+                # Righe del blocco per mese di creazione, una scrittura per partizione
+                partitions = {}
+                for position, month in enumerate(map(ms_to_month, columns[created])):
+                    partitions.setdefault(month, []).append(position)
+                for month, positions in partitions.items():
+                    if month not in writers:
+                        folder = os.path.join(staging, f"created_month={month}")
+                        os.makedirs(folder)
+                        writers[month] = COLUMNAR_WRITERS[self.file_format](
+                            os.path.join(folder, f"part-0.{self.file_format}"), names, types
+                        )
+                    writers[month].write([[values[p] for p in positions] for values in columns])
+        finally:
+            for writer in writers.values():
+                writer.close()
+
+        # Sostituisce la cartella del partner (anche senza deal: export vuoto)
+        os.makedirs(staging, exist_ok=True)
+        previous = f"{target}.old"
+        shutil.rmtree(previous, ignore_errors=True)
+        if os.path.exists(target):
+            os.replace(target, previous)
+        os.replace(staging, target)
+        shutil.rmtree(previous, ignore_errors=True)
+        log(f"    {count} deal in {len(writers)} partizioni ({self.file_format})")
+        return count * len(names)
+
+    def flush(self):
+        # I file vengono scritti subito da write_partner
+        return 0
+
+
+# Destinazioni aggiuntive del run in corso (aperte da connect_sheets)
+_run_destinations = []
+
+
+def configured_destinations(partners):
+    """Destinazioni aggiuntive configurate che ricevono almeno uno dei partner del run."""
+    destinations = [SheetsDestination(spreadsheet_id, list(partners)) for spreadsheet_id in MIRROR_SPREADSHEET_IDS]
+    own_spreadsheets = {}
+    for partner_keyword in partners:
+        spreadsheet_id = PARTNERS[partner_keyword].get("spreadsheet_id")
+        if spreadsheet_id:
+            own_spreadsheets.setdefault(spreadsheet_id, []).append(partner_keyword)
+    destinations += [SheetsDestination(spreadsheet_id, keywords) for spreadsheet_id, keywords in own_spreadsheets.items()]
+    if EXPORT_DIR:
+        destinations += [FileDestination(EXPORT_DIR, file_format, list(partners)) for file_format in EXPORT_FORMATS]
+    if COLUMNAR_EXPORT_DIR:
+        destinations.append(ColumnarDestination(COLUMNAR_EXPORT_DIR, COLUMNAR_FORMAT, list(partners)))
+    return destinations
+
+
+def open_destinations(partners, prefetch):
+    """Apre in parallelo le destinazioni aggiuntive del run (metadati e valori attuali)."""
+    destinations = configured_destinations(partners)
+    _run_destinations[:] = destinations
+    if not destinations:
+        return
+    with ThreadPoolExecutor(max_workers=len(destinations)) as executor:
+        list(executor.map(lambda destination: destination.open(prefetch), destinations))
+    print(f"  Destinazioni aggiuntive: {', '.join(destination.name for destination in destinations)}", flush=True)
+
+
+def partner_destinations(partner_keyword):
+    return [destination for destination in _run_destinations if partner_keyword in destination.partners]
+
+
+def write_destinations(store, partner_keyword, rows=None):
+    """
+    Scrive (o accoda) il partner in tutte le sue destinazioni aggiuntive. Le righe
+    del foglio vengono generate dall'archivio solo se mancano e servono.
+    """
+    for destination in partner_destinations(partner_keyword):
+        with timed_phase("destinations"):
+            if rows is None and destination.uses_rows:
+                rows = partner_rows(store, partner_keyword)
+            cells = destination.write_partner(store, partner_keyword, rows)
+        log(f"    {cells} celle per {destination.name}")
+        count_stat("destination_cells", cells)
+
+
+def flush_with_destinations(session):
+    """
+    Invia in parallelo le scritture accodate dello spreadsheet principale (con i
+    suoi spreadsheet di overflow) e delle destinazioni aggiuntive.
+    Ritorna le celle aggiornate nel principale e negli overflow.
+    """
+    destinations = list(_run_destinations)
+    _run_destinations.clear()
+    if not destinations and not session.overflow:
+        return session.flush()
+    with ThreadPoolExecutor(max_workers=len(destinations) + len(session.overflow) + 1) as executor:
+        primary = [executor.submit(target.flush) for target in [session] + session.overflow]
+        futures = [(destination, executor.submit(destination.flush)) for destination in destinations]
+        for destination, future in futures:
+            cells = future.result()
+            if cells:
+                print(f"  {destination.name}: {cells} celle aggiornate", flush=True)
+        return sum(future.result() for future in primary)
+
+
+FUNNEL_HEADERS = [
+    "Partner", "Stage", "Deal entrati", "% sui deal del partner",
+    "Conversione dallo stage precedente", "Mediana giorni nello stage",
+    "Mediana giorni dalla creazione", "Aggiornato il",
+]
+DAY_MS = 24 * 3600 * 1000
+
+
+def compute_funnel(history, stage_ids):
+    """
+    Metriche di funnel per stage, nell'ordine della pipeline:
+    deal entrati, quota sui deal del partner, conversione dallo stage
+    precedente, mediana dei giorni nello stage (fino all'ingresso successivo)
+    e mediana dei giorni dalla creazione del deal al primo ingresso.
+    """
+    entered = {}
+    days_in_stage = {}
+    days_from_create = {}
+    for deal in history.values():
+        entries = deal["entries"]
+        first_entry = {}
+        for i, (stage, entered_at) in enumerate(entries):
+            first_entry.setdefault(stage, entered_at)
+            if i + 1 < len(entries):
+                days_in_stage.setdefault(stage, []).append((entries[i + 1][1] - entered_at) / DAY_MS)
+        for stage, entered_at in first_entry.items():
+            entered[stage] = entered.get(stage, 0) + 1
+            if deal["created"]:
+                days_from_create.setdefault(stage, []).append((entered_at - deal["created"]) / DAY_MS)
+
+    # Stage fuori dalla pipeline (es. pipeline cambiata) in coda
+    ordered = list(stage_ids) + sorted(stage for stage in entered if stage not in stage_ids)
+    total = len(history)
+    metrics = []
+    previous = None
+    for stage in ordered:
+        count = entered.get(stage, 0)
+        metrics.append({
+            "stage": stage,
+            "deals": count,
+            "share": count / total if total else None,
+            "conversion": count / previous if previous else None,
+            "median_days_in_stage": round(median(days_in_stage[stage]), 2) if stage in days_in_stage else None,
+            "median_days_from_create": round(median(days_from_create[stage]), 2) if stage in days_from_create else None,
+        })
+        previous = count
+    return metrics
+
+
+def update_funnel(session, store, partner_keywords):
+    """
+    Ricalcola le metriche dei partner con nuovi ingressi negli stage e
+    accoda la riscrittura del foglio FUNNEL_SHEET con quelle di tutti i partner.
+    """
+    for partner_keyword in partner_keywords:
+        pipeline_id = PARTNERS[partner_keyword]["pipeline"] or PARTNERSHIP_PIPELINE_ID
+        if not store.partner_is_dirty(pipeline_id, partner_keyword):
+            continue
+        history = store.partner_stage_history(pipeline_id, partner_keyword)
+        if history:
+            store.save_funnel(partner_keyword, compute_funnel(history, PIPELINE_STAGES.get(pipeline_id, [])))
+            print(f"  Funnel {partner_keyword}: {len(history)} deal con storico", flush=True)
+
+    rows = []
+    for partner_keyword, metrics in store.load_funnel().items():
+        for m in metrics:
+            rows.append([
+                partner_keyword, STAGE_LABELS.get(m["stage"], m["stage"]), m["deals"],
+                m["share"] if m["share"] is not None else "",
+                m["conversion"] if m["conversion"] is not None else "",
+                m["median_days_in_stage"] if m["median_days_in_stage"] is not None else "",
+                m["median_days_from_create"] if m["median_days_from_create"] is not None else "",
+                datetime.fromtimestamp(m["updated_at"] / 1000).strftime("%Y-%m-%d %H:%M:%S"),
+            ])
+    if not rows:
+        return 0
+
+    ensure_sheet_exists(session, FUNNEL_SHEET)
+    clear_sheet(session, FUNNEL_SHEET)
+    data = [FUNNEL_HEADERS] + rows
+    session.ensure_grid(FUNNEL_SHEET, len(data), len(FUNNEL_HEADERS))
+    cells = session.update_values(f"'{FUNNEL_SHEET}'!A1", data)
+
+    sheet_id = get_sheet_id(session, FUNNEL_SHEET)
+    formats = {3: ("PERCENT", "0.0%"), 4: ("PERCENT", "0.0%"), 5: ("NUMBER", '0.00"d"'), 6: ("NUMBER", '0.00"d"')}
+    session.queue_requests([{
+        "repeatCell": {
+            "range": {
+                "sheetId": sheet_id,
+                "startRowIndex": 1,
+                "endRowIndex": len(data),
+                "startColumnIndex": col_idx,
+                "endColumnIndex": col_idx + 1
+            },
+            "cell": {"userEnteredFormat": {"numberFormat": {"type": number_type, "pattern": pattern}}},
+            "fields": "userEnteredFormat.numberFormat"
+        }
+    } for col_idx, (number_type, pattern) in formats.items()])
+    return cells
+
+
+def stream_partner(session, store, partner_keyword, pages):
+    """
+    Export completo di un partner in modalità stream: le pagine vengono salvate
+    nell'archivio mentre passano. Ritorna (celle, hs_lastmodifieddate massimo).
+    """
+    sheet_name = PARTNERS[partner_keyword]["sheet"]
+    fetched_ids = []
+
+    def stored_pages():
+        for page in pages:
+            enrich_deals(store, page, [partner_keyword])
+            store.upsert(page)
+            fetched_ids.extend(deal["id"] for deal in page)
+            yield page
+
+    # Lettura, archivio e scrittura sono interlacciati: un'unica fase
+    with timed_phase("stream"):
+        cells, num_rows, deal_count, last_modified = write_stream(
+            session, sheet_name, partner_keyword, stored_pages()
+        )
+    log(f"{deal_count} deal trovati")
+    count_stat("deals", deal_count)
+
+    if deal_count == 0:
+        log(f"Nessun deal per {partner_keyword}, skip.")
+        return 0, None
+    complete_partner_sync(store, partner_keyword, fetched_ids)
+
+    log(f"    {cells} celle scritte su '{sheet_name}' ({num_rows} righe)")
+
+    # Le destinazioni aggiuntive ricevono le righe generate dall'archivio appena aggiornato
+    write_destinations(store, partner_keyword)
+    count_stat("rows", deal_count)
+    count_stat("cells", cells)
+    return cells, last_modified
+
+
+def run_partner_export(session, store, partner_keyword, modified_since, partner_deals=None):
+    """
+    Export di un partner, eseguito in un worker del thread pool: lettura da
+    HubSpot (se partner_deals non è già valorizzato dalla ricerca combinata) e
+    salvataggio nell'archivio. In modalità stream il foglio viene anche scritto.
+    Ritorna (foglio da generare, hs_lastmodifieddate massimo).
+    """
+    with partner_context(partner_keyword):
+        pipeline_id = PARTNERS[partner_keyword]["pipeline"] or PARTNERSHIP_PIPELINE_ID
+        log(f"Pipeline: {pipeline_id}")
+
+        # Stream: lettura, trasformazione e scrittura a blocchi (solo export completo)
+        if SHEETS_WRITE_MODE == "stream" and not modified_since:
+            pages = [partner_deals] if partner_deals is not None else iter_partner_pages(pipeline_id, partner_keyword)
+            _, last_modified = stream_partner(session, store, partner_keyword, pages)
+            return False, last_modified
+
+        # Recupera deal direttamente con filtro API per pipeline e partner
+        if partner_deals is None:
+            with timed_phase("fetch"):
+                partner_deals = get_deals_for_partner(pipeline_id, partner_keyword, modified_since)
+        return store_partner_deals(store, partner_keyword, partner_deals, modified_since)
+
+
+def store_partner_deals(store, partner_keyword, partner_deals, modified_since):
+    """
+    Salva nell'archivio i deal letti per il partner. Il foglio viene generato
+    da render_partners() dopo i salvataggi di tutti i partner.
+    Ritorna (foglio da generare, hs_lastmodifieddate massimo).
+    """
+    log(f"{len(partner_deals)} deal trovati")
+    count_stat("deals", len(partner_deals))
+
+    if len(partner_deals) == 0:
+        if modified_since:
+            log(f"Nessuna modifica per {partner_keyword}, skip.")
+        else:
+            log(f"Nessun deal per {partner_keyword}, skip.")
+        return False, None
+
+    with timed_phase("enrich"):
+        enrich_deals(store, partner_deals, [partner_keyword])
+
+    with timed_phase("store"):
+        store.upsert(partner_deals)
+        if not modified_since:
+            complete_partner_sync(store, partner_keyword, [deal["id"] for deal in partner_deals])
+    return True, get_last_modified_ms(partner_deals)
+
+
+def partners_to_render(store, pending):
+    """
+    Partner i cui fogli vanno generati dopo i salvataggi del run: quelli con deal
+    letti (pending) e quelli, anche fuori dal run, da cui un deal è passato ad
+    altra pipeline o ad altro partner (altrimenti la riga resterebbe nel foglio
+    di prima fino all'export completo successivo).
+    """
+    moved = [
+        partner_keyword for partner_keyword in PARTNERS
+        if partner_keyword not in pending
+        and store.partner_lost_deals(PARTNERS[partner_keyword]["pipeline"] or PARTNERSHIP_PIPELINE_ID, partner_keyword)
+    ]
+    for partner_keyword in moved:
+        print(f"  [{partner_keyword}] Deal passati ad altro partner o pipeline, foglio da rigenerare", flush=True)
+    return list(pending) + moved
+
+
+def render_partner_from_store(session, store, partner_keyword):
+    """Rigenera il foglio del partner dall'archivio, senza chiamate HubSpot."""
+    with partner_context(partner_keyword):
+        if not store.is_synced(partner_keyword):
+            log(f"Nessun export completo di {partner_keyword} in archivio, skip.")
+            return 0
+        with timed_phase("render"):
+            return render_partner(session, store, partner_keyword)
+
+
+def print_run_header(incremental=False, render_from_store=False, async_mode=False, partners=None):
+    print("=" * 50, flush=True)
+    print(f"HubSpot to Google Sheets - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", flush=True)
+    if partners and len(partners) < len(PARTNERS):
+        print(f"Partner: {', '.join(partners)}", flush=True)
+    if incremental:
+        print("Modalità incrementale", flush=True)
+    if render_from_store:
+        print(f"Rigenerazione fogli dall'archivio locale ({DEAL_STORE_FILE})", flush=True)
+    if async_mode:
+        print(f"Modalità asincrona ({ASYNC_MAX_CONNECTIONS} connessioni HubSpot)", flush=True)
+    print("=" * 50, flush=True)
+
+    with ENDPOINT_STATS_LOCK:
+        ENDPOINT_STATS.clear()
+    # Un solo "adesso" per tutte le durate calcolate nel run
+    set_run_clock()
+
+
+def load_labels():
+    """Label degli stage e delle proprietà enumerate (dalla cache se valida)."""
+    with timed_phase("labels"):
+        print("\n[1/3] Caricamento stage...", flush=True)
+        load_stage_labels()
+        print(f"  {len(STAGE_LABELS)} stage caricati", flush=True)
+
+        print("\n[2/3] Caricamento label proprietà...", flush=True)
+        load_property_labels()
+        for name, labels in PROPERTY_LABELS.items():
+            print(f"  {name}: {len(labels)} label", flush=True)
+
+
+def connect_sheets(prefetch, partners=None):
+    """Apre la sessione Sheets; con prefetch legge i valori dei fogli dei partner del run."""
+    with timed_phase("sheets_connect"):
+        print("\n[3/3] Connessione a Google Sheets...", flush=True)
+        session = SheetsSession(get_google_sheets_service())
+        print(f"  Connesso! {len(session.sheets)} fogli", flush=True)
+        open_overflow_sessions(session)
+        if session.overflow:
+            print(f"  Spreadsheet di overflow: {', '.join(OVERFLOW_SPREADSHEET_IDS)}", flush=True)
+
+        # Valori attuali di tutti i fogli partner con una sola lettura per spreadsheet
+        if prefetch:
+            prefetch_partner_sheets(session, partners or PARTNERS)
+
+        open_destinations(partners or list(PARTNERS), prefetch)
+    return session
+
+
+def finish_export(session, store, sync_state, last_modified, partners):
+    """Funnel, scrittura della sessione, checkpoint e riepilogo di fine run."""
+    # Metriche di funnel dallo storico degli stage (solo partner con novità)
+    print(f"\nFunnel ({FUNNEL_SHEET})...", flush=True)
+    with timed_phase("funnel"):
+        update_funnel(session, store, partners)
+    evicted = store.evict_lookups(ENRICHMENT_CACHE_MAX_AGE)
+    if evicted:
+        print(f"  {evicted} voci di arricchimento scadute eliminate", flush=True)
+    store.close()
+    update_shard_index(session)
+
+    # Tutte le scritture e formattazioni in due chiamate
+    print("\nScrittura su Google Sheets...", flush=True)
+    with timed_phase("sheets_write"):
+        total_cells = flush_with_destinations(session)
+    count_stat("cells_updated", total_cells)
+
+    # Aggiorna i checkpoint solo dopo la scrittura riuscita
+    changed = [
+        update_checkpoint(sync_state, partner_keyword, value)
+        for partner_keyword, value in last_modified.items()
+    ]
+    if any(changed):
+        save_sync_state(sync_state)
+
+    # Le label scadute vengono aggiornate in background: attende prima di uscire
+    wait_label_refresh()
+
+    print_phase_timings()
+    print_endpoint_stats()
+
+    print("\n" + "=" * 50, flush=True)
+    print(f"FATTO! {total_cells} celle totali aggiornate", flush=True)
+    print(f"https://docs.google.com/spreadsheets/d/{GOOGLE_SHEET_ID}", flush=True)
+    print("=" * 50, flush=True)
+
+
+def prepare_partners(store, sync_state, incremental, partners=None):
+    """Checkpoint incrementali dei partner (default tutti): {partner_keyword: modified_since o None}."""
+    plans = {}
+    for partner_keyword in partners or PARTNERS:
+        with partner_context(partner_keyword):
+            plans[partner_keyword] = prepare_partner(store, partner_keyword, sync_state, incremental)
+    return plans
+
+
+def run_export(incremental=False, combined=False, render_from_store=False, partners=None):
+    """
+    Esegue l'export completo.
+    Con incremental=True scarica solo i deal modificati dopo il checkpoint del
+    partner e li unisce all'archivio locale, da cui viene generato l'intero
+    foglio. I deal usciti dal filtro partner/pipeline vengono rimossi solo
+    dall'export completo.
+    Con combined=True esegue una sola Search API per pipeline invece di una
+    per partner e smista i deal in locale.
+    Con render_from_store=True i fogli vengono rigenerati dall'archivio locale
+    senza leggere deal da HubSpot (checkpoint invariati).
+    Con partners vengono esportati solo i partner indicati, in quell'ordine.
+    I partner vengono esportati in parallelo da EXPORT_WORKERS thread che
+    condividono i rate limiter HubSpot.
+    """
+    partners = list(partners or PARTNERS)
+    with run_telemetry(incremental=incremental, combined=combined,
+                       render_from_store=render_from_store, async_mode=False, partners=partners):
+        print_run_header(incremental, render_from_store, partners=partners)
+        load_labels()
+        session = connect_sheets(
+            SHEETS_WRITE_MODE == "delta" or (SHEETS_WRITE_MODE == "stream" and (incremental or render_from_store)),
+            partners
+        )
+
+        store = DealStore()
+        print(f"\nExport per partner ({EXPORT_WORKERS} in parallelo)...", flush=True)
+        sync_state = load_sync_state()
+        deals_by_partner = {}
+        last_modified = {}
+
+        with timed_phase("partners"), ThreadPoolExecutor(max_workers=max(1, EXPORT_WORKERS)) as executor:
+            if render_from_store:
+                list(executor.map(lambda k: render_partner_from_store(session, store, k), partners))
+            else:
+                # Checkpoint incrementali (None = export completo)
+                plans = prepare_partners(store, sync_state, incremental, partners)
+
+                # Ricerca combinata: una Search API per pipeline, smistamento in locale
+                if combined:
+                    groups = group_partners_by_pipeline(partners)
+                    for pipeline_id, keywords in groups.items():
+                        print(f"  Ricerca combinata pipeline {pipeline_id}: {', '.join(keywords)}", flush=True)
+                    with timed_phase("fetch_combined"):
+                        for partner_deals in executor.map(
+                            lambda group: get_deals_for_pipeline(group[0], {k: plans[k] for k in group[1]}),
+                            groups.items()
+                        ):
+                            deals_by_partner.update(partner_deals)
+
+                # Un task per partner: fetch (se non già fatto), archivio, scrittura e formattazione
+                futures = {
+                    executor.submit(
+                        run_partner_export, session, store, partner_keyword,
+                        plans[partner_keyword], deals_by_partner.get(partner_keyword)
+                    ): partner_keyword
+                    for partner_keyword in partners
+                }
+                pending = []
+                for future in as_completed(futures):
+                    render, last_modified[futures[future]] = future.result()
+                    if render:
+                        pending.append(futures[future])
+
+                # Fogli generati dopo tutti i salvataggi, così i deal che hanno cambiato
+                # partner escono anche dal foglio del partner precedente
+                to_render = partners_to_render(store, [k for k in partners if k in pending])
+                list(executor.map(lambda k: render_partner_from_store(session, store, k), to_render))
+
+        finish_export(session, store, sync_state, last_modified, partners)
+
+
+async def run_export_async(incremental=False, combined=False, partners=None):
+    """
+    Come run_export(), su un unico event loop: le chiamate HubSpot usano un
+    client httpx asincrono (al massimo ASYNC_MAX_CONNECTIONS connessioni) e
+    label, connessione a Google Sheets e ricerche dei partner partono insieme.
+    Il client Google non è asincrono: le chiamate Sheets e la generazione dei
+    fogli girano in thread con asyncio.to_thread. La modalità stream non è
+    disponibile (i fogli vengono scritti in delta).
+    """
+    if httpx is None:
+        raise RuntimeError("La modalità --async richiede httpx (pip install httpx)")
+
+    partners = list(partners or PARTNERS)
+    with run_telemetry(incremental=incremental, combined=combined, render_from_store=False,
+                       async_mode=True, partners=partners):
+        print_run_header(incremental, async_mode=True, partners=partners)
+        # Gli stage (dalla cache) decidono le proprietà richieste e i checkpoint validi
+        await asyncio.to_thread(load_stage_labels)
+        store = DealStore()
+        sync_state = load_sync_state()
+        plans = prepare_partners(store, sync_state, incremental, partners)
+        deals_by_partner = {}
+
+        client = httpx.AsyncClient(
+            headers=HUBSPOT_HEADERS,
+            timeout=httpx.Timeout(HUBSPOT_TIMEOUT[1], connect=HUBSPOT_TIMEOUT[0]),
+            limits=httpx.Limits(max_connections=max(1, ASYNC_MAX_CONNECTIONS)),
+        )
+        token = _hubspot_async_client.set(client)
+        try:
+            # Label e sessione Sheets servono solo per generare i fogli: partono insieme alle ricerche
+            labels_task = asyncio.create_task(asyncio.to_thread(load_labels))
+            session_task = asyncio.create_task(asyncio.to_thread(
+                connect_sheets, SHEETS_WRITE_MODE in ("delta", "stream"), partners
+            ))
+            semaphore = asyncio.Semaphore(max(1, EXPORT_WORKERS))
+
+            print(f"\nExport per partner ({EXPORT_WORKERS} ricerche contemporanee)...", flush=True)
+            if combined:
+                groups = group_partners_by_pipeline(partners)
+                for pipeline_id, keywords in groups.items():
+                    print(f"  Ricerca combinata pipeline {pipeline_id}: {', '.join(keywords)}", flush=True)
+                with timed_phase("fetch_combined"):
+                    for partner_deals in await asyncio.gather(*(
+                        get_deals_for_pipeline_async(pipeline_id, {k: plans[k] for k in keywords})
+                        for pipeline_id, keywords in groups.items()
+                    )):
+                        deals_by_partner.update(partner_deals)
+
+            async def export_one(partner_keyword):
+                with partner_context(partner_keyword):
+                    pipeline_id = PARTNERS[partner_keyword]["pipeline"] or PARTNERSHIP_PIPELINE_ID
+                    partner_deals = deals_by_partner.get(partner_keyword)
+                    if partner_deals is None:
+                        async with semaphore:
+                            log(f"Pipeline: {pipeline_id}")
+                            with timed_phase("fetch"):
+                                partner_deals = await get_deals_for_partner_async(
+                                    pipeline_id, partner_keyword, plans[partner_keyword]
+                                )
+                    return await asyncio.to_thread(
+                        store_partner_deals, store, partner_keyword, partner_deals, plans[partner_keyword]
+                    )
+
+            with timed_phase("partners"):
+                results = await asyncio.gather(*(export_one(partner_keyword) for partner_keyword in partners))
+                # Fogli generati dopo tutti i salvataggi (vedi run_export)
+                await labels_task
+                session = await session_task
+                to_render = partners_to_render(
+                    store, [k for k, (render, _) in zip(partners, results) if render]
+                )
+                await asyncio.gather(*(
+                    asyncio.to_thread(render_partner_from_store, session, store, partner_keyword)
+                    for partner_keyword in to_render
+                ))
+        finally:
+            _hubspot_async_client.reset(token)
+            await client.aclose()
+
+        last_modified = {partner_keyword: value for partner_keyword, (_, value) in zip(partners, results)}
+        await asyncio.to_thread(finish_export, session, store, sync_state, last_modified, partners)
+
+
+# Modalità --schedule: scheduler con run completi giornalieri e sync per partner
+@contextmanager
+def export_lock(blocking=False):
+    """
+    Lock esclusivo tra processi su EXPORT_LOCK_FILE, così due export (schedulati
+    o manuali) o un export e il ricevitore webhook non scrivono mai insieme.
+    Restituisce False se il lock è già preso; con blocking=True attende che si
+    liberi. Senza fcntl (Windows) non c'è lock tra processi.
+    """
+    if fcntl is None:
+        yield True
+        return
+    with open(EXPORT_LOCK_FILE, "a") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            if not blocking:
+                yield False
+                return
+            log(f"Export in corso in un altro processo, attendo il lock ({EXPORT_LOCK_FILE})")
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def load_schedule_state():
+    """Ultimi run riusciti: {"full": epoch, "partners": {partner_keyword: epoch}}."""
+    try:
+        with open(SCHEDULE_STATE_FILE) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        state = {}
+    state.setdefault("full", 0)
+    state.setdefault("partners", {})
+    return state
+
+
+def save_schedule_state(state):
+    write_file_atomic(SCHEDULE_STATE_FILE, json.dumps(state, indent=2, sort_keys=True) + "\n")
+
+
+def next_daily_slot(after, at=SCHEDULE_FULL_AT):
+    """Primo orario giornaliero "HH:MM" (ora locale) successivo all'epoch after."""
+    hour, minute = (int(part) for part in at.split(":"))
+    day = datetime.fromtimestamp(after)
+    slot = day.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if slot.timestamp() <= after:
+        slot = datetime.combine(day.date() + timedelta(days=1), slot.time())
+    return slot.timestamp()
+
+
+class ExportScheduler:
+    """
+    Scheduler della modalità --schedule: un export completo al giorno alle
+    SCHEDULE_FULL_AT e, con incremental, un sync incrementale per partner ogni
+    "sync_minutes" (PARTNERS, default SCHEDULE_INCREMENTAL_MINUTES).
+    I partner in scadenza insieme vengono esportati in un solo run, in ordine di
+    priorità; i run non si sovrappongono mai (un solo ciclo nel processo ed
+    export_lock tra processi). Gli orari dei run riusciti sono salvati in
+    SCHEDULE_STATE_FILE: dopo un riavvio i run persi vengono recuperati con un
+    solo run. Servizio Sheets, sessione HubSpot, rate limiter e cache delle
+    label restano in memoria tra un run e l'altro.
+    """
+
+    def __init__(self, export, incremental=False, combined=False):
+        self.export = export
+        self.incremental = incremental
+        self.combined = combined
+        self.state = load_schedule_state()
+        self.jitter = {}    # "full" o partner -> ritardo casuale del prossimo run (secondi)
+        self.retry_at = {}  # "full" o partner -> epoch prima del quale non ritentare
+
+    def delay(self, key):
+        if key not in self.jitter:
+            self.jitter[key] = random.uniform(0, max(0.0, SCHEDULE_JITTER_SECONDS))
+        return self.jitter[key]
+
+    def next_full(self):
+        """Epoch del prossimo export completo (subito se mai eseguito o se perso)."""
+        last = self.state["full"]
+        due = next_daily_slot(last) + self.delay("full") if last else 0
+        return max(due, self.retry_at.get("full", 0))
+
+    def next_sync(self, partner_keyword):
+        """Epoch del prossimo sync incrementale del partner."""
+        minutes = PARTNERS[partner_keyword].get("sync_minutes") or SCHEDULE_INCREMENTAL_MINUTES
+        last = self.state["partners"].get(partner_keyword, 0)
+        due = last + minutes * 60 + self.delay(partner_keyword)
+        return max(due, self.retry_at.get(partner_keyword, 0))
+
+    def due_run(self, now):
+        """Prossimo run da eseguire: (incremental, [partner per priorità]) o None."""
+        by_priority = sorted(PARTNERS, key=lambda k: -PARTNERS[k].get("priority", 0))
+        if now >= self.next_full():
+            return False, by_priority
+        if self.incremental:
+            partners = [k for k in by_priority if now >= self.next_sync(k)]
+            if partners:
+                return True, partners
+        return None
+
+    def next_wakeup(self):
+        times = [self.next_full()]
+        if self.incremental:
+            times += [self.next_sync(partner_keyword) for partner_keyword in PARTNERS]
+        return min(times)
+
+    def run(self, incremental, partners):
+        """Esegue un run con il lock; ne registra l'esito nello stato dello scheduler."""
+        keys = partners if incremental else ["full"] + partners
+        started = time.time()
+        with export_lock() as acquired:
+            if not acquired:
+                print(f"Export già in corso in un altro processo ({EXPORT_LOCK_FILE}), "
+                      f"nuovo tentativo tra {SCHEDULE_RETRY_SECONDS:g}s", flush=True)
+                self.retry_at.update(dict.fromkeys(keys, started + SCHEDULE_RETRY_SECONDS))
+                return False
+            try:
+                self.export(incremental=incremental, combined=self.combined, partners=partners)
+            except Exception as e:
+                # Un run fallito non ferma lo scheduler: viene ritentato più tardi
+                print(f"\nExport fallito: {type(e).__name__}: {e} "
+                      f"(nuovo tentativo tra {SCHEDULE_RETRY_SECONDS:g}s)", flush=True)
+                self.retry_at.update(dict.fromkeys(keys, started + SCHEDULE_RETRY_SECONDS))
+                return False
+
+        # Intervalli misurati dall'inizio del run: la durata non sposta le scadenze
+        if not incremental:
+            self.state["full"] = started
+        for partner_keyword in partners:
+            self.state["partners"][partner_keyword] = started
+        save_schedule_state(self.state)
+        for key in keys:
+            self.jitter.pop(key, None)
+            self.retry_at.pop(key, None)
+        return True
+
+    def print_plan(self):
+        def when(epoch):
+            return "subito" if epoch <= time.time() else datetime.fromtimestamp(epoch).strftime("%Y-%m-%d %H:%M:%S")
+
+        print(f"\nProssimo export completo: {when(self.next_full())}", flush=True)
+        if self.incremental:
+            for partner_keyword in PARTNERS:
+                minutes = PARTNERS[partner_keyword].get("sync_minutes") or SCHEDULE_INCREMENTAL_MINUTES
+                print(f"  {partner_keyword}: sync ogni {minutes:g} min, prossimo "
+                      f"{when(self.next_sync(partner_keyword))}", flush=True)
+
+    def run_forever(self):
+        self.print_plan()
+        while True:
+            due = self.due_run(time.time())
+            if due is not None:
+                if self.run(*due):
+                    self.print_plan()
+                continue
+            # Risveglio alla prossima scadenza (al massimo ogni 60 s: cambi d'ora, sospensioni)
+            time.sleep(min(60.0, max(1.0, self.next_wakeup() - time.time())))
+
+
+# Modalità --webhook: aggiornamento quasi in tempo reale delle singole righe
+BATCH_READ_PATH = "/crm/v3/objects/deals/batch/read"
+WEBHOOK_EVENT_TYPES = ("deal.propertyChange", "deal.creation")
+# Caratteri che HubSpot decodifica nell'URI prima di calcolare la firma v3
+SIGNATURE_URI_DECODE = {
+    "%3A": ":", "%2F": "/", "%3F": "?", "%40": "@", "%21": "!", "%24": "$",
+    "%27": "'", "%28": "(", "%29": ")", "%2A": "*", "%2C": ",", "%3B": ";",
+}
+
+
+def hubspot_signature_v3(secret, method, uri, body, timestamp):
+    """Firma v3 HubSpot: HMAC-SHA256 (base64) di metodo + URI + corpo + timestamp."""
+    for encoded, char in SIGNATURE_URI_DECODE.items():
+        uri = uri.replace(encoded, char).replace(encoded.lower(), char)
+    source = method.encode() + uri.encode() + body + str(timestamp).encode()
+    return base64.b64encode(hmac.new(secret.encode(), source, hashlib.sha256).digest()).decode()
+
+
+def verify_webhook_signature(method, uri, body, timestamp, signature, secret=None):
+    """True se la firma v3 è valida e il timestamp (epoch ms) ha meno di WEBHOOK_MAX_AGE_MS."""
+    secret = secret or HUBSPOT_CLIENT_SECRET
+    if not (secret and timestamp and signature):
+        return False
+    try:
+        age = abs(int(time.time() * 1000) - int(timestamp))
+    except ValueError:
+        return False
+    if age > WEBHOOK_MAX_AGE_MS:
+        return False
+    return hmac.compare_digest(hubspot_signature_v3(secret, method, uri, body, timestamp), signature)
+
+
+def webhook_deal_ids(events, exported):
+    """
+    Deal ID da aggiornare tra gli eventi di un webhook: creazioni e modifiche
+    di proprietà esportate (exported, le altre proprietà non cambiano le righe).
+    """
+    deal_ids = []
+    for event in events if isinstance(events, list) else []:
+        if event.get("subscriptionType") not in WEBHOOK_EVENT_TYPES or not event.get("objectId"):
+            continue
+        if (event["subscriptionType"] == "deal.propertyChange"
+                and event.get("propertyName") not in exported):
+            continue
+        deal_ids.append(str(event["objectId"]))
+    return deal_ids
+
+
+class WebhookBatcher:
+    """
+    Raccoglie i Deal ID dei webhook e li consegna in lotti: più eventi dello
+    stesso deal diventano una sola lettura, e un lotto parte dopo
+    WEBHOOK_DEBOUNCE_SECONDS senza nuovi eventi (al più WEBHOOK_MAX_DELAY_SECONDS
+    dopo il primo, così un flusso continuo non rimanda gli aggiornamenti).
+    """
+
+    def __init__(self, debounce=WEBHOOK_DEBOUNCE_SECONDS, max_delay=WEBHOOK_MAX_DELAY_SECONDS):
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.condition = threading.Condition()
+        self.pending = {}  # Deal ID -> None (dict: ordine di arrivo, senza duplicati)
+        self.first_at = None
+        self.last_at = None
+
+    def add(self, deal_ids):
+        """Accoda i Deal ID di un webhook."""
+        if not deal_ids:
+            return
+        with self.condition:
+            now = time.monotonic()
+            self.pending.update(dict.fromkeys(deal_ids))
+            if self.first_at is None:
+                self.first_at = now
+            self.last_at = now
+            self.condition.notify()
+
+    def next_batch(self, timeout=None):
+        """Attende il prossimo lotto di Deal ID (lista vuota se scade timeout)."""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                if self.pending:
+                    ready_at = min(self.last_at + self.debounce, self.first_at + self.max_delay)
+                    if now >= ready_at:
+                        batch = list(self.pending)
+                        self.pending.clear()
+                        self.first_at = self.last_at = None
+                        return batch
+                    wait = ready_at - now
+                else:
+                    wait = None
+                if deadline is not None:
+                    if now >= deadline:
+                        return []
+                    wait = min(wait, deadline - now) if wait is not None else deadline - now
+                self.condition.wait(wait)
+
+
+def batch_read_deals(deal_ids, properties=None):
+    """
+    Legge i deal indicati con la batch read API (HUBSPOT_BATCH_READ_LIMIT per
+    chiamata). I deal non trovati (eliminati o archiviati) vengono saltati.
+    """
+    deal_ids = list(deal_ids)
+    deals = []
+    for i in range(0, len(deal_ids), HUBSPOT_BATCH_READ_LIMIT):
+        data = hubspot_request("POST", BATCH_READ_PATH, json_body={
+            "properties": properties or hubspot_properties(),
+            "inputs": [{"id": deal_id} for deal_id in deal_ids[i:i + HUBSPOT_BATCH_READ_LIMIT]],
+        })
+        deals.extend(data.get("results", []))
+    return deals
+
+
+def deal_partners(properties):
+    """Partner il cui filtro (pipeline e partner_label_name) comprende il deal."""
+    return {
+        partner_keyword for partner_keyword, config in PARTNERS.items()
+        if properties.get("pipeline") == (config["pipeline"] or PARTNERSHIP_PIPELINE_ID)
+        and partner_matches(properties.get("partner_label_name"), partner_keyword)
+    }
+
+
+def patch_partner_rows(session, store, partner_keyword, deals, removed_ids):
+    """
+    Aggiorna nel foglio del partner solo le righe dei deal indicati e toglie
+    quelle dei deal usciti dal partner; le altre righe non vengono toccate.
+    Un foglio vuoto o con colonne diverse, o un partner diviso su più fogli,
+    viene generato per intero dall'archivio. Ritorna le celle accodate.
+    """
+    sheet_name = PARTNERS[partner_keyword]["sheet"]
+    existing_headers, _ = read_sheet_rows(session, sheet_name)
+    if (existing_headers != get_headers_for_partner(partner_keyword)
+            or len(partner_shard_titles(session, sheet_name)) > 1):
+        if not store.is_synced(partner_keyword):
+            log("Foglio da creare ma archivio senza export completo del partner: righe non aggiornate")
+            return 0
+        return render_partner(session, store, partner_keyword)
+
+    rows = process_deals(deals, partner_keyword)
+    cells, num_rows = write_delta(
+        session, sheet_name, partner_keyword, rows, delete_missing=False, remove_ids=removed_ids
+    )
+    format_sheet(session, sheet_name, num_rows, partner_keyword)
+    return cells
+
+
+def apply_deal_changes(service, store, deal_ids):
+    """
+    Lotto di webhook: legge i deal con una batch read, li salva nell'archivio e
+    aggiorna le righe dei partner interessati, compresi quelli da cui un deal è
+    uscito (cambio di pipeline o di partner). Ritorna le celle aggiornate.
+    """
+    set_run_clock()
+    load_stage_labels()
+    load_property_labels()
+
+    previous = store.get_deals(deal_ids)
+    fetched = batch_read_deals(deal_ids)
+    enrich_deals(store, fetched, {partner for deal in fetched for partner in deal_partners(deal.get("properties", {}))})
+    store.upsert(fetched)
+    current = store.get_deals([deal["id"] for deal in fetched])
+
+    changes = {}  # partner -> (deal da scrivere, Deal ID da togliere)
+    for deal_id, properties in current.items():
+        partners_now = deal_partners(properties)
+        for partner_keyword in partners_now:
+            changes.setdefault(partner_keyword, ([], []))[0].append({"id": deal_id, "properties": properties})
+        for partner_keyword in deal_partners(previous.get(deal_id, {})) - partners_now:
+            changes.setdefault(partner_keyword, ([], []))[1].append(deal_id)
+    if not changes:
+        return 0
+
+    # Metadati e valori riletti a ogni lotto sotto export_lock: un export precedente
+    # può aver creato, ampliato o riordinato i fogli
+    session = SheetsSession(service)
+    open_overflow_sessions(session)
+    prefetch_partner_sheets(session, changes)
+    for partner_keyword, (partner_deals, removed_ids) in changes.items():
+        with partner_context(partner_keyword):
+            patch_partner_rows(session, store, partner_keyword, partner_deals, removed_ids)
+
+    # Nuovi ingressi negli stage: ricalcola il funnel dei partner interessati
+    if store.dirty_labels:
+        update_funnel(session, store, list(changes))
+        store.dirty_labels.clear()
+    update_shard_index(session)
+    return sum(target.flush() for target in [session] + session.overflow)
+
+
+def make_webhook_handler(batcher, exported):
+    """
+    Handler HTTP del ricevitore: verifica la firma, accoda i Deal ID delle
+    modifiche alle proprietà in exported e risponde subito.
+    """
+
+    class WebhookHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def reply(self, status, text=""):
+            body = text.encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "text/plain; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            # Controllo di salute per il processo che tiene attivo il ricevitore
+            if self.path == "/health":
+                return self.reply(200, "ok")
+            return self.reply(404)
+
+        def do_POST(self):
+            if self.path.split("?")[0] != WEBHOOK_PATH:
+                return self.reply(404)
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+            base_url = WEBHOOK_PUBLIC_URL.rstrip("/") or (
+                f"{self.headers.get('X-Forwarded-Proto', 'http')}://{self.headers.get('Host', '')}"
+            )
+            if not verify_webhook_signature(
+                "POST", base_url + self.path, body,
+                self.headers.get("X-HubSpot-Request-Timestamp"),
+                self.headers.get("X-HubSpot-Signature-v3"),
+            ):
+                log("Webhook con firma non valida o scaduta, ignorato")
+                return self.reply(401, "invalid signature")
+
+            try:
+                events = json.loads(body or b"[]")
+            except ValueError:
+                return self.reply(400, "invalid JSON")
+            # Risposta immediata: HubSpot ritenta le consegne che superano i 5 secondi
+            batcher.add(webhook_deal_ids(events, exported))
+            return self.reply(204)
+
+    return WebhookHandler
+
+
+def run_webhook_receiver():
+    """
+    Ricevitore dei webhook HubSpot (creazione e modifica dei deal): gli eventi
+    vengono uniti per deal e, dopo il debounce, i deal cambiati vengono letti
+    con una batch read e le sole righe interessate aggiornate nei fogli.
+    Gira finché il processo non viene interrotto.
+    """
+    if not HUBSPOT_CLIENT_SECRET:
+        raise RuntimeError("La modalità --webhook richiede HUBSPOT_CLIENT_SECRET (firma v3 dei webhook)")
+
+    # Le proprietà della timeline (hs_v2_date_entered_*, hs_v2_cumulative_time_in_*)
+    # dipendono dagli stage: caricati prima di accettare eventi, insieme calcolato una volta
+    load_stage_labels()
+    exported = frozenset(hubspot_properties())
+
+    batcher = WebhookBatcher()
+    server = ThreadingHTTPServer((WEBHOOK_HOST, WEBHOOK_PORT), make_webhook_handler(batcher, exported))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Ricevitore webhook in ascolto su {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH} "
+          f"(debounce {WEBHOOK_DEBOUNCE_SECONDS:g}s)", flush=True)
+    print("Premi Ctrl+C per uscire\n", flush=True)
+
+    service = get_google_sheets_service()
+    store = DealStore()
+    try:
+        while True:
+            deal_ids = batcher.next_batch()
+            start = time.monotonic()
+            try:
+                # Un export in corso può riscrivere, dividere o compattare gli stessi fogli:
+                # il lotto attende il lock e legge i fogli solo dopo averlo preso
+                with export_lock(blocking=True):
+                    cells = apply_deal_changes(service, store, deal_ids)
+            except Exception as e:
+                # Un lotto fallito non ferma il ricevitore: i deal restano da rileggere all'export
+                log(f"Errore nell'aggiornamento di {len(deal_ids)} deal: {e}")
+                continue
+            log(f"{datetime.now().strftime('%H:%M:%S')} {len(deal_ids)} deal aggiornati, "
+                f"{cells} celle scritte in {time.monotonic() - start:.1f}s")
+    finally:
+        server.shutdown()
+        store.close()
+
+
+def main():
+    incremental = "--incremental" in sys.argv
+    if "--refresh-labels" in sys.argv:
+        invalidate_label_cache()
+    combined = "--combined" in sys.argv
+    export = run_export
+    if "--async" in sys.argv:
+        # Export su event loop asyncio (client HubSpot httpx)
+        def export(**kwargs):
+            asyncio.run(run_export_async(**kwargs))
+    if "--render-from-store" in sys.argv:
+        # Rigenera i fogli dall'archivio locale (es. dopo un cambio di colonne)
+        with export_lock() as acquired:
+            if not acquired:
+                sys.exit(f"Export già in corso in un altro processo ({EXPORT_LOCK_FILE})")
+            run_export(render_from_store=True)
+        return
+    if "--webhook" in sys.argv:
+        # Ricevitore webhook: aggiorna le righe dei deal modificati in pochi secondi
+        run_webhook_receiver()
+        return
+    if "--schedule" in sys.argv:
+        print(f"Modalità schedulata attiva - Export completo giornaliero alle {SCHEDULE_FULL_AT}", flush=True)
+        if incremental:
+            print(f"Export incrementale per partner (default ogni {SCHEDULE_INCREMENTAL_MINUTES:g} min)", flush=True)
+        print("Premi Ctrl+C per uscire\n", flush=True)
+
+        # L'export completo ricalcola anche i giorni in Proposal; i run persi vengono recuperati all'avvio
+        ExportScheduler(export, incremental=incremental, combined=combined).run_forever()
     else:
         # Esecuzione singola
-        run_export()
+        with export_lock() as acquired:
+            if not acquired:
+                sys.exit(f"Export già in corso in un altro processo ({EXPORT_LOCK_FILE})")
+            export(incremental=incremental, combined=combined)
 
 
 if __name__ == "__main__":
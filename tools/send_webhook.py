@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Invia al ricevitore di hubspot_to_sheets.py --webhook un webhook firmato come
+HubSpot (firma v3 con HUBSPOT_CLIENT_SECRET), per provarlo in locale senza
+registrare l'app su HubSpot.
+
+    python tools/send_webhook.py 12345 12346                    # deal.propertyChange su dealstage
+    python tools/send_webhook.py 12345 --property partner_label_name
+    python tools/send_webhook.py 12347 --creation
+    python tools/send_webhook.py 12345 --url http://localhost:8080/hubspot/webhook
+
+Stampa lo stato HTTP della risposta (204 = accodato, 401 = firma non valida).
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from hubspot_to_sheets import WEBHOOK_PATH, WEBHOOK_PORT, hubspot_signature_v3  # noqa: E402
+
+
+def make_events(deal_ids, property_name, creation):
+    """Eventi nel formato dei webhook HubSpot, uno per deal."""
+    now = int(time.time() * 1000)
+    events = []
+    for i, deal_id in enumerate(deal_ids):
+        event = {
+            "eventId": now + i,
+            "subscriptionId": 1,
+            "portalId": 1,
+            "appId": 1,
+            "occurredAt": now,
+            "subscriptionType": "deal.creation" if creation else "deal.propertyChange",
+            "attemptNumber": 0,
+            "objectId": int(deal_id),
+            "changeSource": "CRM_UI",
+        }
+        if not creation:
+            event.update(propertyName=property_name, propertyValue="")
+        events.append(event)
+    return events
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Invia un webhook HubSpot firmato al ricevitore locale")
+    parser.add_argument("deal_ids", nargs="+", help="Deal ID degli eventi")
+    parser.add_argument("--url", default=f"http://localhost:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    parser.add_argument("--property", default="dealstage", help="proprietà modificata (deal.propertyChange)")
+    parser.add_argument("--creation", action="store_true", help="invia eventi deal.creation")
+    parser.add_argument("--secret", default=os.getenv("HUBSPOT_CLIENT_SECRET", ""),
+                        help="client secret dell'app (default: HUBSPOT_CLIENT_SECRET)")
+    args = parser.parse_args()
+    if not args.secret:
+        parser.error("serve il client secret: --secret o HUBSPOT_CLIENT_SECRET")
+
+    body = json.dumps(make_events(args.deal_ids, args.property, args.creation)).encode()
+    timestamp = str(int(time.time() * 1000))
+    response = requests.post(args.url, data=body, timeout=10, headers={
+        "Content-Type": "application/json",
+        "X-HubSpot-Request-Timestamp": timestamp,
+        "X-HubSpot-Signature-v3": hubspot_signature_v3(args.secret, "POST", args.url, body, timestamp),
+    })
+    print(f"{response.status_code} {response.text}".strip(), flush=True)
+    sys.exit(0 if response.ok else 1)
+
+
+if __name__ == "__main__":
+    main()